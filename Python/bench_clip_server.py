@@ -0,0 +1,407 @@
+# bench_clip_server.py
+# Powtarzalny benchmark clip_server bez pobierania ViT-H-14 i bez GPU: generuje lokalnie mały, losowo
+# zainicjalizowany model CLIP w ONNX (z procesorem i znacznikiem eksportu, więc serwer nie łączy się z hubem),
+# ładuje aplikację FastAPI w tym samym procesie i mierzy opóźnienia (p50/p95/p99) oraz obrazy/s dla endpointów
+# w różnych rozmiarach partii, formatach odpowiedzi, konfiguracjach workerów i współbieżności klientów.
+# Osobno mierzone są etapy (odczyt, dekodowanie, preprocessing, inferencja, serializacja), żeby regresja
+# była od razu przypisana do konkretnego etapu. Wyniki zapisywane są do JSON i mogą być porównane z poprzednimi.
+# Użycie: python bench_clip_server.py [--quick] [--output wyniki.json] [--baseline poprzednie.json]
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+STAND_IN_MODEL_ID = "bench/tiny-clip"
+FORMATS = {
+    "json": ({"accept": "application/json"}, {}),
+    "binary_float32": ({"accept": "application/octet-stream"}, {"dtype": "float32"}),
+    "binary_float16": ({"accept": "application/octet-stream"}, {"dtype": "float16"}),
+    "npy": ({"accept": "application/x-npy"}, {}),
+}
+TEXTS = ["cosplay photo", "triss merigold", "a person in armor", "witcher cosplay at a convention",
+         "blue wig and school uniform", "photo of a cosplayer on stage", "yennefer", "geralt of rivia"]
+
+# --- Model zastępczy ---
+def _bytes_to_unicode() -> Dict[int, str]:
+    # Mapowanie bajtów na znaki jak w tokenizerze CLIP (GPT-2 byte-level BPE)
+    byte_values = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    characters = byte_values[:]
+    extra = 0
+    for value in range(256):
+        if value not in byte_values:
+            byte_values.append(value)
+            characters.append(256 + extra)
+            extra += 1
+    return dict(zip(byte_values, (chr(character) for character in characters)))
+
+def build_stand_in_model(model_dir: pathlib.Path, embedding_dim: int = 1024, width: int = 256, layers: int = 4,
+                         image_size: int = 224, seed: int = 0):
+    # Graf o interfejsie eksportu CLIP z optimum (input_ids, pixel_values, attention_mask -> logits_per_image,
+    # logits_per_text, text_embeds, image_embeds; osobne wymiary partii tekstu i obrazów) z losowymi wagami.
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+    from transformers import CLIPImageProcessor, CLIPProcessor, CLIPTokenizer
+
+    model_dir.mkdir(parents=True, exist_ok=True)
+    # Słownik z samych znaków (bez reguł BPE) - tokenizacja działa, a model nie potrzebuje sensownych tokenów
+    characters = list(_bytes_to_unicode().values())
+    vocab = {character: position for position, character in enumerate(characters)}
+    vocab.update({f"{character}</w>": len(characters) + position for position, character in enumerate(characters)})
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    (model_dir / "vocab.json").write_text(json.dumps(vocab), encoding="utf-8")
+    (model_dir / "merges.txt").write_text("#version: 0.2\n", encoding="utf-8")
+    tokenizer = CLIPTokenizer(str(model_dir / "vocab.json"), str(model_dir / "merges.txt"), model_max_length=77)
+    image_processor = CLIPImageProcessor(size={"shortest_edge": image_size}, crop_size={"height": image_size, "width": image_size})
+    CLIPProcessor(image_processor=image_processor, tokenizer=tokenizer).save_pretrained(str(model_dir))
+
+    rng = np.random.default_rng(seed)
+    patch = 32
+    initializers = [
+        numpy_helper.from_array((rng.standard_normal((width, 3, patch, patch)) * 0.02).astype(np.float32), "patch_weight"),
+        numpy_helper.from_array((rng.standard_normal((len(vocab), width)) * 0.02).astype(np.float32), "token_embedding"),
+        numpy_helper.from_array((rng.standard_normal((width, embedding_dim)) / np.sqrt(width)).astype(np.float32), "image_projection"),
+        numpy_helper.from_array((rng.standard_normal((width, embedding_dim)) / np.sqrt(width)).astype(np.float32), "text_projection"),
+        numpy_helper.from_array(np.array([2, 3], dtype=np.int64), "spatial_axes"),
+        numpy_helper.from_array(np.array([1], dtype=np.int64), "sequence_axis"),
+        numpy_helper.from_array(np.array([2], dtype=np.int64), "feature_axis"),
+    ]
+    nodes = [
+        helper.make_node("Conv", ["pixel_values", "patch_weight"], ["patches"], kernel_shape=[patch, patch], strides=[patch, patch]),
+        helper.make_node("ReduceMean", ["patches", "spatial_axes"], ["image_hidden_0"], keepdims=0),
+        helper.make_node("Gather", ["token_embedding", "input_ids"], ["token_vectors"]),
+        helper.make_node("Cast", ["attention_mask"], ["mask_float"], to=TensorProto.FLOAT),
+        helper.make_node("Unsqueeze", ["mask_float", "feature_axis"], ["mask_expanded"]),
+        helper.make_node("Mul", ["token_vectors", "mask_expanded"], ["masked_tokens"]),
+        helper.make_node("ReduceSum", ["masked_tokens", "sequence_axis"], ["text_hidden_0"], keepdims=0),
+    ]
+    # Warstwy MLP obu wież - pozwalają przybliżyć koszt obliczeń prawdziwego modelu (--model-width/--model-layers)
+    for tower in ("image", "text"):
+        for layer in range(layers):
+            weight_name = f"{tower}_mlp_{layer}"
+            initializers.append(numpy_helper.from_array((rng.standard_normal((width, width)) / np.sqrt(width)).astype(np.float32), weight_name))
+            nodes.append(helper.make_node("MatMul", [f"{tower}_hidden_{layer}", weight_name], [f"{tower}_linear_{layer}"]))
+            nodes.append(helper.make_node("Relu", [f"{tower}_linear_{layer}"], [f"{tower}_hidden_{layer + 1}"]))
+    nodes += [
+        helper.make_node("MatMul", [f"image_hidden_{layers}", "image_projection"], ["image_embeds"]),
+        helper.make_node("MatMul", [f"text_hidden_{layers}", "text_projection"], ["text_embeds"]),
+        helper.make_node("Transpose", ["text_embeds"], ["text_embeds_t"], perm=[1, 0]),
+        helper.make_node("MatMul", ["image_embeds", "text_embeds_t"], ["logits_per_image"]),
+        helper.make_node("Transpose", ["logits_per_image"], ["logits_per_text"], perm=[1, 0]),
+    ]
+    graph = helper.make_graph(
+        nodes, "bench_tiny_clip",
+        [helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["text_batch_size", "sequence_length"]),
+         helper.make_tensor_value_info("pixel_values", TensorProto.FLOAT, ["image_batch_size", 3, image_size, image_size]),
+         helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["text_batch_size", "sequence_length"])],
+        [helper.make_tensor_value_info(name, TensorProto.FLOAT, None)
+         for name in ("logits_per_image", "logits_per_text", "text_embeds", "image_embeds")],
+        initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 18)])
+    model.ir_version = 8
+    onnx.save(model, str(model_dir / "model.onnx"))
+    (model_dir / "_SUCCESSFUL_ONNX_EXPORT").write_text(f"Stand-in benchmark model generated at {time.ctime()}", encoding="utf-8")
+
+def generate_images(directory: pathlib.Path, count: int, width: int, height: int, seed: int = 0) -> List[str]:
+    # Syntetyczne zdjęcia JPEG: gładkie gradienty + szum, żeby koszt dekodowania przypominał prawdziwe zdjęcia
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    rows, columns = np.mgrid[0:height, 0:width].astype(np.float32)
+    paths = []
+    for position in range(count):
+        path = directory / f"bench_{width}x{height}_{position:04d}.jpg"
+        if not path.exists():
+            frequencies = rng.uniform(20, 200, size=3)
+            channels = [np.sin(columns / frequencies[0] + position) * 100 + 128,
+                        np.cos(rows / frequencies[1] - position) * 100 + 128,
+                        ((columns + rows) / frequencies[2] * 16) % 255]
+            image = np.stack(channels, axis=-1) + rng.normal(0, 12, size=(height, width, 3))
+            Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(path, quality=90)
+        paths.append(str(path))
+    return paths
+
+# --- Pomiary ---
+def summarize_latencies(latencies_ms: List[float]) -> Dict[str, float]:
+    values = np.asarray(latencies_ms, dtype=np.float64)
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(np.mean(values)),
+    }
+
+async def _measure(client, make_request: Callable[[int], Tuple[str, str, Dict[str, Any]]], items_per_request: int,
+                   requests: int, concurrency: int, warmup: int) -> Dict[str, Any]:
+    for position in range(warmup):
+        method, url, kwargs = make_request(position)
+        await client.request(method, url, **kwargs)
+    latencies: List[float] = []
+    errors: List[str] = []
+    counter = iter(range(warmup, warmup + requests))
+
+    async def worker():
+        for position in counter:
+            method, url, kwargs = make_request(position)
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            await response.aread()
+            latencies.append((time.perf_counter() - started) * 1000.0)
+            if response.status_code != 200:
+                errors.append(f"{response.status_code}: {response.text[:200]}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall_s = time.perf_counter() - started
+    return {
+        **summarize_latencies(latencies),
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / wall_s,
+        "images_per_second": len(latencies) * items_per_request / wall_s,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+    }
+
+def _endpoint_scenarios(paths: List[str], folder: pathlib.Path, batch_sizes: List[int], formats: List[str],
+                        vector_dim: int) -> List[Dict[str, Any]]:
+    # Każdy scenariusz: endpoint, rozmiar partii, format, liczba elementów w żądaniu i fabryka żądań (kolejne
+    # żądania biorą kolejne obrazy, więc nawet przy włączonym cache nie trafia się w te same pliki od razu)
+    def pick(position: int, count: int) -> List[str]:
+        start = (position * count) % len(paths)
+        return [paths[(start + offset) % len(paths)] for offset in range(count)]
+
+    scenarios: List[Dict[str, Any]] = []
+    for format_name in formats:
+        headers, params = FORMATS[format_name]
+        scenarios.append({"endpoint": "/get_image_embedding", "batch_size": 1, "format": format_name, "items": 1,
+                          "make": lambda i, h=headers, q=params: ("POST", "/get_image_embedding", {"json": {"path": pick(i, 1)[0]}, "headers": h, "params": q})})
+        scenarios.append({"endpoint": "/get_text_embedding", "batch_size": 1, "format": format_name, "items": 1,
+                          "make": lambda i, h=headers, q=params: ("POST", "/get_text_embedding", {"json": {"text": TEXTS[i % len(TEXTS)]}, "headers": h, "params": q})})
+        for batch_size in batch_sizes:
+            scenarios.append({"endpoint": "/get_image_embeddings_batch", "batch_size": batch_size, "format": format_name, "items": batch_size,
+                              "make": lambda i, b=batch_size, h=headers, q=params: ("POST", "/get_image_embeddings_batch", {"json": {"paths": pick(i, b)}, "headers": h, "params": q})})
+            scenarios.append({"endpoint": "/get_text_embeddings_batch", "batch_size": batch_size, "format": format_name, "items": batch_size,
+                              "make": lambda i, b=batch_size, h=headers, q=params: ("POST", "/get_text_embeddings_batch", {"json": {"texts": [TEXTS[(i + k) % len(TEXTS)] + f" {k}" for k in range(b)]}, "headers": h, "params": q})})
+
+    def upload(position: int):
+        path = pick(position, 1)[0]
+        with open(path, "rb") as f:
+            return "POST", "/get_image_embedding_upload", {"files": {"file": (os.path.basename(path), f.read(), "image/jpeg")}}
+    scenarios.append({"endpoint": "/get_image_embedding_upload", "batch_size": 1, "format": "json", "items": 1, "make": upload})
+
+    folder_count = len(list(folder.glob("*.jpg")))
+    for ingest_format in ("ndjson", "binary"):
+        scenarios.append({"endpoint": "/ingest_folder", "batch_size": folder_count, "format": ingest_format, "items": folder_count,
+                          "make": lambda i, f=ingest_format: ("POST", "/ingest_folder", {"json": {"root": str(folder), "format": f}})})
+
+    rng = np.random.default_rng(1)
+    query_vectors = rng.standard_normal((max(batch_sizes), vector_dim)).astype(np.float32).tolist()
+    for batch_size in batch_sizes:
+        scenarios.append({"endpoint": "/index/{name}/search", "batch_size": batch_size, "format": "json", "items": batch_size,
+                          "make": lambda i, b=batch_size: ("POST", "/index/bench/search", {"json": {"vectors": query_vectors[:b], "top_k": 10}})})
+        scenarios.append({"endpoint": "/classify", "batch_size": batch_size, "format": "json", "items": batch_size,
+                          "make": lambda i, b=batch_size: ("POST", "/classify", {"json": {"index": "bench", "vectors": query_vectors[:b]}})})
+    largest = max(batch_sizes)
+    scenarios.append({"endpoint": "/duplicates", "batch_size": largest, "format": "json", "items": largest,
+                      "make": lambda i: ("POST", "/duplicates", {"json": {"paths": pick(i, largest), "threshold": 0.97}})})
+    scenarios.append({"endpoint": "/cluster", "batch_size": largest, "format": "json", "items": largest,
+                      "make": lambda i: ("POST", "/cluster", {"json": {"index": "bench", "k": 8, "include_centroids": False}})})
+    return scenarios
+
+async def run_endpoint_benchmarks(clip_server, paths: List[str], folder: pathlib.Path, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    import httpx
+
+    results = []
+    for worker_config in args.workers:
+        decode_workers, inference_threads = (int(part) for part in worker_config.split("x"))
+        # Konfiguracja workerów jest czytana przy starcie aplikacji (pula dekodująca, wątki inferencji, sesja ONNX)
+        clip_server.DECODE_WORKERS = decode_workers
+        clip_server.INFERENCE_THREADS = inference_threads
+        await clip_server.startup_event()
+        if clip_server.embedder is None:
+            raise RuntimeError("Nie udało się zainicjalizować embeddera na modelu zastępczym - sprawdź logi.")
+        try:
+            transport = httpx.ASGITransport(app=clip_server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=600.0) as client:
+                rng = np.random.default_rng(2)
+                index_vectors = rng.standard_normal((args.index_size, args.embedding_dim)).astype(np.float32)
+                await client.post("/index/bench/upsert", json={"ids": [f"v{row}" for row in range(args.index_size)], "vectors": index_vectors.tolist()})
+                for scenario in _endpoint_scenarios(paths, folder, args.batch_sizes, args.formats, args.embedding_dim):
+                    for concurrency in args.concurrency:
+                        measured = await _measure(client, scenario["make"], scenario["items"], args.requests, concurrency, args.warmup)
+                        row = {"kind": "endpoint", "endpoint": scenario["endpoint"], "batch_size": scenario["batch_size"],
+                               "format": scenario["format"], "concurrency": concurrency, "workers": worker_config, **measured}
+                        results.append(row)
+                        print(f"{row['endpoint']:<28} {row['format']:<15} b={row['batch_size']:<4} c={concurrency:<3} w={worker_config:<5} "
+                              f"p50={row['p50_ms']:9.2f}ms p95={row['p95_ms']:9.2f}ms p99={row['p99_ms']:9.2f}ms "
+                              f"{row['images_per_second']:9.1f} obr/s" + (f"  BŁĘDY: {row['errors']} ({row['first_error']})" if row["errors"] else ""))
+                await client.delete("/index/bench")
+        finally:
+            await clip_server.shutdown_event()
+    return results
+
+def _time_repeated(func: Callable[[], Any], repeats: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000.0)
+    return summarize_latencies(samples)
+
+def run_stage_benchmarks(clip_server, paths: List[str], args: argparse.Namespace) -> List[Dict[str, Any]]:
+    # Etapy potoku mierzone bezpośrednio na embedderze - regresja w endpointach da się przypisać do etapu
+    from fastapi.responses import JSONResponse
+
+    embedder = clip_server.CLIPImageEmbedder(device="cpu")
+    results = []
+    image_bytes = embedder._read_image_bytes(paths[0])
+    decoded = embedder._load_image(image_bytes)
+    stages = [
+        ("read", 1, lambda: embedder._read_image_bytes(paths[0])),
+        ("decode", 1, lambda: embedder._load_image(image_bytes)),
+        ("preprocess", 1, lambda: embedder.processor(images=[decoded], return_tensors="np")),
+        ("decode_and_preprocess", 1, lambda: embedder._prepare_image_pixels(image_bytes)),
+    ]
+    pixels = embedder._prepare_image_pixels(image_bytes)
+    for batch_size in args.batch_sizes:
+        batch_pixels = np.repeat(pixels[None], batch_size, axis=0)
+        embeddings = embedder.get_image_embeddings_from_pixels(batch_pixels)
+        stages.append(("inference_image", batch_size, lambda p=batch_pixels: embedder.get_image_embeddings_from_pixels(p)))
+        stages.append(("inference_text", batch_size, lambda b=batch_size: embedder.get_text_embeddings_batch([TEXTS[k % len(TEXTS)] for k in range(b)])))
+        stages.append(("serialize_json", batch_size, lambda e=embeddings: JSONResponse(content={"embeddings": e.tolist()}).body))
+        stages.append(("serialize_binary_float32", batch_size, lambda e=embeddings: clip_server.encode_embeddings_binary(e, "float32")))
+        stages.append(("serialize_binary_float16", batch_size, lambda e=embeddings: clip_server.encode_embeddings_binary(e, "float16")))
+    for stage, batch_size, func in stages:
+        func()  # rozgrzewka
+        measured = _time_repeated(func, args.stage_repeats)
+        row = {"kind": "stage", "stage": stage, "batch_size": batch_size, **measured,
+               "images_per_second": batch_size / (measured["p50_ms"] / 1000.0) if measured["p50_ms"] > 0 else None}
+        results.append(row)
+        print(f"etap {stage:<26} b={batch_size:<4} p50={row['p50_ms']:9.3f}ms p95={row['p95_ms']:9.3f}ms")
+    return results
+
+# --- Porównanie z poprzednim przebiegiem ---
+def _result_key(row: Dict[str, Any]) -> Tuple:
+    if row["kind"] == "stage":
+        return ("stage", row["stage"], row["batch_size"])
+    return ("endpoint", row["endpoint"], row["batch_size"], row["format"], row["concurrency"], row["workers"])
+
+def compare_with_baseline(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    baseline_by_key = {_result_key(row): row for row in baseline}
+    regressions = []
+    for row in results:
+        previous = baseline_by_key.get(_result_key(row))
+        if previous is None:
+            continue
+        if row["p50_ms"] > previous["p50_ms"] * (1.0 + tolerance):
+            regressions.append(f"{_result_key(row)}: p50 {previous['p50_ms']:.2f}ms -> {row['p50_ms']:.2f}ms")
+        elif row.get("images_per_second") and previous.get("images_per_second") and row["images_per_second"] < previous["images_per_second"] * (1.0 - tolerance):
+            regressions.append(f"{_result_key(row)}: {previous['images_per_second']:.1f} -> {row['images_per_second']:.1f} obr/s")
+    return regressions
+
+def _configure_environment(work_dir: pathlib.Path):
+    # Wszystko w katalogu roboczym benchmarku: model, cache, indeksy; bez sieci i bez cudzego session_config.json
+    os.environ["CLIP_MODELS_DIR"] = str(work_dir / "models")
+    os.environ["CLIP_CACHE_DIR"] = str(work_dir / "cache")
+    os.environ["CLIP_INDEX_DIR"] = str(work_dir / "indexes")
+    os.environ["CLIP_SESSION_CONFIG"] = str(work_dir / "session_config.json")
+    os.environ["CLIP_MODEL_ID"] = STAND_IN_MODEL_ID
+    os.environ["CLIP_DEVICE"] = "cpu"
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ.setdefault("CLIP_CACHE_ENABLED", "0")
+
+def _parse_int_list(value: str) -> List[int]:
+    return [int(part) for part in value.split(",") if part.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark clip_server na lokalnym modelu zastępczym (bez sieci i GPU).")
+    parser.add_argument("--work-dir", type=str, default=None, help="Katalog roboczy (model, obrazy, cache); domyślnie tymczasowy")
+    parser.add_argument("--batch-sizes", type=_parse_int_list, default=[1, 8, 32])
+    parser.add_argument("--formats", type=lambda v: v.split(","), default=list(FORMATS), help=f"Formaty odpowiedzi: {','.join(FORMATS)}")
+    parser.add_argument("--workers", type=lambda v: v.split(","), default=["1x1", "4x1"],
+                        help="Konfiguracje workerów: <wątki dekodowania>x<wątki inferencji>, np. 1x1,4x2")
+    parser.add_argument("--concurrency", type=_parse_int_list, default=[1, 4], help="Liczba równoległych klientów")
+    parser.add_argument("--requests", type=int, default=20, help="Żądań na scenariusz")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--stage-repeats", type=int, default=20)
+    parser.add_argument("--images", type=int, default=64, help="Liczba syntetycznych obrazów")
+    parser.add_argument("--image-size", type=str, default="1920x1080")
+    parser.add_argument("--folder-images", type=int, default=32, help="Obrazów w folderze dla /ingest_folder")
+    parser.add_argument("--index-size", type=int, default=10000, help="Wektorów w indeksie dla /index/search i /classify")
+    parser.add_argument("--embedding-dim", type=int, default=1024)
+    parser.add_argument("--model-width", type=int, default=256)
+    parser.add_argument("--model-layers", type=int, default=4)
+    parser.add_argument("--skip-stages", action="store_true")
+    parser.add_argument("--skip-endpoints", action="store_true")
+    parser.add_argument("--quick", action="store_true", help="Mała macierz scenariuszy (sprawdzenie, że wszystko działa)")
+    parser.add_argument("--output", type=str, default=None, help="Plik JSON z wynikami")
+    parser.add_argument("--baseline", type=str, default=None, help="Poprzedni plik wyników do porównania")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Dopuszczalne pogorszenie względem baseline (0.15 = 15%%)")
+    args = parser.parse_args()
+    if args.quick:
+        args.batch_sizes, args.formats, args.workers, args.concurrency = [1, 8], ["json", "binary_float32"], ["2x1"], [1]
+        args.requests, args.stage_repeats, args.images, args.folder_images, args.index_size = 5, 5, 16, 8, 2000
+
+    work_dir = pathlib.Path(args.work_dir) if args.work_dir else pathlib.Path(tempfile.mkdtemp(prefix="clip_bench_"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    _configure_environment(work_dir)
+    model_dir = work_dir / "models" / STAND_IN_MODEL_ID.replace("/", "_--_")
+    model_signature = {"embedding_dim": args.embedding_dim, "width": args.model_width, "layers": args.model_layers}
+    signature_path = model_dir / "bench_model.json"
+    if not signature_path.exists() or json.loads(signature_path.read_text(encoding="utf-8")) != model_signature:
+        print(f"Generowanie modelu zastępczego w {model_dir} ({model_signature})...")
+        for stale in model_dir.glob("*") if model_dir.exists() else []:
+            stale.unlink()
+        build_stand_in_model(model_dir, args.embedding_dim, args.model_width, args.model_layers)
+        signature_path.write_text(json.dumps(model_signature), encoding="utf-8")
+
+    width, height = (int(part) for part in args.image_size.lower().split("x"))
+    paths = generate_images(work_dir / "images", args.images, width, height)
+    folder = work_dir / "ingest"
+    generate_images(folder, args.folder_images, width, height, seed=1)
+
+    sys.path.insert(0, str(pathlib.Path(__file__).parent.resolve()))
+    clip_server = importlib.import_module("clip_server")
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    clip_server.logger.setLevel(logging.WARNING)
+
+    import onnxruntime
+    results: List[Dict[str, Any]] = []
+    if not args.skip_stages:
+        results += run_stage_benchmarks(clip_server, paths, args)
+    if not args.skip_endpoints:
+        results += asyncio.run(run_endpoint_benchmarks(clip_server, paths, folder, args))
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {"python": sys.version.split()[0], "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                        "onnxruntime": onnxruntime.__version__, "numpy": np.__version__},
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Zapisano wyniki do {args.output}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESJA {line}")
+        if regressions:
+            raise SystemExit(1)
+        print("Brak regresji względem baseline.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# bench_serialization.py
+# Porównanie kosztu serializacji odpowiedzi z embeddingami: JSON przez Pydantic (dotychczasowa ścieżka
+# response_model) vs JSON bez walidacji vs format binarny (float32/float16) vs .npy.
+# Mierzy kodowanie po stronie serwera, dekodowanie po stronie klienta i rozmiar odpowiedzi.
+# Użycie: python bench_serialization.py [--dim 1024] [--repeats 20] [--output wyniki.json]
+import argparse
+import json
+import statistics
+import time
+from io import BytesIO
+
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from clip_server import EmbeddingsResponse, encode_embeddings_binary, decode_embeddings_binary
+
+VECTOR_COUNTS = [1, 64, 512]
+
+def _encode_json_pydantic(embeddings: np.ndarray) -> bytes:
+    # Odpowiednik dawnej ścieżki: lista list floatów -> walidacja modelu -> jsonable_encoder -> JSONResponse
+    model = EmbeddingsResponse(embeddings=[emb.tolist() for emb in embeddings])
+    return JSONResponse(content=jsonable_encoder(model)).body
+
+def _encode_json_direct(embeddings: np.ndarray) -> bytes:
+    return JSONResponse(content={"embeddings": embeddings.tolist()}).body
+
+def _encode_npy(embeddings: np.ndarray) -> bytes:
+    buffer = BytesIO()
+    np.save(buffer, embeddings.astype("<f4", copy=False), allow_pickle=False)
+    return buffer.getvalue()
+
+def _decode_json(payload: bytes) -> np.ndarray:
+    return np.asarray(json.loads(payload)["embeddings"], dtype=np.float32)
+
+def _decode_npy(payload: bytes) -> np.ndarray:
+    return np.load(BytesIO(payload), allow_pickle=False)
+
+FORMATS = {
+    "json_pydantic": (_encode_json_pydantic, _decode_json),
+    "json_direct": (_encode_json_direct, _decode_json),
+    "binary_float32": (lambda e: encode_embeddings_binary(e, "float32"), decode_embeddings_binary),
+    "binary_float16": (lambda e: encode_embeddings_binary(e, "float16"), decode_embeddings_binary),
+    "npy_float32": (_encode_npy, _decode_npy),
+}
+
+def _time_ms(func, argument, repeats: int) -> float:
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func(argument)
+        samples.append((time.perf_counter() - started) * 1000.0)
+    return statistics.median(samples)
+
+def run_benchmark(dim: int, repeats: int) -> list:
+    rng = np.random.default_rng(0)
+    results = []
+    for count in VECTOR_COUNTS:
+        embeddings = rng.standard_normal((count, dim)).astype(np.float32)
+        for format_name, (encode, decode) in FORMATS.items():
+            payload = encode(embeddings)
+            decoded = decode(payload)
+            max_abs_error = float(np.max(np.abs(decoded.astype(np.float32) - embeddings)))
+            results.append({
+                "vectors": count,
+                "dim": dim,
+                "format": format_name,
+                "payload_bytes": len(payload),
+                "encode_ms": _time_ms(encode, embeddings, repeats),
+                "decode_ms": _time_ms(decode, payload, repeats),
+                "max_abs_error": max_abs_error,
+            })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark serializacji odpowiedzi z embeddingami clip_server.")
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--output", type=str, default=None, help="Opcjonalny plik JSON z wynikami")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.dim, args.repeats)
+    print(f"{'wektory':>8} {'format':<16} {'bajty':>12} {'kodowanie ms':>13} {'dekodowanie ms':>15} {'max błąd':>10}")
+    for row in results:
+        print(f"{row['vectors']:>8} {row['format']:<16} {row['payload_bytes']:>12} {row['encode_ms']:>13.3f} {row['decode_ms']:>15.3f} {row['max_abs_error']:>10.2e}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Zapisano wyniki do {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,43 @@
 ﻿# clip_server.py
 import uvicorn
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Body
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Body, Request, Depends
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
 from pydantic import BaseModel, Field
-from typing import List, Union, Optional, Dict, Any
+from typing import List, Union, Optional, Dict, Any, Callable, Deque, Tuple, Literal, Set
 import numpy as np
 import os
 import base64
 from io import BytesIO
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 import logging
 import pathlib
 import time # Dla mechanizmu blokady i oczekiwania
+import argparse
+import asyncio
+import struct
+import hashlib
+import json
+import fnmatch
+import re
+import itertools
+import sqlite3
+import threading
+import secrets
+import multiprocessing
+import sys
+import bisect
+import contextlib
+import contextvars
+import functools
+import cProfile
+import pstats
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client, Listener
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, CancelledError as FutureCancelledError
 
 # --- Konfiguracja Logowania ---
 logger = logging.getLogger("clip_server")
@@ -38,42 +64,1091 @@ else: # Jeśli Uvicorn już skonfigurował handlery, zmodyfikuj ich formatter
 # --- Koniec Konfiguracji Logowania ---
 
 import onnxruntime
-from transformers import AutoProcessor
-from optimum.onnxruntime import ORTModelForFeatureExtraction
-from huggingface_hub import snapshot_download
+# transformers (AutoProcessor), optimum i huggingface_hub są importowane leniwie: optimum/huggingface_hub tylko
+# przy pobieraniu i eksporcie modelu, więc start z gotowym eksportem nie ładuje ich ani nie łączy się z hubem.
 
 # --- Konfiguracja Ścieżek Modeli ---
 SCRIPT_DIR = pathlib.Path(__file__).parent.resolve()
-LOCAL_MODELS_ROOT_DIR = SCRIPT_DIR / "models"
+LOCAL_MODELS_ROOT_DIR = pathlib.Path(os.environ.get("CLIP_MODELS_DIR") or (SCRIPT_DIR / "models"))
 LOCAL_MODELS_ROOT_DIR.mkdir(parents=True, exist_ok=True)
 logger.info(f"Główny lokalny folder modeli: {LOCAL_MODELS_ROOT_DIR}")
 
 # Plik blokady dla synchronizacji eksportu między procesami
 EXPORT_LOCK_FILE = LOCAL_MODELS_ROOT_DIR / ".export_lock"
+
+# Domyślny model i urządzenie (nadpisywane np. przez benchmark z lokalnym modelem zastępczym)
+DEFAULT_MODEL_ID = os.environ.get("CLIP_MODEL_ID") or "laion/CLIP-ViT-H-14-laion2B-s32B-b79K"
+DEFAULT_DEVICE = os.environ.get("CLIP_DEVICE") or "cuda"
 # --- Koniec Konfiguracji Ścieżek Modeli ---
 
+# --- Konfiguracja Serwera (zmienne środowiskowe) ---
+def _env_int(name: str, default: int) -> int:
+    raw_value = os.environ.get(name)
+    if raw_value is None or raw_value.strip() == "":
+        return default
+    try:
+        return int(raw_value)
+    except ValueError:
+        logger.warning(f"Nieprawidłowa wartość zmiennej {name}='{raw_value}'. Używam domyślnej: {default}")
+        return default
+
+def _env_float(name: str, default: float) -> float:
+    raw_value = os.environ.get(name)
+    if raw_value is None or raw_value.strip() == "":
+        return default
+    try:
+        return float(raw_value)
+    except ValueError:
+        logger.warning(f"Nieprawidłowa wartość zmiennej {name}='{raw_value}'. Używam domyślnej: {default}")
+        return default
+
+# Mikro-batching: pojedyncze żądania są zbierane w partie ograniczone rozmiarem i maksymalnym czasem oczekiwania
+BATCH_MAX_SIZE = max(1, _env_int("CLIP_BATCH_MAX_SIZE", 32))
+BATCH_MAX_WAIT_MS = max(0.0, _env_float("CLIP_BATCH_MAX_WAIT_MS", 10.0))
+# Liczba wątków wykonujących wywołania ONNX poza pętlą zdarzeń (1 = wywołania sesji są serializowane)
+INFERENCE_THREADS = max(1, _env_int("CLIP_INFERENCE_THREADS", 1))
+# Równoległe dekodowanie/preprocessing obrazów nakładające się na inferencję poprzedniej porcji
+DECODE_WORKERS = max(1, _env_int("CLIP_DECODE_WORKERS", min(8, os.cpu_count() or 4)))
+INFERENCE_CHUNK_SIZE = max(1, _env_int("CLIP_INFERENCE_CHUNK_SIZE", 32))
+# Limity wsadowego uploadu obrazów (/get_image_embeddings_upload) - całe żądanie jest trzymane w pamięci
+UPLOAD_MAX_MB = max(1, _env_int("CLIP_UPLOAD_MAX_MB", 256))
+UPLOAD_MAX_FILES = max(1, _env_int("CLIP_UPLOAD_MAX_FILES", 512))
+# Tryb wielu wycinków (?crops=auto|grid): limit wycinków na obraz
+CROP_MAX_PER_IMAGE = max(1, _env_int("CLIP_MAX_CROPS", 64))
+# Pasy priorytetów: interaktywny (pojedyncze zdjęcie, tekst, wyszukiwanie) i masowy (partie, ingest, duplikaty).
+# Każdy pas ma własny limit równoległych żądań i długość kolejki; pełna kolejka = 429 z Retry-After.
+# Klient może wskazać pas nagłówkiem X-CLIP-Priority lub ?priority=interactive|bulk (domyślny zależy od endpointu).
+# Kolejka masowa jest długa, bo aplikacja wysyła równolegle po kilka partii na każdy folder modelki, a czekające
+# żądanie to tylko uśpiona korutyna; 429 ma chronić przed zalewem, nie przed zwykłym tworzeniem profili.
+INTERACTIVE_CONCURRENCY = max(1, _env_int("CLIP_INTERACTIVE_CONCURRENCY", 32))
+INTERACTIVE_QUEUE = max(0, _env_int("CLIP_INTERACTIVE_QUEUE", 128))
+BULK_CONCURRENCY = max(1, _env_int("CLIP_BULK_CONCURRENCY", 1))
+BULK_QUEUE = max(0, _env_int("CLIP_BULK_QUEUE", 256))
+# Co ile sprawdzać, czy klient nie zerwał połączenia (porzucona praca jest przerywana na granicy porcji)
+DISCONNECT_POLL_MS = max(10.0, _env_float("CLIP_DISCONNECT_POLL_MS", 250.0))
+DECODE_PREFETCH_CHUNKS = max(1, _env_int("CLIP_DECODE_PREFETCH_CHUNKS", 1))
+# Dekodowanie dużych JPEG w zmniejszonej skali (PIL draft) i wstępne skalowanie najkrótszego boku - CLIP i tak
+# potrzebuje tylko ~224px. 0 = pełna rozdzielczość, skalowanie tylko w procesorze CLIP
+DECODE_USE_DRAFT = _env_int("CLIP_DECODE_DRAFT", 1) != 0
+# Trwały cache embeddingów kluczowany hashem zawartości pliku + modelem (wspólny dla workerów)
+CACHE_ENABLED = _env_int("CLIP_CACHE_ENABLED", 1) != 0
+CACHE_DIR = pathlib.Path(os.environ.get("CLIP_CACHE_DIR") or (SCRIPT_DIR / "cache"))
+CACHE_MEMORY_ITEMS = max(0, _env_int("CLIP_CACHE_MEMORY_ITEMS", 20000))
+CACHE_MAX_DISK_MB = max(1, _env_int("CLIP_CACHE_MAX_DISK_MB", 2048))
+# Cache embeddingów tekstu (model + znormalizowany prompt); z CLIP_TEXT_CACHE_PERSIST=1 wektory trafiają też
+# do cache embeddingów na dysku (o ile CLIP_CACHE_ENABLED=1), więc zestawy etykiet przeżywają restart
+TEXT_CACHE_ITEMS = max(0, _env_int("CLIP_TEXT_CACHE_ITEMS", 10000))
+TEXT_CACHE_PERSIST = _env_int("CLIP_TEXT_CACHE_PERSIST", 1) != 0
+# Definicje zestawów etykiet do tagowania zero-shot (/labels, /tag)
+LABEL_SETS_DIR = pathlib.Path(os.environ.get("CLIP_LABEL_SETS_DIR") or (SCRIPT_DIR / "label_sets"))
+# Projekcje kompaktowych wektorów (PCA + kwantyzacja int8/PQ) dopasowane na próbce (/projections, ?projection=)
+PROJECTIONS_DIR = pathlib.Path(os.environ.get("CLIP_PROJECTIONS_DIR") or (SCRIPT_DIR / "projections"))
+# Trwałe indeksy wektorowe (/index/..., /classify)
+INDEX_DIR = pathlib.Path(os.environ.get("CLIP_INDEX_DIR") or (SCRIPT_DIR / "indexes"))
+INDEX_IVF_THRESHOLD = max(1, _env_int("CLIP_INDEX_IVF_THRESHOLD", 100000))
+INDEX_IVF_NPROBE = max(1, _env_int("CLIP_INDEX_IVF_NPROBE", 8))
+# Opóźnienie zapisu indeksu na dysk po zmianie (kolejne zmiany w tym czasie są łączone w jeden zapis)
+INDEX_SAVE_DELAY_S = max(0.0, _env_float("CLIP_INDEX_SAVE_DELAY_S", 2.0))
+
+# Wariant modelu ONNX: fp32 (eksport bazowy), int8 (dynamiczna kwantyzacja wag) lub fp16 (połowiczna precyzja).
+# Warianty są generowane z eksportu fp32 przy pierwszym użyciu i trzymane obok niego z własnym znacznikiem.
+MODEL_VARIANTS = {
+    "fp32": ("model.onnx", "_SUCCESSFUL_ONNX_EXPORT"),
+    "int8": ("model_int8.onnx", "_SUCCESSFUL_ONNX_EXPORT_INT8"),
+    "fp16": ("model_fp16.onnx", "_SUCCESSFUL_ONNX_EXPORT_FP16"),
+}
+MODEL_VARIANT = (os.environ.get("CLIP_MODEL_VARIANT") or "fp32").strip().lower()
+if MODEL_VARIANT not in MODEL_VARIANTS:
+    logger.warning(f"Nieznany wariant modelu CLIP_MODEL_VARIANT='{MODEL_VARIANT}'. Używam 'fp32'.")
+    MODEL_VARIANT = "fp32"
+
+# Ustawienia sesji ONNX Runtime. Kolejność (od najsłabszej): domyślne -> plik JSON (CLIP_SESSION_CONFIG,
+# domyślnie session_config.json obok skryptu) -> zmienne środowiskowe -> flagi CLI (przekazywane workerom przez env).
+SESSION_CONFIG_FILE = pathlib.Path(os.environ.get("CLIP_SESSION_CONFIG") or (SCRIPT_DIR / "session_config.json"))
+SESSION_SETTINGS_DEFAULTS: Dict[str, Any] = {
+    "workers": 0,               # 0 = CLIP_WORKERS / WEB_CONCURRENCY / 1
+    "intra_op_threads": 0,      # 0 = rdzenie / (workery * wątki inferencji)
+    "inter_op_threads": 0,      # 0 = 1 dla trybu sekwencyjnego, 2 dla równoległego
+    "graph_optimization": "all",
+    "execution_mode": "sequential",
+    "enable_mem_arena": True,
+    "enable_mem_pattern": True,
+    "cache_optimized_model": True,
+    "io_binding": "auto",       # auto = tylko dla CUDAExecutionProvider
+}
+SESSION_SETTINGS_ENV = {
+    "workers": "CLIP_WORKERS",
+    "intra_op_threads": "CLIP_ORT_INTRA_OP_THREADS",
+    "inter_op_threads": "CLIP_ORT_INTER_OP_THREADS",
+    "graph_optimization": "CLIP_ORT_GRAPH_OPTIMIZATION",
+    "execution_mode": "CLIP_ORT_EXECUTION_MODE",
+    "enable_mem_arena": "CLIP_ORT_MEM_ARENA",
+    "enable_mem_pattern": "CLIP_ORT_MEM_PATTERN",
+    "cache_optimized_model": "CLIP_ORT_CACHE_OPTIMIZED",
+    "io_binding": "CLIP_ORT_IO_BINDING",
+}
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+EXECUTION_MODES = {
+    "sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+# Rejestr modeli: żądanie może wskazać model parametrem ?model=<id>[@wariant] lub nagłówkiem X-CLIP-Model.
+# Model domyślny jest ładowany na starcie i nigdy nie jest usuwany; pozostałe są ładowane przy pierwszym użyciu
+# i usuwane od najdawniej używanego po przekroczeniu limitu liczby modeli lub budżetu pamięci (0 = bez limitu).
+MAX_LOADED_MODELS = max(1, _env_int("CLIP_MAX_LOADED_MODELS", 2))
+MODEL_MEMORY_BUDGET_MB = max(0, _env_int("CLIP_MODEL_MEMORY_BUDGET_MB", 0))
+# Modele, które wolno załadować na żądanie (poza domyślnym i już wyeksportowanymi lokalnie); "*" = dowolny z huba
+ALLOWED_MODELS = [model_id.strip() for model_id in (os.environ.get("CLIP_ALLOWED_MODELS") or "").split(",") if model_id.strip()]
+
+# Profilowanie N kolejnych żądań od startu (0 = wyłączone); to samo można włączyć w trakcie przez POST /debug/profile
+PROFILE_DIR = pathlib.Path(os.environ.get("CLIP_PROFILE_DIR") or (SCRIPT_DIR / "profiles"))
+PROFILE_STARTUP_REQUESTS = max(0, _env_int("CLIP_PROFILE_REQUESTS", 0))
+PROFILE_STARTUP_MODE = (os.environ.get("CLIP_PROFILE_MODE") or "sample").strip().lower()
+
+# Wspólny proces inferencji: jeden model w pamięci dla wielu workerów HTTP (patrz run_inference_host).
+# Workery łączą się z nim przez multiprocessing.connection, a piksele przekazują przez pamięć współdzieloną.
+INFERENCE_HOST_ADDRESS = os.environ.get("CLIP_INFERENCE_HOST") or None  # np. "127.0.0.1:8009"
+# Klucz uwierzytelniania połączeń bez wartości domyślnej (stały klucz wpuściłby każdy lokalny proces):
+# --shared-inference losuje go przy każdym uruchomieniu, samodzielny host i jego workery muszą mieć wspólny CLIP_INFERENCE_AUTHKEY
+INFERENCE_HOST_AUTHKEY = os.environ["CLIP_INFERENCE_AUTHKEY"].encode("utf-8") if os.environ.get("CLIP_INFERENCE_AUTHKEY") else None
+INFERENCE_HOST_CONNECT_TIMEOUT_S = max(1.0, _env_float("CLIP_INFERENCE_HOST_TIMEOUT_S", 900.0))
+
+def _require_inference_authkey() -> bytes:
+    if INFERENCE_HOST_AUTHKEY is None:
+        raise RuntimeError("Brak CLIP_INFERENCE_AUTHKEY - ustaw ten sam losowy klucz dla procesu inferencji i workerów "
+                           "(albo uruchom serwer z --shared-inference, który wygeneruje go sam).")
+    return INFERENCE_HOST_AUTHKEY
+
+def _coerce_session_setting(name: str, value: Any) -> Any:
+    default = SESSION_SETTINGS_DEFAULTS[name]
+    if isinstance(default, bool):
+        if isinstance(value, str):
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        return bool(value)
+    if isinstance(default, int):
+        return max(0, int(value))
+    value = str(value).strip().lower()
+    allowed = {"graph_optimization": GRAPH_OPTIMIZATION_LEVELS, "execution_mode": EXECUTION_MODES,
+               "io_binding": ("auto", "on", "off")}[name]
+    if value not in allowed:
+        raise ValueError(f"dozwolone: {list(allowed)}")
+    return value
+
+def resolve_session_settings() -> Dict[str, Any]:
+    settings = dict(SESSION_SETTINGS_DEFAULTS)
+    sources: Dict[str, Tuple[str, Any]] = {}
+    if SESSION_CONFIG_FILE.is_file():
+        try:
+            with open(SESSION_CONFIG_FILE, "r", encoding="utf-8") as f:
+                for name, value in json.load(f).items():
+                    sources[name] = (str(SESSION_CONFIG_FILE), value)
+        except (OSError, ValueError) as e_config:
+            logger.warning(f"Nie udało się wczytać konfiguracji sesji z '{SESSION_CONFIG_FILE}': {e_config}. Pomijam plik.")
+    for name, env_name in SESSION_SETTINGS_ENV.items():
+        if os.environ.get(env_name):
+            sources[name] = (env_name, os.environ[env_name])
+    for name, (source, value) in sources.items():
+        if name not in settings:
+            logger.warning(f"Nieznane ustawienie sesji '{name}' w {source}. Pomijam.")
+            continue
+        try:
+            settings[name] = _coerce_session_setting(name, value)
+        except (TypeError, ValueError) as e_value:
+            logger.warning(f"Niepoprawna wartość '{value}' dla ustawienia sesji '{name}' ({source}): {e_value}. Używam domyślnej.")
+
+    # Przy kilku workerach uvicorn każdy proces ma własną sesję - rdzenie dzielimy, zamiast pozwolić każdej
+    # sesji zająć wszystkie (nadsubskrypcja). WEB_CONCURRENCY to zmienna, z której uvicorn czyta --workers.
+    if settings["workers"] <= 0:
+        settings["workers"] = max(1, _env_int("WEB_CONCURRENCY", 1))
+    cpu_count = os.cpu_count() or 1
+    if settings["intra_op_threads"] <= 0:
+        settings["intra_op_threads"] = max(1, cpu_count // (settings["workers"] * INFERENCE_THREADS))
+    if settings["inter_op_threads"] <= 0:
+        settings["inter_op_threads"] = 2 if settings["execution_mode"] == "parallel" else 1
+    settings["cpu_count"] = cpu_count
+    return settings
+# --- Koniec Konfiguracji Serwera ---
+
+_decode_pool: Optional[ThreadPoolExecutor] = None
+
+def get_decode_pool() -> ThreadPoolExecutor:
+    # Dekodowanie PIL i operacje numpy zwalniają GIL, więc pula wątków wystarcza
+    global _decode_pool
+    if _decode_pool is None:
+        _decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="clip-decode")
+    return _decode_pool
+
+# --- Metryki (format tekstowy Prometheus) i profilowanie ---
+# Każdy worker uvicorn ma własny rejestr - przy --workers N /metrics pokazuje stan workera, który obsłużył scrape.
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384)
+PROMETHEUS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _escape_label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class MetricsRegistry:
+    # Liczniki, gauge i histogramy z etykietami bez zewnętrznych zależności; bezpieczne dla wątków pul.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._descriptions: Dict[str, Tuple[str, str, Optional[Tuple[float, ...]]]] = {}
+        self._values: Dict[str, Dict[Tuple[Tuple[str, str], ...], Any]] = {}
+
+    def describe(self, name: str, metric_type: str, help_text: str, buckets: Optional[Tuple[float, ...]] = None):
+        self._descriptions[name] = (metric_type, help_text, buckets)
+        self._values.setdefault(name, {})
+
+    @staticmethod
+    def _label_key(labels: Optional[Dict[str, Any]]) -> Tuple[Tuple[str, str], ...]:
+        return tuple(sorted((key, str(value)) for key, value in labels.items())) if labels else ()
+
+    def inc(self, name: str, labels: Optional[Dict[str, Any]] = None, value: float = 1.0):
+        key = self._label_key(labels)
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, labels: Optional[Dict[str, Any]] = None):
+        key = self._label_key(labels)
+        with self._lock:
+            self._values[name][key] = float(value)
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, Any]] = None):
+        buckets = self._descriptions[name][2]
+        key = self._label_key(labels)
+        position = bisect.bisect_left(buckets, value)
+        with self._lock:
+            histogram = self._values[name].get(key)
+            if histogram is None:
+                histogram = self._values[name][key] = [[0] * len(buckets), 0.0, 0]
+            if position < len(buckets):
+                histogram[0][position] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def clear(self, name: str):
+        with self._lock:
+            self._values[name].clear()
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for name, (metric_type, help_text, buckets) in self._descriptions.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for key, value in self._values[name].items():
+                    label_text = ",".join(f'{label}="{_escape_label_value(label_value)}"' for label, label_value in key)
+                    if metric_type != "histogram":
+                        lines.append(f"{name}{{{label_text}}} {value:.17g}" if label_text else f"{name} {value:.17g}")
+                        continue
+                    prefix = f"{label_text}," if label_text else ""
+                    cumulative = 0
+                    for bound, count in zip(buckets, value[0]):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {value[2]}')
+                    suffix = f"{{{label_text}}}" if label_text else ""
+                    lines.append(f"{name}_sum{suffix} {value[1]:.17g}")
+                    lines.append(f"{name}_count{suffix} {value[2]}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("clip_requests_total", "counter", "Obsłużone żądania HTTP.")
+metrics.describe("clip_requests_in_flight", "gauge", "Żądania HTTP w trakcie obsługi.")
+metrics.describe("clip_request_duration_seconds", "histogram", "Czas obsługi żądania HTTP.", METRICS_LATENCY_BUCKETS)
+metrics.describe("clip_request_items", "histogram", "Liczba elementów (obrazów/tekstów/plików) w żądaniu.", METRICS_SIZE_BUCKETS)
+metrics.describe("clip_stage_duration_seconds", "histogram", "Czas etapów potoku (read, decode, preprocess, tokenize, queue, inference, serialize).", METRICS_LATENCY_BUCKETS)
+metrics.describe("clip_inference_batch_size", "histogram", "Wiersze w jednym wywołaniu modelu.", METRICS_SIZE_BUCKETS)
+metrics.describe("clip_inference_in_flight", "gauge", "Wywołania modelu w trakcie wykonania.")
+metrics.describe("clip_microbatch_size", "histogram", "Rozmiar partii złożonych przez mikro-batcher.", METRICS_SIZE_BUCKETS)
+metrics.describe("clip_microbatch_queue_depth", "gauge", "Elementy czekające w kolejce mikro-batchera.")
+metrics.describe("clip_microbatch_items_total", "counter", "Elementy przetworzone przez mikro-batcher (wg wyniku).")
+metrics.describe("clip_embedding_cache_total", "counter", "Zdarzenia cache embeddingów (trafienia, braki, wstawienia, usunięcia).")
+metrics.describe("clip_embedding_cache_memory_items", "gauge", "Wpisy cache embeddingów w pamięci.")
+metrics.describe("clip_text_cache_total", "counter", "Zdarzenia cache embeddingów tekstu (trafienia, braki, wstawienia).")
+metrics.describe("clip_text_cache_memory_items", "gauge", "Wpisy cache embeddingów tekstu w pamięci.")
+metrics.describe("clip_upload_bytes", "histogram", "Rozmiar żądań wsadowego uploadu obrazów.",
+                 (65536, 1 << 20, 4 << 20, 16 << 20, 64 << 20, 256 << 20, 1 << 30))
+metrics.describe("clip_skipped_items_total", "counter", "Elementy partii pominięte przez błąd wejścia (brak pliku, uszkodzony obraz...).")
+metrics.describe("clip_lane_active", "gauge", "Żądania wykonywane w danym pasie priorytetu.")
+metrics.describe("clip_lane_queue_depth", "gauge", "Żądania czekające na miejsce w danym pasie priorytetu.")
+metrics.describe("clip_lane_admitted_total", "counter", "Żądania przyjęte do pasa priorytetu.")
+metrics.describe("clip_lane_rejected_total", "counter", "Żądania odrzucone (429) przez pełną kolejkę pasa.")
+metrics.describe("clip_lane_cancelled_total", "counter", "Żądania przerwane po rozłączeniu klienta.")
+metrics.describe("clip_inference_gate_waiting", "gauge", "Wywołania ONNX czekające na wolny slot inferencji.")
+metrics.describe("clip_model_info", "gauge", "Załadowane modele i ich provider ONNX (wartość zawsze 1).")
+metrics.describe("clip_model_requests_total", "counter", "Żądania obsłużone przez dany model.")
+metrics.describe("clip_model_memory_bytes", "gauge", "Szacowana pamięć sesji modelu (rozmiar plików modelu).")
+metrics.describe("clip_models_loaded", "gauge", "Liczba załadowanych modeli.")
+metrics.describe("clip_model_loads_total", "counter", "Ładowania modeli na żądanie.")
+metrics.describe("clip_model_evictions_total", "counter", "Modele usunięte z pamięci (LRU lub ręcznie).")
+metrics.describe("clip_embedder_ready", "gauge", "1, gdy embedder jest gotowy do inferencji.")
+metrics.describe("clip_startup_seconds", "gauge", "Czas faz startu serwera i embeddera.")
+metrics.describe("clip_profiling_active", "gauge", "1, gdy trwa profilowanie żądań.")
+
+class RequestTimings:
+    # Suma czasów etapów jednego żądania (także z wątków pul - patrz _in_request_context)
+    __slots__ = ("stages", "_lock")
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self, total_s: float) -> str:
+        with self._lock:
+            entries = [f"{stage};dur={seconds * 1000.0:.2f}" for stage, seconds in self.stages.items()]
+        return ", ".join(entries + [f"total;dur={total_s * 1000.0:.2f}"])
+
+_request_timings: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar("clip_request_timings", default=None)
+
+def record_stage(stage: str, seconds: float):
+    metrics.observe("clip_stage_duration_seconds", seconds, {"stage": stage})
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+@contextlib.contextmanager
+def stage_timer(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+class ProfilingSession:
+    # Profil N kolejnych żądań (bez /metrics i /debug/*):
+    #   sample   - wątek próbkujący stosy wszystkich wątków co interval_ms; plik .folded (flamegraph.pl, speedscope)
+    #   cprofile - cProfile pętli zdarzeń i wywołań w pulach wątków; plik .prof (pstats, snakeviz, gprof2dot)
+    # Bez aktywnej sesji koszt to jedno sprawdzenie zmiennej globalnej na żądanie i na zadanie w puli.
+    # Od Pythona 3.12 cProfile korzysta z sys.monitoring (jeden profiler na proces, wszystkie wątki), więc
+    # osobne profile per wątek są potrzebne tylko w starszych wersjach.
+    _PER_THREAD_CPROFILE = sys.version_info < (3, 12)
+    _IDLE_FILES = ("threading.py", "queue.py", "selectors.py", "thread.py")
+
+    def __init__(self, requests: int, mode: str = "sample", interval_ms: float = 5.0, directory: Optional[pathlib.Path] = None):
+        if mode not in ("sample", "cprofile"):
+            raise ValueError(f"Nieznany tryb profilowania '{mode}'. Dozwolone: sample, cprofile")
+        self.requests = requests
+        self.mode = mode
+        self.interval_s = max(0.0005, interval_ms / 1000.0)
+        self.directory = directory or PROFILE_DIR
+        self.completed_requests = 0
+        self.samples = 0
+        self.started_at = time.time()
+        self.output_path: Optional[str] = None
+        self._lock = threading.Lock()
+        self._stacks: Dict[str, int] = {}
+        self._stop_event = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._loop_profile: Optional[cProfile.Profile] = None
+        self._thread_stats: Optional[pstats.Stats] = None
+        self._thread_state = threading.local()
+
+    def start(self):
+        if self.mode == "sample":
+            self._sampler = threading.Thread(target=self._sample_loop, name="clip-profiler", daemon=True)
+            self._sampler.start()
+        else:
+            # Wywoływane w wątku pętli zdarzeń - tam działa kod async endpointów
+            self._loop_profile = cProfile.Profile()
+            self._loop_profile.enable()
+        logger.info(f"Profilowanie ({self.mode}) następnych {self.requests} żądań...")
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        thread_names = {}
+        while not self._stop_event.wait(self.interval_s):
+            frames = sys._current_frames()
+            if len(thread_names) != len(frames):
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            collected = []
+            for thread_id, frame in frames.items():
+                if thread_id == own_id or os.path.basename(frame.f_code.co_filename) in self._IDLE_FILES:
+                    continue # Bezczynne wątki (czekające na kolejkę/selektor) tylko zaciemniałyby wykres
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                collected.append(";".join(reversed(stack)))
+            with self._lock:
+                self.samples += 1
+                for folded in collected:
+                    self._stacks[folded] = self._stacks.get(folded, 0) + 1
+
+    def profile_call(self, func: Callable, *args) -> Any:
+        if self.mode != "cprofile" or not self._PER_THREAD_CPROFILE or getattr(self._thread_state, "active", False):
+            return func(*args)
+        profile = cProfile.Profile()
+        self._thread_state.active = True
+        profile.enable()
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            self._thread_state.active = False
+            with self._lock:
+                if self._thread_stats is None:
+                    self._thread_stats = pstats.Stats(profile)
+                else:
+                    self._thread_stats.add(profile)
+
+    def request_finished(self) -> bool:
+        with self._lock:
+            self.completed_requests += 1
+            return self.completed_requests >= self.requests
+
+    def stop(self) -> str:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        if self.mode == "sample":
+            self._stop_event.set()
+            if self._sampler is not None:
+                self._sampler.join(timeout=5)
+            output_path = self.directory / f"profile_{timestamp}_{os.getpid()}.folded"
+            with self._lock:
+                lines = [f"{stack} {count}" for stack, count in sorted(self._stacks.items())]
+            output_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        else:
+            self._loop_profile.disable()
+            output_path = self.directory / f"profile_{timestamp}_{os.getpid()}.prof"
+            with self._lock:
+                stats = pstats.Stats(self._loop_profile)
+                if self._thread_stats is not None:
+                    stats.add(self._thread_stats)
+            stats.dump_stats(str(output_path))
+        self.output_path = str(output_path)
+        logger.info(f"Profil {self.completed_requests} żądań zapisany do {output_path}")
+        return self.output_path
+
+    def describe(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "requests": self.requests, "completed_requests": self.completed_requests,
+                "interval_ms": self.interval_s * 1000.0, "samples": self.samples, "started_at": self.started_at,
+                "active": self.output_path is None, "output_path": self.output_path}
+
+profiling_session: Optional[ProfilingSession] = None
+last_profiling_session: Optional[ProfilingSession] = None
+
+def _call_profiled(func: Callable, *args) -> Any:
+    session = profiling_session
+    if session is None:
+        return func(*args)
+    return session.profile_call(func, *args)
+
+def _in_request_context(func: Callable, *args) -> Callable[[], Any]:
+    # Wątki pul nie dziedziczą contextvars - przenosi czasy etapów bieżącego żądania do wątku wykonującego func
+    return functools.partial(contextvars.copy_context().run, _call_profiled, func, *args)
+
+# --- Priorytety żądań i przerywanie porzuconej pracy ---
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+
+class ClientDisconnected(HTTPException):
+    # Klient zamknął połączenie - praca jest przerywana (kod 499 jak w nginx; odpowiedzi i tak nikt nie odbierze)
+    def __init__(self):
+        super().__init__(status_code=499, detail="Klient rozłączył się - przetwarzanie przerwane.")
+
+class LaneTicket:
+    # Bilet przyjętego żądania: pas priorytetu + flaga przerwania. Trafia do contextvar, więc widzą go także
+    # wątki pul (_in_request_context) - pętle porcji i bramka inferencji sprawdzają flagę między wywołaniami ONNX.
+    def __init__(self, lane: str):
+        self.lane = lane
+        self.cancelled = threading.Event()
+        self._cancelled_event: Optional[asyncio.Event] = None
+        self._watcher: Optional[asyncio.Task] = None
+
+    def cancel(self):
+        # Wywoływane z pętli zdarzeń
+        self.cancelled.set()
+        if self._cancelled_event is not None:
+            self._cancelled_event.set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled.is_set():
+            raise ClientDisconnected()
+
+    def watch(self, request: Request):
+        # Tylko po odczytaniu treści żądania - wcześniej receive() zwracałby kolejne fragmenty body
+        if self._watcher is None:
+            self._watcher = asyncio.get_running_loop().create_task(self._watch_disconnect(request))
+
+    def stop_watching(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    async def _watch_disconnect(self, request: Request):
+        while not self.cancelled.is_set():
+            if await request.is_disconnected():
+                logger.info(f"Klient rozłączył się w trakcie {request.method} {request.url.path} (pas '{self.lane}') - przerywam przetwarzanie.")
+                self.cancel()
+                return
+            await asyncio.sleep(DISCONNECT_POLL_MS / 1000.0)
+
+    async def guard(self, future: asyncio.Future) -> Any:
+        # Czeka na future albo na rozłączenie klienta; przy rozłączeniu future jest anulowany (np. element mikro-batchera)
+        if self._cancelled_event is None:
+            self._cancelled_event = asyncio.Event()
+            if self.cancelled.is_set():
+                self._cancelled_event.set()
+        cancelled_waiter = asyncio.ensure_future(self._cancelled_event.wait())
+        try:
+            await asyncio.wait((future, cancelled_waiter), return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        finally:
+            cancelled_waiter.cancel()
+        if not future.done():
+            future.cancel()
+            raise ClientDisconnected()
+        return future.result()
+
+_request_ticket: contextvars.ContextVar[Optional[LaneTicket]] = contextvars.ContextVar("clip_request_ticket", default=None)
+
+def raise_if_request_cancelled():
+    ticket = _request_ticket.get()
+    if ticket is not None:
+        ticket.raise_if_cancelled()
+
+class PriorityLane:
+    # Ograniczona współbieżność + ograniczona kolejka FIFO. Zwolnione miejsce przechodzi wprost na najstarszego
+    # czekającego, więc nowe żądania nie wyprzedzają kolejki. Działa w pętli zdarzeń (bez blokad).
+    def __init__(self, name: str, max_concurrent: int, max_queue: int):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.avg_service_s = 0.0
+        # Statystyki
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.cancelled_total = 0
+
+    def retry_after_s(self) -> int:
+        # Szacunek: czas obsłużenia kolejki przy średnim czasie żądania w tym pasie
+        return max(1, int(np.ceil((len(self._waiters) + 1) * max(self.avg_service_s, 0.1) / self.max_concurrent)))
+
+    def check_capacity(self):
+        # 429, jeśli acquire() odrzuciłby teraz żądanie (bez zajmowania miejsca)
+        if (self.active >= self.max_concurrent or self._waiters) and len(self._waiters) >= self.max_queue:
+            self.rejected_total += 1
+            raise HTTPException(status_code=429, headers={"Retry-After": str(self.retry_after_s())},
+                                detail=f"Kolejka pasa '{self.name}' jest pełna ({len(self._waiters)} oczekujących). Spróbuj ponownie później.")
+
+    async def acquire(self):
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+        else:
+            self.check_capacity()
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release_slot() # Miejsce zostało już przekazane - oddaj je kolejnemu
+                else:
+                    with contextlib.suppress(ValueError):
+                        self._waiters.remove(waiter)
+                raise
+        self.admitted_total += 1
+
+    def release(self, service_s: float):
+        self.avg_service_s = service_s if not self.avg_service_s else 0.9 * self.avg_service_s + 0.1 * service_s
+        self._release_slot()
+
+    def _release_slot(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"max_concurrent": self.max_concurrent, "max_queue": self.max_queue, "active": self.active,
+                "queue_depth": len(self._waiters), "admitted_total": self.admitted_total, "rejected_total": self.rejected_total,
+                "cancelled_total": self.cancelled_total, "avg_service_ms": round(self.avg_service_s * 1000.0, 2)}
+
+priority_lanes: Dict[str, PriorityLane] = {
+    LANE_INTERACTIVE: PriorityLane(LANE_INTERACTIVE, INTERACTIVE_CONCURRENCY, INTERACTIVE_QUEUE),
+    LANE_BULK: PriorityLane(LANE_BULK, BULK_CONCURRENCY, BULK_QUEUE),
+}
+
+class InferenceGate:
+    # Sloty wywołań ONNX (CLIP_INFERENCE_THREADS) wspólne dla obu pasów: wywołanie masowe czeka, dopóki na slot
+    # czeka jakiekolwiek interaktywne. Wywłaszczenie następuje na granicy porcji (CLIP_INFERENCE_CHUNK_SIZE).
+    # Wywołania bez biletu (mikro-batcher, proces inferencji) traktowane są jako interaktywne.
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.busy = 0
+        self._condition = threading.Condition()
+        self.waiting: Dict[str, int] = {LANE_INTERACTIVE: 0, LANE_BULK: 0}
+
+    def resize(self, slots: int):
+        # startup_event ustawia liczbę slotów zgodnie z INFERENCE_THREADS z chwili startu (np. macierz benchmarku)
+        with self._condition:
+            self.slots = max(1, slots)
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        ticket = _request_ticket.get()
+        lane = ticket.lane if ticket is not None else LANE_INTERACTIVE
+        with self._condition:
+            self.waiting[lane] += 1
+            try:
+                while self.busy >= self.slots or (lane == LANE_BULK and self.waiting[LANE_INTERACTIVE]):
+                    if ticket is not None and ticket.cancelled.is_set():
+                        self._condition.notify_all() # Zwolnione miejsce w kolejce może odblokować wywołania masowe
+                        raise ClientDisconnected()
+                    self._condition.wait(timeout=DISCONNECT_POLL_MS / 1000.0)
+            finally:
+                self.waiting[lane] -= 1
+            self.busy += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.busy -= 1
+                self._condition.notify_all()
+
+inference_gate = InferenceGate(INFERENCE_THREADS)
+
+def _request_lane(request: Request, default_lane: str) -> str:
+    requested = (request.headers.get("x-clip-priority") or request.query_params.get("priority") or default_lane).strip().lower()
+    if requested not in priority_lanes:
+        raise HTTPException(status_code=400, detail=f"Nieznany priorytet '{requested}'. Dozwolone: {list(priority_lanes)}")
+    return requested
+
+@contextlib.asynccontextmanager
+async def admit_request(request: Request, default_lane: str, watch_disconnect: bool = True):
+    # Miejsce w pasie na czas obsługi żądania; bilet trafia do contextvar. Rozłączenie w kolejce też zwalnia miejsce.
+    ticket = LaneTicket(_request_lane(request, default_lane))
+    lane = priority_lanes[ticket.lane]
+    if watch_disconnect:
+        ticket.watch(request)
+    try:
+        await ticket.guard(asyncio.ensure_future(lane.acquire()))
+    except BaseException:
+        ticket.stop_watching()
+        if ticket.cancelled.is_set():
+            lane.cancelled_total += 1
+        raise
+    _request_ticket.set(ticket)
+    started = time.perf_counter()
+    try:
+        yield ticket
+    finally:
+        ticket.stop_watching()
+        if ticket.cancelled.is_set():
+            lane.cancelled_total += 1
+        lane.release(time.perf_counter() - started)
+
+async def interactive_lane(request: Request):
+    async with admit_request(request, LANE_INTERACTIVE) as ticket:
+        yield ticket
+
+async def bulk_lane(request: Request):
+    async with admit_request(request, LANE_BULK) as ticket:
+        yield ticket
+
+# --- Cache embeddingów (hash zawartości) ---
+def compute_content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+class EmbeddingCache:
+    # Dwa poziomy: gorący LRU w pamięci procesu + SQLite na dysku (WAL, współdzielony przez workery uvicorna).
+    # Klucz: (klucz modelu, hash zawartości obrazu) - zmiana nazwy/przeniesienie pliku nie unieważnia wpisu.
+    # Rozmiar na dysku ograniczony max_disk_bytes; usuwane są najdawniej używane wpisy.
+    # Czas ostatniego użycia trafień z dysku jest buforowany i zapisywany zbiorczo (jedna transakcja co
+    # ACCESS_FLUSH_ITEMS trafień / ACCESS_FLUSH_SECONDS, przed zapisem nowych wpisów i przy zamknięciu).
+    EVICTION_CHECK_INTERVAL = 1000
+    ACCESS_FLUSH_ITEMS = 256
+    ACCESS_FLUSH_SECONDS = 30.0
+
+    def __init__(self, db_path: pathlib.Path, memory_items: int = CACHE_MEMORY_ITEMS, max_disk_mb: int = CACHE_MAX_DISK_MB):
+        self.db_path = db_path
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_mb * 1024 * 1024
+        self._memory: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._inserts_since_eviction_check = 0
+        self._pending_access: Dict[Tuple[str, str], float] = {}
+        self._last_access_flush = time.monotonic()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.inserts = 0
+        self.evictions = 0
+
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(db_path), timeout=30.0, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model_key TEXT NOT NULL, content_hash TEXT NOT NULL, dim INTEGER NOT NULL, vector BLOB NOT NULL,"
+            " size_bytes INTEGER NOT NULL, last_access REAL NOT NULL, PRIMARY KEY (model_key, content_hash))")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)")
+        logger.info(f"Cache embeddingów: {db_path} (LRU w pamięci: {memory_items} wpisów, limit dysku: {max_disk_mb} MB)")
+
+    def get(self, model_key: str, content_hash: str) -> Optional[np.ndarray]:
+        key = (model_key, content_hash)
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+            row = self._connection.execute(
+                "SELECT dim, vector FROM embeddings WHERE model_key = ? AND content_hash = ?", key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._pending_access[key] = time.time()
+            if len(self._pending_access) >= self.ACCESS_FLUSH_ITEMS or time.monotonic() - self._last_access_flush >= self.ACCESS_FLUSH_SECONDS:
+                self._flush_access_times()
+            self.disk_hits += 1
+            embedding = np.frombuffer(row[1], dtype="<f4", count=row[0]).astype(np.float32)
+            self._remember(key, embedding)
+            return embedding
+
+    def put_many(self, model_key: str, content_hashes: List[str], embeddings: np.ndarray):
+        if not content_hashes:
+            return
+        now = time.time()
+        rows = []
+        with self._lock:
+            self._flush_access_times() # Przed wstawieniem: starszy czas z bufora nie nadpisze świeżego last_access
+            for content_hash, embedding in zip(content_hashes, embeddings):
+                vector = np.ascontiguousarray(embedding, dtype="<f4")
+                self._remember((model_key, content_hash), vector.astype(np.float32))
+                rows.append((model_key, content_hash, vector.shape[0], vector.tobytes(), vector.nbytes, now))
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model_key, content_hash, dim, vector, size_bytes, last_access) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.inserts += len(rows)
+            self._inserts_since_eviction_check += len(rows)
+            if self._inserts_since_eviction_check >= self.EVICTION_CHECK_INTERVAL:
+                self._inserts_since_eviction_check = 0
+                self._enforce_disk_limit()
+
+    def _remember(self, key: Tuple[str, str], embedding: np.ndarray):
+        if self.memory_items <= 0:
+            return
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _flush_access_times(self):
+        # Wywoływane pod self._lock
+        self._last_access_flush = time.monotonic()
+        if not self._pending_access:
+            return
+        rows = [(accessed_at, *key) for key, accessed_at in self._pending_access.items()]
+        self._pending_access.clear()
+        self._connection.execute("BEGIN")
+        try:
+            self._connection.executemany("UPDATE embeddings SET last_access = ? WHERE model_key = ? AND content_hash = ?", rows)
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def _enforce_disk_limit(self):
+        total_bytes, total_rows = self._connection.execute("SELECT COALESCE(SUM(size_bytes), 0), COUNT(*) FROM embeddings").fetchone()
+        if total_bytes <= self.max_disk_bytes or total_rows == 0:
+            return
+        # Usuń z zapasem 10%, żeby nie sprawdzać limitu przy każdej kolejnej partii
+        excess_bytes = total_bytes - int(self.max_disk_bytes * 0.9)
+        rows_to_delete = min(total_rows, int(excess_bytes / (total_bytes / total_rows)) + 1)
+        self._connection.execute(
+            "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_access LIMIT ?)", (rows_to_delete,))
+        self.evictions += rows_to_delete
+        logger.info(f"Cache embeddingów: usunięto {rows_to_delete} najdawniej używanych wpisów (rozmiar {total_bytes / 1048576:.1f} MB > limit).")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": ((self.memory_hits + self.disk_hits) / lookups) if lookups else 0.0,
+                "inserts": self.inserts,
+                "evictions": self.evictions,
+                "memory_items": len(self._memory),
+                "db_path": str(self.db_path),
+            }
+
+    def close(self):
+        with self._lock:
+            try:
+                self._flush_access_times()
+            except sqlite3.Error as e:
+                logger.warning(f"Cache embeddingów: nie zapisano czasów użycia przy zamykaniu: {e}")
+            self._connection.close()
+
+def normalize_prompt(text: str) -> str:
+    # Tokenizer CLIP i tak sprowadza tekst do małych liter i pojedynczych spacji - takie prompty dają ten sam wektor
+    return " ".join(text.split()).lower()
+
+class TextEmbeddingCache:
+    # LRU w pamięci dla embeddingów tekstu, klucz: (klucz modelu, znormalizowany prompt).
+    # Opcjonalnie zapisuje wektory do EmbeddingCache (SQLite) pod hashem promptu z prefiksem "text:".
+    def __init__(self, memory_items: int = TEXT_CACHE_ITEMS, backing_cache: Optional[EmbeddingCache] = None):
+        self.memory_items = memory_items
+        self.backing_cache = backing_cache
+        self._memory: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.inserts = 0
+
+    @staticmethod
+    def _backing_key(prompt: str) -> str:
+        return "text:" + compute_content_hash(prompt.encode("utf-8"))
+
+    def get_many(self, model_key: str, prompts: List[str], memory_only: bool = False) -> List[Optional[np.ndarray]]:
+        # memory_only: tylko LRU, bez SQLite (wywołanie z pętli zdarzeń); chybienie nie jest liczone - policzy je
+        # właściwe wyszukiwanie w puli wątków
+        results: List[Optional[np.ndarray]] = []
+        with self._lock:
+            for prompt in prompts:
+                embedding = self._memory.get((model_key, prompt))
+                if embedding is not None:
+                    self._memory.move_to_end((model_key, prompt))
+                    self.memory_hits += 1
+                results.append(embedding)
+        if memory_only:
+            return results
+        if self.backing_cache is not None:
+            for position, prompt in enumerate(prompts):
+                if results[position] is None:
+                    results[position] = self.backing_cache.get(model_key, self._backing_key(prompt))
+                    if results[position] is not None:
+                        with self._lock:
+                            self.disk_hits += 1
+                            self._remember((model_key, prompt), results[position])
+        with self._lock:
+            self.misses += sum(1 for embedding in results if embedding is None)
+        return results
+
+    def put_many(self, model_key: str, prompts: List[str], embeddings: np.ndarray):
+        with self._lock:
+            for prompt, embedding in zip(prompts, embeddings):
+                self._remember((model_key, prompt), np.asarray(embedding, dtype=np.float32))
+            self.inserts += len(prompts)
+        if self.backing_cache is not None and prompts:
+            self.backing_cache.put_many(model_key, [self._backing_key(prompt) for prompt in prompts], embeddings)
+
+    def _remember(self, key: Tuple[str, str], embedding: np.ndarray):
+        if self.memory_items <= 0:
+            return
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": ((self.memory_hits + self.disk_hits) / lookups) if lookups else 0.0,
+                "inserts": self.inserts,
+                "memory_items": len(self._memory),
+                "persistent": self.backing_cache is not None,
+            }
+
+class _PreparedImage:
+    # Wynik etapu dekodowania: albo embedding z cache, albo piksele do inferencji
+    # (w trybie wycinków: piksele wszystkich wycinków (N, 3, H, W) i ich prostokąty w pikselach oryginału)
+    __slots__ = ("content_hash", "embedding", "pixel_values", "boxes")
+
+    def __init__(self, content_hash: Optional[str], embedding: Optional[np.ndarray] = None, pixel_values: Optional[np.ndarray] = None,
+                 boxes: Optional[List[Tuple[int, int, int, int]]] = None):
+        self.content_hash = content_hash
+        self.embedding = embedding
+        self.pixel_values = pixel_values
+        self.boxes = boxes
+
+def _window_positions(length: int, window: int, overlap: float) -> List[int]:
+    # Równomiernie rozłożone początki okien pokrywające cały odcinek (pierwsze przy 0, ostatnie przy krawędzi)
+    if window >= length:
+        return [0]
+    count = int(np.ceil((length - window) / (window * (1.0 - overlap)))) + 1
+    return sorted(set(int(round(position)) for position in np.linspace(0, length - window, count)))
+
+class CropSpecError(ValueError):
+    # Nieprawidłowe parametry wycinków (także przekroczony limit dla danego obrazu) - błąd żądania, nie obrazu
+    pass
+
+class CropSpec:
+    # Zestaw wycinków dla zdjęć grupowych, w których środkowy kadr procesora CLIP gubi postacie przy krawędziach.
+    # auto: kwadratowe okna o boku scale x krótszy bok w każdej skali, z zakładką, pokrywające cały obraz;
+    # grid: siatka rows x cols (kafelek niekwadratowy procesor przycina do środka, jak cały obraz).
+    # Pierwszym wycinkiem jest domyślnie środkowy kadr - ten sam, który daje zwykły embedding obrazu.
+    def __init__(self, mode: str = "auto", scales: Tuple[float, ...] = (1.0, 0.5), grid: Tuple[int, int] = (2, 2),
+                 overlap: float = 0.25, include_center: bool = True):
+        self.mode = mode
+        self.scales = scales
+        self.grid = grid
+        self.overlap = overlap
+        self.include_center = include_center
+
+    @classmethod
+    def parse(cls, mode: str, scales: Optional[str] = None, grid: Optional[str] = None, overlap: Optional[str] = None,
+              include_center: Optional[str] = None) -> "CropSpec":
+        mode = mode.strip().lower()
+        if mode not in ("auto", "grid"):
+            raise CropSpecError(f"nieznany tryb '{mode}' (dozwolone: auto, grid)")
+        spec = cls(mode)
+        if scales:
+            try:
+                spec.scales = tuple(sorted({float(scale) for scale in scales.split(",") if scale.strip()}, reverse=True))
+            except ValueError:
+                raise CropSpecError(f"nieprawidłowe skale '{scales}' (np. scales=1,0.5)")
+            if not spec.scales or any(not 0.05 <= scale <= 1.0 for scale in spec.scales):
+                raise CropSpecError("skale muszą być z przedziału [0.05, 1]")
+        if grid:
+            rows, _, cols = grid.lower().partition("x")
+            try:
+                spec.grid = (int(rows), int(cols or rows))
+            except ValueError:
+                raise CropSpecError(f"nieprawidłowa siatka '{grid}' (np. grid=2x3)")
+            if not all(1 <= count <= 16 for count in spec.grid):
+                raise CropSpecError("siatka musi mieć od 1 do 16 wierszy i kolumn (np. grid=2x3)")
+        if overlap is not None:
+            try:
+                spec.overlap = float(overlap)
+            except ValueError:
+                raise CropSpecError(f"nieprawidłowa zakładka '{overlap}'")
+            if not 0.0 <= spec.overlap < 0.9:
+                raise CropSpecError("zakładka musi być z przedziału [0, 0.9)")
+        if include_center is not None:
+            spec.include_center = include_center.strip().lower() in ("1", "true", "yes")
+        return spec
+
+    def boxes(self, width: int, height: int) -> List[Tuple[int, int, int, int]]:
+        # Prostokąty (left, top, right, bottom) w pikselach obrazu, bez powtórzeń, środkowy kadr pierwszy
+        boxes: List[Tuple[int, int, int, int]] = []
+        if self.include_center:
+            side = min(width, height)
+            left, top = (width - side) // 2, (height - side) // 2
+            boxes.append((left, top, left + side, top + side))
+        if self.mode == "grid":
+            rows, cols = self.grid
+            tile_width, tile_height = width / cols, height / rows
+            margin_x, margin_y = tile_width * self.overlap / 2.0, tile_height * self.overlap / 2.0
+            for row in range(rows):
+                for col in range(cols):
+                    boxes.append((max(0, int(round(col * tile_width - margin_x))), max(0, int(round(row * tile_height - margin_y))),
+                                  min(width, int(round((col + 1) * tile_width + margin_x))), min(height, int(round((row + 1) * tile_height + margin_y)))))
+        else:
+            for scale in self.scales:
+                side = max(1, int(round(scale * min(width, height))))
+                for top in _window_positions(height, side, self.overlap):
+                    for left in _window_positions(width, side, self.overlap):
+                        boxes.append((left, top, left + side, top + side))
+        boxes = list(dict.fromkeys(box for box in boxes if box[2] > box[0] and box[3] > box[1]))
+        if len(boxes) > CROP_MAX_PER_IMAGE:
+            raise CropSpecError(f"Obraz {width}x{height} daje {len(boxes)} wycinków, limit to {CROP_MAX_PER_IMAGE} (CLIP_MAX_CROPS).")
+        return boxes
+
+    def describe(self) -> Dict[str, Any]:
+        description: Dict[str, Any] = {"mode": self.mode, "overlap": self.overlap, "include_center": self.include_center}
+        if self.mode == "grid":
+            description["grid"] = f"{self.grid[0]}x{self.grid[1]}"
+        else:
+            description["scales"] = list(self.scales)
+        return description
+
+class CropEmbeddings:
+    # Wynik trybu wycinków dla jednego obrazu: wektor każdego wycinka + wektor zbiorczy
+    # (znormalizowana średnia znormalizowanych wektorów wycinków)
+    __slots__ = ("boxes", "embeddings", "pooled")
+
+    def __init__(self, boxes: List[Tuple[int, int, int, int]], embeddings: np.ndarray):
+        self.boxes = boxes
+        self.embeddings = embeddings
+        self.pooled = normalize_rows(normalize_rows(embeddings).mean(axis=0, keepdims=True))[0]
+
 class CLIPImageEmbedder:
-    def __init__(self, model_id: str = "laion/CLIP-ViT-H-14-laion2B-s32B-b79K", device: str = "cuda"):
-        logger.info(f"Inicjalizacja CLIPImageEmbedder z modelem '{model_id}' na '{device}'...")
+    def __init__(self, model_id: str = DEFAULT_MODEL_ID, device: str = DEFAULT_DEVICE,
+                 embedding_cache: Optional[EmbeddingCache] = None, model_variant: Optional[str] = None,
+                 inference_host: Optional[str] = None, text_cache: Optional[TextEmbeddingCache] = None):
+        model_variant = (model_variant or MODEL_VARIANT).lower()
+        if model_variant not in MODEL_VARIANTS:
+            raise ValueError(f"Nieznany wariant modelu '{model_variant}'. Dostępne: {list(MODEL_VARIANTS)}")
+        logger.info(f"Inicjalizacja CLIPImageEmbedder z modelem '{model_id}' (wariant {model_variant}) na '{device}'...")
         self.model_id = model_id
+        self.model_variant = model_variant
+        self.model_file_name = MODEL_VARIANTS[model_variant][0]
+        self.embedding_cache = embedding_cache
+        self.text_cache = text_cache
+        # Klucz modelu w cache embeddingów - warianty dają różne wektory, więc nie mogą dzielić wpisów
+        self.cache_model_key = model_id if model_variant == "fp32" else f"{model_id}@{model_variant}"
         self.requested_device = device
         self.effective_device = "cpu"
         self.processor = None
-        self.model_ort_instance = None
         self.ort_session = None
+        self.inference_client: Optional[InferenceHostClient] = None
+        self.startup_timings: Dict[str, float] = {}
         self.output_names = None
+        self.model_input_names: List[str] = []
+        self.image_output_name: Optional[str] = None
+        self.text_output_name: Optional[str] = None
+        # Gotowe tensory zastępcze dla nieużywanej wieży modelu (klucz: rozmiar partii)
+        self._dummy_text_inputs_cache: Dict[int, Dict[str, np.ndarray]] = {}
+        self._dummy_pixel_values_cache: Dict[int, np.ndarray] = {}
+        self._text_and_image_batch_shared = False
+        self._dummy_pixel_size: Tuple[int, int] = (224, 224)
+        self.session_settings = resolve_session_settings()
+        self.use_io_binding = False
+        self.io_binding_device = "cpu"
+        self.optimized_model_file_name: Optional[str] = None
+
+        phase_started = time.perf_counter()
+
+        if inference_host:
+            self._init_remote_inference(inference_host)
+            return
 
-        safe_model_id_for_path = model_id.replace("/", "_--_")
-        self.specific_local_model_path = LOCAL_MODELS_ROOT_DIR / safe_model_id_for_path
+        self.specific_local_model_path = self._local_model_path(model_id)
         logger.info(f"Lokalna ścieżka modelu: {self.specific_local_model_path}")
 
         # Plik znacznika wskazujący na pomyślny eksport ONNX do self.specific_local_model_path
         onnx_export_success_marker = self.specific_local_model_path / "_SUCCESSFUL_ONNX_EXPORT"
+        export_ready = onnx_export_success_marker.exists()
+        if export_ready:
+            # Gotowy eksport: wszystko jest lokalnie, więc żadnych zapytań do huba (także z wnętrza transformers)
+            os.environ.setdefault("HF_HUB_OFFLINE", "1")
 
         # --- Krok 1: Pobierz pliki źródłowe modelu (np. PyTorch), jeśli folder modelu nie istnieje lub jest pusty ---
-        if not self.specific_local_model_path.exists() or not any(self.specific_local_model_path.iterdir()):
+        if export_ready:
+            logger.info(f"Znacznik '{onnx_export_success_marker.name}' istnieje - pomijam sprawdzanie/pobieranie repo.")
+        elif not self.specific_local_model_path.exists() or not any(self.specific_local_model_path.iterdir()):
             logger.info(f"Folder '{self.specific_local_model_path}' pusty/nie istnieje. Pobieranie repo '{model_id}'...")
             try:
+                from huggingface_hub import snapshot_download
                 snapshot_download(repo_id=model_id, local_dir=self.specific_local_model_path, local_dir_use_symlinks=False)
                 logger.info(f"Repo '{model_id}' pobrane do '{self.specific_local_model_path}'.")
             except Exception as e:
@@ -82,22 +1157,16 @@ class CLIPImageEmbedder:
         else:
             logger.info(f"Folder '{self.specific_local_model_path}' istnieje.")
 
+        phase_started = self._record_startup_phase("download", phase_started)
+
         # --- Krok 2: Załaduj Procesor ---
-        try:
-            self.processor = AutoProcessor.from_pretrained(self.specific_local_model_path, local_files_only=True)
-            logger.info(f"Procesor dla '{model_id}' załadowany z '{self.specific_local_model_path}'.")
-        except Exception:
-            logger.warning(f"Nie udało się załadować procesora lokalnie z '{self.specific_local_model_path}'. Próba z huba '{model_id}'.")
-            try:
-                self.processor = AutoProcessor.from_pretrained(model_id) # Fallback
-                logger.info(f"Procesor dla '{model_id}' załadowany z huba (fallback).")
-            except Exception as e_hub_proc:
-                logger.error(f"Krytyczny błąd ładowania procesora dla '{model_id}': {e_hub_proc}", exc_info=True)
-                raise
+        self._load_processor(allow_hub_fallback=not export_ready)
+        phase_started = self._record_startup_phase("processor", phase_started)
 
         # --- Krok 3: Sprawdź znacznik. Jeśli go nie ma, przeprowadź zsynchronizowany eksport ONNX ---
         if not onnx_export_success_marker.exists():
             logger.info(f"Znacznik udanego eksportu ONNX ('{onnx_export_success_marker.name}') nie znaleziony.")
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
             acquired_lock = False
             lock_fd = -1 # Inicjalizacja deskryptora pliku
             try:
@@ -176,6 +1245,13 @@ class CLIPImageEmbedder:
         else:
             logger.info(f"Znacznik '{onnx_export_success_marker.name}' już istnieje. Zakładam, że model ONNX jest gotowy w '{self.specific_local_model_path}'.")
 
+        phase_started = self._record_startup_phase("export", phase_started)
+
+        # --- Krok 3b: Wygeneruj wybrany wariant (int8/fp16) z eksportu fp32, jeśli jeszcze go nie ma ---
+        if self.model_variant != "fp32":
+            self._ensure_model_variant()
+            phase_started = self._record_startup_phase("variant", phase_started)
+
         # --- Krok 4: Załaduj model ONNX z lokalnej ścieżki ---
         # Provider powinien być już ustalony przez proces eksportujący lub przez _determine_onnx_provider
         final_provider = self._determine_onnx_provider(onnxruntime.get_available_providers())
@@ -183,13 +1259,7 @@ class CLIPImageEmbedder:
         self.active_provider = final_provider 
         logger.info(f"Ładowanie finalnego modelu ONNX z '{self.specific_local_model_path}' providerem '{final_provider}'...")
         try:
-            self.model_ort_instance = ORTModelForFeatureExtraction.from_pretrained(
-                self.specific_local_model_path,
-                provider=final_provider,
-                local_files_only=True,
-                use_io_binding=False
-            )
-            self.ort_session = self.model_ort_instance.model
+            self.ort_session = self._load_session(final_provider)
             self.output_names = [output.name for output in self.ort_session.get_outputs()]
             
             session_providers = self.ort_session.get_providers()
@@ -205,10 +1275,7 @@ class CLIPImageEmbedder:
             if final_provider == "CUDAExecutionProvider" and "CPUExecutionProvider" in onnxruntime.get_available_providers():
                 logger.warning(f"Ładowanie CUDA nie powiodło się, próba CPU dla istniejących plików ONNX...")
                 try:
-                    self.model_ort_instance = ORTModelForFeatureExtraction.from_pretrained(
-                        self.specific_local_model_path, provider="CPUExecutionProvider", local_files_only=True, use_io_binding=False
-                    )
-                    self.ort_session = self.model_ort_instance.model
+                    self.ort_session = self._load_session("CPUExecutionProvider")
                     self.output_names = [output.name for output in self.ort_session.get_outputs()]
                     self.effective_device = "cpu"
                     logger.info(f"Model ONNX załadowany z CPU (fallback).")
@@ -217,16 +1284,307 @@ class CLIPImageEmbedder:
                     raise # Rzuć błąd, jeśli nawet CPU zawiedzie
             else:
                 raise
-
+        phase_started = self._record_startup_phase("session", phase_started)
 
         if not hasattr(self.processor, 'tokenizer') or self.processor.tokenizer is None:
             logger.error(f"Krytyczny błąd: Załadowany procesor nie posiada tokenizera.")
+
+        self.decode_target_size = self._resolve_decode_target_size()
+        logger.info(f"Docelowy rozmiar dekodowania obrazów (najkrótszy bok): {self.decode_target_size}")
             
         if self.ort_session is None:
             logger.critical(f"Nie udało się zainicjalizować sesji ONNX!")
             raise RuntimeError("Inicjalizacja sesji ONNX nie powiodła się.")
 
-        logger.info(f"Zakończono pomyślnie inicjalizację CLIPImageEmbedder dla '{model_id}'.")
+        # IO binding: wyjście trafia do bufora na urządzeniu, a stałe tensory zastępcze są tam trzymane na stałe
+        io_binding_setting = self.session_settings["io_binding"]
+        self.use_io_binding = io_binding_setting == "on" or (io_binding_setting == "auto" and self.effective_device == "cuda")
+        self.io_binding_device = "cuda" if self.effective_device == "cuda" else "cpu"
+        logger.info(f"Efektywne ustawienia sesji ONNX: {self.describe_session_settings()}")
+
+        self._resolve_model_io()
+        self._record_startup_phase("model_io", phase_started)
+
+        logger.info(f"Zakończono pomyślnie inicjalizację CLIPImageEmbedder dla '{model_id}'. Czasy faz startu [s]: {self.startup_timings}")
+
+    @staticmethod
+    def _local_model_path(model_id: str) -> pathlib.Path:
+        return LOCAL_MODELS_ROOT_DIR / model_id.replace("/", "_--_")
+
+    @staticmethod
+    def estimate_model_bytes(model_id: str, model_variant: str) -> int:
+        # Przybliżony koszt pamięci sesji: plik modelu razem z danymi zewnętrznymi (0, gdy nie ma jeszcze eksportu)
+        model_dir = CLIPImageEmbedder._local_model_path(model_id)
+        if not model_dir.exists():
+            return 0
+        model_file_name = MODEL_VARIANTS[model_variant][0]
+        return sum(path.stat().st_size for path in model_dir.glob(f"{model_file_name}*") if path.is_file())
+
+    def _record_startup_phase(self, phase: str, phase_started: float) -> float:
+        now = time.perf_counter()
+        self.startup_timings[phase] = round(now - phase_started, 3)
+        return now
+
+    def _load_processor(self, allow_hub_fallback: bool = True):
+        from transformers import AutoProcessor
+        try:
+            self.processor = AutoProcessor.from_pretrained(self.specific_local_model_path, local_files_only=True)
+            logger.info(f"Procesor dla '{self.model_id}' załadowany z '{self.specific_local_model_path}'.")
+        except Exception:
+            if not allow_hub_fallback:
+                logger.error(f"Nie udało się załadować procesora lokalnie z '{self.specific_local_model_path}' (fallback do huba wyłączony).", exc_info=True)
+                raise
+            logger.warning(f"Nie udało się załadować procesora lokalnie z '{self.specific_local_model_path}'. Próba z huba '{self.model_id}'.")
+            try:
+                self.processor = AutoProcessor.from_pretrained(self.model_id) # Fallback
+                logger.info(f"Procesor dla '{self.model_id}' załadowany z huba (fallback).")
+            except Exception as e_hub_proc:
+                logger.error(f"Krytyczny błąd ładowania procesora dla '{self.model_id}': {e_hub_proc}", exc_info=True)
+                raise
+
+    @classmethod
+    def preprocessing_only(cls, model_id: str) -> "CLIPImageEmbedder":
+        # Sam procesor (wczytanie, dekodowanie, preprocessing) bez sesji ONNX - dla procesów dekodujących indeksowania offline
+        instance = cls.__new__(cls)
+        instance.model_id = model_id
+        instance.embedding_cache = None
+        instance.processor = None
+        instance.specific_local_model_path = cls._local_model_path(model_id)
+        instance._load_processor(allow_hub_fallback=False)
+        instance.decode_target_size = instance._resolve_decode_target_size()
+        return instance
+
+    def _init_remote_inference(self, inference_host: str):
+        # Tryb workera HTTP: model jest w procesie inferencji, lokalnie tylko procesor (tokenizer + preprocessing)
+        phase_started = time.perf_counter()
+        self.inference_client = InferenceHostClient(inference_host, _require_inference_authkey())
+        host_info = self.inference_client.info()
+        phase_started = self._record_startup_phase("inference_host_connect", phase_started)
+        self.model_id = host_info["model_id"]
+        self.model_variant = host_info["model_variant"]
+        self.model_file_name = MODEL_VARIANTS[self.model_variant][0]
+        self.cache_model_key = host_info["cache_model_key"]
+        self.effective_device = host_info["effective_device"]
+        self.output_names = host_info["output_names"]
+        self.model_input_names = host_info["model_input_names"]
+        self.image_output_name = host_info["image_output_name"]
+        self.text_output_name = host_info["text_output_name"]
+        self.session_settings = host_info["session"]
+        self.specific_local_model_path = self._local_model_path(self.model_id)
+        self._load_processor(allow_hub_fallback=False)
+        self._record_startup_phase("processor", phase_started)
+        self.decode_target_size = self._resolve_decode_target_size()
+        logger.info(f"CLIPImageEmbedder połączony z procesem inferencji {inference_host} (model '{self.model_id}', "
+                    f"wariant {self.model_variant}, urządzenie {self.effective_device}). Czasy faz startu [s]: {self.startup_timings}")
+
+    def is_ready(self) -> bool:
+        return self.processor is not None and (self.ort_session is not None or self.inference_client is not None)
+
+    def describe_remote_info(self) -> Dict[str, Any]:
+        return {
+            "model_id": self.model_id, "model_variant": self.model_variant, "cache_model_key": self.cache_model_key,
+            "effective_device": self.effective_device, "output_names": self.output_names,
+            "model_input_names": self.model_input_names, "image_output_name": self.image_output_name,
+            "text_output_name": self.text_output_name, "session": self.describe_session_settings(),
+        }
+
+    def _build_session_options(self, graph_optimization: str) -> onnxruntime.SessionOptions:
+        settings = self.session_settings
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = settings["intra_op_threads"]
+        session_options.inter_op_num_threads = settings["inter_op_threads"]
+        session_options.execution_mode = EXECUTION_MODES[settings["execution_mode"]]
+        session_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[graph_optimization]
+        session_options.enable_cpu_mem_arena = settings["enable_mem_arena"]
+        session_options.enable_mem_pattern = settings["enable_mem_pattern"]
+        return session_options
+
+    def _create_session(self, model_path: pathlib.Path, provider: str, session_options: onnxruntime.SessionOptions) -> onnxruntime.InferenceSession:
+        # Sesja tworzona bezpośrednio (bez optimum), CPU jako zapasowy provider jak w ORTModel
+        providers = [provider] if provider == "CPUExecutionProvider" else [provider, "CPUExecutionProvider"]
+        return onnxruntime.InferenceSession(str(model_path), sess_options=session_options, providers=providers)
+
+    def _load_session(self, provider: str) -> onnxruntime.InferenceSession:
+        # Zoptymalizowany graf jest zapisywany obok modelu (osobno dla poziomu optymalizacji i providera)
+        # i przy kolejnych startach ładowany bez ponownej optymalizacji. Zapisuje go tylko proces, który
+        # zdobędzie blokadę eksportu - pozostałe workery w tym czasie optymalizują graf w pamięci.
+        # Zapis idzie do pliku tymczasowego podmienianego przez os.replace pod blokadą, więc inne procesy widzą
+        # albo stary, albo kompletny nowy graf; plik danych wag ma unikalną nazwę i nie jest nigdy nadpisywany.
+        graph_optimization = self.session_settings["graph_optimization"]
+        source_path = self.specific_local_model_path / self.model_file_name
+        device_suffix = "cuda" if provider == "CUDAExecutionProvider" else "cpu"
+        optimized_path = source_path.with_name(f"{source_path.stem}.optimized-{graph_optimization}-{device_suffix}.onnx")
+        use_cache = self.session_settings["cache_optimized_model"] and graph_optimization != "disable"
+
+        if use_cache and optimized_path.exists() and optimized_path.stat().st_mtime >= source_path.stat().st_mtime:
+            try:
+                session = self._create_session(optimized_path, provider, self._build_session_options("disable"))
+                self.optimized_model_file_name = optimized_path.name
+                logger.info(f"Załadowano zoptymalizowany graf z cache: {optimized_path.name}")
+                return session
+            except Exception as e_cached:
+                # Bez usuwania: plik mógł zostać właśnie podmieniony przez proces z blokadą; zapis pod blokadą go zastąpi
+                logger.warning(f"Nie udało się załadować zoptymalizowanego grafu '{optimized_path.name}': {e_cached}. Optymalizuję ponownie.")
+
+        session_options = self._build_session_options(graph_optimization)
+        lock_fd = -1
+        write_token = f"{os.getpid()}-{time.time_ns()}"
+        temporary_path = optimized_path.with_name(f"{optimized_path.stem}.tmp-{write_token}.onnx")
+        data_file_name = f"{optimized_path.stem}.{write_token}.onnx_data"
+        if use_cache:
+            try:
+                lock_fd = os.open(EXPORT_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+                session_options.optimized_model_filepath = str(temporary_path)
+                # Duże modele (ViT-H-14) przekraczają limit 2 GB protobuf - wagi do osobnego pliku
+                session_options.add_session_config_entry("session.optimized_model_external_initializers_file_name", data_file_name)
+                session_options.add_session_config_entry("session.optimized_model_external_initializers_min_size_in_bytes", "1024")
+            except FileExistsError:
+                logger.info(f"Blokada eksportu zajęta - zoptymalizowany graf nie zostanie zapisany przez ten proces.")
+        replaced = False
+        try:
+            session = self._create_session(source_path, provider, session_options)
+            if lock_fd != -1:
+                try:
+                    os.replace(temporary_path, optimized_path)
+                    replaced = True
+                    self.optimized_model_file_name = optimized_path.name
+                    logger.info(f"Zapisano zoptymalizowany graf do cache: {optimized_path.name}")
+                    self._remove_stale_optimized_data(optimized_path, keep=data_file_name)
+                except OSError as e_replace:
+                    logger.warning(f"Nie udało się podmienić zoptymalizowanego grafu '{optimized_path.name}': {e_replace}")
+            return session
+        finally:
+            if lock_fd != -1:
+                # Resztki nieudanego zapisu usuwamy jeszcze pod blokadą
+                leftovers = [temporary_path] if replaced else [temporary_path, optimized_path.with_name(data_file_name)]
+                for leftover_path in leftovers:
+                    with contextlib.suppress(OSError):
+                        leftover_path.unlink(missing_ok=True)
+                try:
+                    os.close(lock_fd)
+                    os.remove(EXPORT_LOCK_FILE)
+                except OSError as e_lock:
+                    logger.error(f"Błąd podczas zwalniania blokady eksportu: {e_lock}")
+
+    @staticmethod
+    def _remove_stale_optimized_data(optimized_path: pathlib.Path, keep: str):
+        # Wywoływane tylko pod blokadą eksportu. Pliki wag poprzednich wersji grafu, które inny proces ma
+        # jeszcze otwarte (Windows), zostają do następnej optymalizacji.
+        stale_paths = list(optimized_path.parent.glob(f"{optimized_path.stem}.*.onnx_data"))
+        stale_paths.append(optimized_path.with_name(f"{optimized_path.name}_data")) # Nazwa sprzed wersjonowania
+        for stale_path in stale_paths:
+            if stale_path.name != keep:
+                with contextlib.suppress(OSError):
+                    stale_path.unlink()
+
+    def describe_session_settings(self) -> Dict[str, Any]:
+        if self.inference_client is not None:
+            return {**self.session_settings, "inference_host": self.inference_client.address}
+        return {**self.session_settings, "io_binding_active": self.use_io_binding,
+                "optimized_model_file": self.optimized_model_file_name, "inference_threads": INFERENCE_THREADS}
+
+    def _to_session_value(self, array: np.ndarray) -> Any:
+        # Stałe tensory (zastępcze) przy IO binding trzymamy od razu na urządzeniu docelowym
+        if self.use_io_binding and self.io_binding_device != "cpu":
+            return onnxruntime.OrtValue.ortvalue_from_numpy(array, self.io_binding_device, 0)
+        return array
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _inference_timer(modality: str, batch_size: int):
+        # Obejmuje też wywołania przez wspólny proces inferencji (czas z perspektywy workera)
+        metrics.observe("clip_inference_batch_size", batch_size, {"modality": modality})
+        metrics.inc("clip_inference_in_flight")
+        try:
+            with inference_gate.slot(), stage_timer("inference"):
+                yield
+        finally:
+            metrics.inc("clip_inference_in_flight", value=-1.0)
+
+    def _run_session(self, output_name: str, model_inputs: Dict[str, Any]) -> np.ndarray:
+        if not self.use_io_binding:
+            return self.ort_session.run([output_name], model_inputs)[0]
+        binding = self.ort_session.io_binding()
+        for name, value in model_inputs.items():
+            if isinstance(value, onnxruntime.OrtValue):
+                binding.bind_ortvalue_input(name, value)
+            else:
+                binding.bind_cpu_input(name, np.ascontiguousarray(value))
+        binding.bind_output(output_name, self.io_binding_device)
+        self.ort_session.run_with_iobinding(binding)
+        return binding.copy_outputs_to_cpu()[0]
+
+    def _ensure_model_variant(self):
+        variant_file_name, variant_marker_name = MODEL_VARIANTS[self.model_variant]
+        variant_marker = self.specific_local_model_path / variant_marker_name
+        if variant_marker.exists():
+            logger.info(f"Znacznik '{variant_marker_name}' już istnieje. Wariant {self.model_variant} gotowy.")
+            return
+        source_path = self.specific_local_model_path / MODEL_VARIANTS["fp32"][0]
+        target_path = self.specific_local_model_path / variant_file_name
+        lock_fd = -1
+        try:
+            lock_fd = os.open(EXPORT_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+        except FileExistsError:
+            logger.info(f"Inny proces generuje model (plik blokady {EXPORT_LOCK_FILE} istnieje). Oczekiwanie na '{variant_marker_name}'...")
+            wait_time, max_wait_time, sleep_interval = 0, 600, 5
+            while not variant_marker.exists() and wait_time < max_wait_time:
+                time.sleep(sleep_interval)
+                wait_time += sleep_interval
+            if not variant_marker.exists():
+                raise RuntimeError(f"Timeout oczekiwania na wariant {self.model_variant} modelu w {self.specific_local_model_path}")
+            return
+        try:
+            logger.info(f"Generowanie wariantu {self.model_variant} z '{source_path.name}' do '{target_path.name}'...")
+            started = time.perf_counter()
+            convert_model_variant(source_path, target_path, self.model_variant)
+            with open(variant_marker, "w") as f:
+                f.write(f"Successfully converted ({self.model_variant}) at {time.ctime()} by PID {os.getpid()}")
+            logger.info(f"Wariant {self.model_variant} zapisany w {time.perf_counter() - started:.1f}s. Utworzono znacznik: {variant_marker}")
+        finally:
+            try:
+                os.close(lock_fd)
+                os.remove(EXPORT_LOCK_FILE)
+            except OSError as e_lock:
+                logger.error(f"Błąd podczas zwalniania blokady eksportu: {e_lock}")
+
+    def _resolve_model_io(self):
+        # Nazwy i kształty wejść/wyjść sesji ustalane raz, zamiast przy każdym wywołaniu
+        session_inputs = self.ort_session.get_inputs()
+        self.model_input_names = [inp.name for inp in session_inputs]
+        self.output_names = [output.name for output in self.ort_session.get_outputs()]
+        input_shapes = {inp.name: inp.shape for inp in session_inputs}
+
+        if 'image_embeds' in self.output_names:
+            self.image_output_name = 'image_embeds'
+        elif 'last_hidden_state' in self.output_names and len(self.output_names) == 1:
+            logger.warning(f"Model nie ma wyjścia 'image_embeds', używam 'last_hidden_state'[:, 0, :]. To może nie być właściwe osadzenie CLIP.")
+            self.image_output_name = 'last_hidden_state'
+        for candidate in ('text_embeds', 'pooler_output', 'last_hidden_state'):
+            if candidate in self.output_names:
+                if candidate != 'text_embeds':
+                    logger.warning(f"Model nie ma wyjścia 'text_embeds', dla tekstu używam '{candidate}'.")
+                self.text_output_name = candidate
+                break
+
+        # Wyeksportowany CLIP ma osobne wymiary partii dla tekstu i obrazów (text_batch_size / image_batch_size),
+        # więc jedna pusta sekwencja tekstu wystarcza dla dowolnej partii obrazów. Jeśli wymiar jest wspólny,
+        # tensory zastępcze są budowane (i cache'owane) osobno dla każdego rozmiaru partii.
+        text_shape = input_shapes.get('input_ids')
+        pixel_shape = input_shapes.get('pixel_values')
+        self._text_and_image_batch_shared = bool(text_shape and pixel_shape and text_shape[0] == pixel_shape[0])
+        self._dummy_pixel_size = self._resolve_model_pixel_size(pixel_shape)
+        logger.info(f"Wejścia modelu: {self.model_input_names}, wyjścia: {self.output_names}, "
+                    f"wyjście obrazu: {self.image_output_name}, wyjście tekstu: {self.text_output_name}, "
+                    f"wspólny wymiar partii tekst/obraz: {self._text_and_image_batch_shared}")
+
+    def _resolve_model_pixel_size(self, pixel_shape: Optional[List[Any]]) -> Tuple[int, int]:
+        if pixel_shape and len(pixel_shape) == 4 and isinstance(pixel_shape[2], int) and isinstance(pixel_shape[3], int):
+            return pixel_shape[2], pixel_shape[3]
+        crop_size = getattr(getattr(self.processor, 'image_processor', None), 'crop_size', None)
+        if isinstance(crop_size, dict) and crop_size.get("height") and crop_size.get("width"):
+            return int(crop_size["height"]), int(crop_size["width"])
+        return 224, 224
 
 
     def _determine_onnx_provider(self, available_providers_list: List[str]) -> str:
@@ -247,296 +1605,3412 @@ class CLIPImageEmbedder:
         logger.info(f"Wybrany provider ONNX do użycia: {provider}")
         return provider
 
+    def _read_image_bytes(self, image_path: str) -> bytes:
+        if not os.path.exists(image_path):
+            logger.error(f"Plik obrazu nie znaleziony: {image_path}")
+            raise FileNotFoundError(f"Plik obrazu nie znaleziony: {image_path}")
+        with stage_timer("read"), open(image_path, "rb") as f:
+            return f.read()
+
     def _load_image(self, image_input: Union[str, Image.Image, bytes]) -> Image.Image:
         if isinstance(image_input, str): 
-            if not os.path.exists(image_input):
-                logger.error(f"Plik obrazu nie znaleziony: {image_input}")
-                raise FileNotFoundError(f"Plik obrazu nie znaleziony: {image_input}")
-            image = Image.open(image_input).convert("RGB")
+            image = self._decode_image(Image.open(BytesIO(self._read_image_bytes(image_input))))
         elif isinstance(image_input, Image.Image): 
             image = image_input.convert("RGB")
         elif isinstance(image_input, bytes): 
-            image = Image.open(BytesIO(image_input)).convert("RGB")
+            image = self._decode_image(Image.open(BytesIO(image_input)))
         else:
             logger.error(f"Nieprawidłowy typ wejścia dla obrazu: {type(image_input)}")
             raise ValueError("Wejście musi być ścieżką do pliku, obiektem PIL.Image lub bajtami obrazu.")
         return image
 
+    def _resolve_decode_target_size(self) -> Optional[int]:
+        # Najkrótszy bok, do którego procesor i tak przeskaluje obraz (dla CLIP zwykle 224)
+        image_processor = getattr(self.processor, 'image_processor', None)
+        size_config = getattr(image_processor, 'size', None)
+        if isinstance(size_config, dict):
+            target = size_config.get("shortest_edge") or min(size_config.get("height", 0), size_config.get("width", 0))
+        elif isinstance(size_config, int):
+            target = size_config
+        else:
+            target = None
+        if not target:
+            logger.warning(f"Nie można ustalić docelowego rozmiaru obrazu z procesora ({size_config}). Dekodowanie bez zmniejszania.")
+            return None
+        return int(target)
+
+    def _decode_image(self, image: Image.Image, target: Optional[int] = None) -> Image.Image:
+        with stage_timer("decode"):
+            # Draft i wstępne skalowanie włącza ta sama flaga (CLIP_DECODE_DRAFT)
+            target = (target or self.decode_target_size) if DECODE_USE_DRAFT else None
+            if target and image.format == "JPEG":
+                # Dekodowanie JPEG w zmniejszonej skali (1/2, 1/4, 1/8) - wynik nadal ma oba boki >= target
+                image.draft("RGB", (target, target))
+            image = image.convert("RGB")
+            if target and min(image.size) > target:
+                # To samo skalowanie najkrótszego boku co w procesorze CLIP, ale na już zmniejszonym obrazie
+                width, height = image.size
+                if width <= height:
+                    new_size = (target, int(target * height / width))
+                else:
+                    new_size = (int(target * width / height), target)
+                image = image.resize(new_size, Image.BICUBIC)
+            return image
+
+    def _prepare_image_pixels(self, image_input: Union[str, Image.Image, bytes]) -> np.ndarray:
+        # Dekodowanie + preprocessing jednego obrazu; wywoływane równolegle w puli dekodującej
+        image = self._load_image(image_input)
+        with stage_timer("preprocess"):
+            return self.processor(images=[image], return_tensors="np")['pixel_values'][0]
+
+    def _prepare_image_item(self, image_input: Union[str, Image.Image, bytes]) -> _PreparedImage:
+        # Jak _prepare_image_pixels, ale najpierw sprawdza cache po hashu zawartości (dekodowanie tylko przy braku trafienia)
+        if self.embedding_cache is None or isinstance(image_input, Image.Image):
+            return _PreparedImage(None, pixel_values=self._prepare_image_pixels(image_input))
+        image_bytes = self._read_image_bytes(image_input) if isinstance(image_input, str) else image_input
+        content_hash = compute_content_hash(image_bytes)
+        cached_embedding = self.embedding_cache.get(self.cache_model_key, content_hash)
+        if cached_embedding is not None:
+            return _PreparedImage(content_hash, embedding=cached_embedding)
+        return _PreparedImage(content_hash, pixel_values=self._prepare_image_pixels(image_bytes))
+
+    def _prepare_image_crops(self, image_input: Union[str, Image.Image, bytes], crop_spec: CropSpec) -> _PreparedImage:
+        # Dekodowanie w rozdzielczości, w której najmniejszy wycinek ma nadal bok >= rozmiar wejścia modelu,
+        # potem preprocessing wszystkich wycinków jednym wywołaniem procesora. Bez cache embeddingów (klucz to cały obraz).
+        if isinstance(image_input, Image.Image):
+            opened = image_input
+        elif isinstance(image_input, (str, bytes)):
+            image_bytes = self._read_image_bytes(image_input) if isinstance(image_input, str) else image_input
+            opened = Image.open(BytesIO(image_bytes))
+        else:
+            raise ValueError("Wejście musi być ścieżką do pliku, obiektem PIL.Image lub bajtami obrazu.")
+        width, height = opened.size
+        boxes = crop_spec.boxes(width, height)
+        target = self.decode_target_size
+        if target:
+            smallest_side = min(min(right - left, bottom - top) for left, top, right, bottom in boxes)
+            target = int(np.ceil(min(width, height) * target / max(smallest_side, 1)))
+        image = opened.convert("RGB") if isinstance(image_input, Image.Image) else self._decode_image(opened, target)
+        scale_x, scale_y = image.size[0] / width, image.size[1] / height
+        crops = [image.crop((int(left * scale_x), int(top * scale_y), int(np.ceil(right * scale_x)), int(np.ceil(bottom * scale_y))))
+                 for left, top, right, bottom in boxes]
+        with stage_timer("preprocess"):
+            pixel_values = self.processor(images=crops, return_tensors="np")['pixel_values']
+        return _PreparedImage(None, pixel_values=pixel_values, boxes=boxes)
+
+    def get_image_crop_embeddings_isolated(self, image_inputs: List[Union[str, Image.Image, bytes]],
+                                           crop_spec: CropSpec) -> List[Union[CropEmbeddings, Exception]]:
+        # Wszystkie wycinki wszystkich obrazów porcji w jednym wywołaniu ONNX. Porcja ma INFERENCE_CHUNK_SIZE / 4 obrazów,
+        # bo każdy daje kilka-kilkanaście wierszy partii. Błąd obrazu zostaje na jego pozycji jak w get_image_embeddings_isolated.
+        results: List[Union[CropEmbeddings, Exception]] = []
+        prepare = functools.partial(self._prepare_image_crops, crop_spec=crop_spec)
+        for prepared_items in self._iter_prepared_chunks(image_inputs, isolate_errors=True, prepare=prepare,
+                                                         chunk_size=max(1, INFERENCE_CHUNK_SIZE // 4)):
+            chunk_results: List[Union[CropEmbeddings, Exception]] = list(prepared_items)
+            valid_positions = [position for position, item in enumerate(prepared_items) if not isinstance(item, Exception)]
+            if valid_positions:
+                embeddings = self.get_image_embeddings_from_pixels(np.concatenate([prepared_items[position].pixel_values for position in valid_positions]))
+                offsets = np.cumsum([0] + [len(prepared_items[position].boxes) for position in valid_positions])
+                for number, position in enumerate(valid_positions):
+                    chunk_results[position] = CropEmbeddings(prepared_items[position].boxes, embeddings[offsets[number]:offsets[number + 1]])
+            results.extend(chunk_results)
+        return results
+
+    def _embed_prepared_images(self, prepared_images: List[_PreparedImage]) -> np.ndarray:
+        # Inferencja tylko dla braków w cache; nowe wyniki trafiają do cache
+        missing_rows = [row for row, item in enumerate(prepared_images) if item.embedding is None]
+        if missing_rows:
+            computed = self.get_image_embeddings_from_pixels(np.stack([prepared_images[row].pixel_values for row in missing_rows]))
+            for computed_row, row in enumerate(missing_rows):
+                prepared_images[row].embedding = computed[computed_row]
+            hashed_rows = [row for row in missing_rows if prepared_images[row].content_hash]
+            if self.embedding_cache is not None and hashed_rows:
+                self.embedding_cache.put_many(self.cache_model_key,
+                                              [prepared_images[row].content_hash for row in hashed_rows],
+                                              np.stack([prepared_images[row].embedding for row in hashed_rows]))
+        return np.stack([item.embedding for item in prepared_images])
+
     def _prepare_model_inputs(self, inputs_to_filter: Dict[str, Any]) -> Dict[str, Any]:
-        try:
-            model_expected_inputs = [inp.name for inp in self.ort_session.get_inputs()]
-        except Exception as e_inputs:
-            logger.error(f"Nie można automatycznie ustalić nazw wejść modelu ONNX: {e_inputs}", exc_info=True)
-            return inputs_to_filter 
-        
-        filtered_inputs = {key: val for key, val in inputs_to_filter.items() if key in model_expected_inputs}
-        return filtered_inputs
+        if not self.model_input_names:
+            return dict(inputs_to_filter)
+        return {key: val for key, val in inputs_to_filter.items() if key in self.model_input_names}
 
-    def _get_dummy_text_inputs(self, batch_size: int) -> Dict[str, np.ndarray]:
+    def _get_dummy_text_inputs(self, batch_size: int) -> Dict[str, Any]:
+        # Minimalne wejście tekstowe (pusty tekst = tylko tokeny BOS/EOS, bez paddingu do model_max_length),
+        # budowane raz - wieża tekstowa przy inferencji obrazów kosztuje wtedy pomijalnie mało.
+        if 'input_ids' not in self.model_input_names:
+            return {}
+        dummy_batch_size = batch_size if self._text_and_image_batch_shared else 1
+        cached = self._dummy_text_inputs_cache.get(dummy_batch_size)
+        if cached is not None:
+            return cached
         if not hasattr(self.processor, 'tokenizer') or self.processor.tokenizer is None:
             logger.warning("Tokenizer nie jest dostępny w procesorze. Zwracam puste dummy inputs, co może prowadzić do błędów.")
             return {} 
 
-        dummy_texts = [""] * batch_size 
-        max_len = getattr(getattr(self.processor, 'tokenizer', None), 'model_max_length', 77)
-
-        processed_text_inputs = self.processor(
-            text=dummy_texts,
-            return_tensors="np",
-            padding="max_length", 
-            max_length=max_len,
-            truncation=True 
-        )
-        return {
-            'input_ids': processed_text_inputs['input_ids'],
-            'attention_mask': processed_text_inputs['attention_mask']
+        processed_text_inputs = self.processor(text=[""] * dummy_batch_size, return_tensors="np", padding=True)
+        cached = {
+            'input_ids': self._to_session_value(processed_text_inputs['input_ids']),
+            'attention_mask': self._to_session_value(processed_text_inputs['attention_mask'])
         }
+        self._dummy_text_inputs_cache[dummy_batch_size] = cached
+        return cached
+
+    def _get_dummy_pixel_inputs(self, batch_size: int) -> Dict[str, Any]:
+        # Odpowiednik _get_dummy_text_inputs dla zapytań tekstowych (eksport CLIP wymaga też pixel_values)
+        if 'pixel_values' not in self.model_input_names:
+            return {}
+        dummy_batch_size = batch_size if self._text_and_image_batch_shared else 1
+        cached = self._dummy_pixel_values_cache.get(dummy_batch_size)
+        if cached is None:
+            height, width = self._dummy_pixel_size
+            cached = self._to_session_value(np.zeros((dummy_batch_size, 3, height, width), dtype=np.float32))
+            self._dummy_pixel_values_cache[dummy_batch_size] = cached
+        return {'pixel_values': cached}
 
     def get_image_embedding(self, image_input: Union[str, Image.Image, bytes]) -> np.ndarray:
-        image = self._load_image(image_input)
-        processed_image_inputs = self.processor(images=[image], return_tensors="np", padding=True)
-        dummy_text_inputs_for_batch = self._get_dummy_text_inputs(batch_size=1)
-        combined_inputs = {
-            'pixel_values': processed_image_inputs['pixel_values'],
-            **dummy_text_inputs_for_batch 
-        }
-        model_inputs_filtered = self._prepare_model_inputs(combined_inputs)
-        
+        return self._embed_prepared_images([self._prepare_image_item(image_input)])[0]
+
+    def _iter_prepared_chunks(self, image_inputs: List[Union[str, Image.Image, bytes]], isolate_errors: bool = False,
+                              prepare: Optional[Callable[[Any], _PreparedImage]] = None, chunk_size: int = INFERENCE_CHUNK_SIZE):
+        # Potok: pula dekoduje i przetwarza kolejną porcję, podczas gdy bieżąca porcja (zwrócona przez yield) jest w inferencji.
+        # Przy isolate_errors=True błąd wczytania obrazu zostaje na swojej pozycji jako wyjątek zamiast przerywać partię.
+        decode_pool = get_decode_pool()
+        prepare = prepare or self._prepare_image_item
+        chunks = [image_inputs[i:i + chunk_size] for i in range(0, len(image_inputs), chunk_size)]
+
+        def submit_chunk(chunk):
+            return [decode_pool.submit(_in_request_context(prepare, image_input)) for image_input in chunk]
+
+        pending_chunks = deque(submit_chunk(chunk) for chunk in chunks[:1 + DECODE_PREFETCH_CHUNKS])
+        next_chunk_index = len(pending_chunks)
         try:
-            raw_outputs = self.ort_session.run(None, model_inputs_filtered) 
-            output_dict = dict(zip(self.output_names, raw_outputs))
-            target_output_name = 'image_embeds' 
-            
-            if target_output_name in output_dict:
-                embedding = output_dict[target_output_name]
-                if embedding.ndim > 1 and embedding.shape[0] == 1: 
-                    embedding = embedding[0] 
-            elif 'last_hidden_state' in output_dict and len(self.output_names) == 1: 
-                 logger.warning(f"Nie znaleziono '{target_output_name}', próbuję 'last_hidden_state'. To może nie być właściwe osadzenie CLIP.")
-                 embedding = output_dict['last_hidden_state'][:, 0, :] 
-                 if embedding.ndim > 1 and embedding.shape[0] == 1: embedding = embedding[0]
-            else:
-                logger.error(f"Nie udało się znaleźć wyjścia '{target_output_name}' ani 'last_hidden_state' w wynikach modelu. Dostępne wyjścia: {self.output_names}")
-                raise RuntimeError(f"Nie można uzyskać osadzeń obrazu z modelu. Dostępne wyjścia: {self.output_names}")
-        except Exception as e:
-            logger.error(f"Błąd podczas inferencji modelu dla obrazu: {e}", exc_info=True)
-            raise
-        return embedding
+            while pending_chunks:
+                raise_if_request_cancelled()
+                futures = pending_chunks.popleft()
+                prepared_items: List[Union[_PreparedImage, Exception]] = []
+                for future in futures:
+                    try:
+                        prepared_items.append(future.result())
+                    except Exception as e_prepare:
+                        if not isolate_errors:
+                            raise
+                        prepared_items.append(e_prepare)
+                if next_chunk_index < len(chunks):
+                    pending_chunks.append(submit_chunk(chunks[next_chunk_index]))
+                    next_chunk_index += 1
+                yield prepared_items
+        finally:
+            for futures in pending_chunks:
+                for future in futures:
+                    future.cancel()
 
     def get_image_embeddings_batch(self, image_inputs: List[Union[str, Image.Image, bytes]]) -> np.ndarray:
         if not image_inputs: return np.array([])
-        batch_size = len(image_inputs)
-        images = [self._load_image(img_input) for img_input in image_inputs]
-        processed_image_inputs = self.processor(images=images, return_tensors="np", padding=True)
-        dummy_text_inputs_for_batch = self._get_dummy_text_inputs(batch_size=batch_size)
-        combined_inputs = {
-            'pixel_values': processed_image_inputs['pixel_values'],
-            **dummy_text_inputs_for_batch
-        }
-        model_inputs_filtered = self._prepare_model_inputs(combined_inputs)
+        chunk_embeddings = [self._embed_prepared_images(prepared_images) for prepared_images in self._iter_prepared_chunks(image_inputs)]
+        return chunk_embeddings[0] if len(chunk_embeddings) == 1 else np.concatenate(chunk_embeddings, axis=0)
+
+    def get_image_embeddings_isolated(self, image_inputs: List[Union[str, Image.Image, bytes]]) -> List[Union[np.ndarray, Exception]]:
+        # Jak get_image_embeddings_batch, ale wynik per element: wektor albo wyjątek (uszkodzone pliki nie psują partii)
+        results: List[Union[np.ndarray, Exception]] = []
+        for prepared_items in self._iter_prepared_chunks(image_inputs, isolate_errors=True):
+            results.extend(self._embed_prepared_items_isolated(prepared_items))
+        return results
+
+    def _embed_prepared_items_isolated(self, prepared_items: List[Union[_PreparedImage, Exception]]) -> List[Union[np.ndarray, Exception]]:
+        results: List[Union[np.ndarray, Exception]] = list(prepared_items)
+        valid_positions = [position for position, item in enumerate(prepared_items) if not isinstance(item, Exception)]
+        if valid_positions:
+            embeddings = self._embed_prepared_images([prepared_items[position] for position in valid_positions])
+            for row, position in enumerate(valid_positions):
+                results[position] = embeddings[row]
+        return results
+
+    def get_image_embeddings_from_pixels(self, pixel_values: np.ndarray) -> np.ndarray:
+        # Jedno wywołanie ONNX dla już przetworzonych obrazów (N, 3, H, W); pobierane jest tylko wyjście obrazu
+        if self.inference_client is not None:
+            with self._inference_timer("image", pixel_values.shape[0]):
+                return self.inference_client.embed_pixels(pixel_values)
+        if self.image_output_name is None:
+            logger.error(f"Nie udało się znaleźć wyjścia 'image_embeds' ani 'last_hidden_state' w wynikach modelu (batch). Dostępne wyjścia: {self.output_names}")
+            raise RuntimeError(f"Nie można uzyskać osadzeń obrazu z modelu (batch). Dostępne wyjścia: {self.output_names}")
+        model_inputs_filtered = self._prepare_model_inputs({
+            'pixel_values': pixel_values,
+            **self._get_dummy_text_inputs(batch_size=pixel_values.shape[0])
+        })
 
         try:
-            raw_outputs = self.ort_session.run(None, model_inputs_filtered)
-            output_dict = dict(zip(self.output_names, raw_outputs))
-            target_output_name = 'image_embeds'
-            
-            if target_output_name in output_dict:
-                embeddings = output_dict[target_output_name]
-            elif 'last_hidden_state' in output_dict and len(self.output_names) == 1:
-                 logger.warning(f"Nie znaleziono '{target_output_name}', próbuję 'last_hidden_state' dla batcha. To może nie być właściwe osadzenie CLIP.")
-                 embeddings = output_dict['last_hidden_state'][:, 0, :] 
-            else:
-                logger.error(f"Nie udało się znaleźć wyjścia '{target_output_name}' ani 'last_hidden_state' w wynikach modelu (batch). Dostępne wyjścia: {self.output_names}")
-                raise RuntimeError(f"Nie można uzyskać osadzeń obrazu z modelu (batch). Dostępne wyjścia: {self.output_names}")
+            with self._inference_timer("image", pixel_values.shape[0]):
+                embeddings = self._run_session(self.image_output_name, model_inputs_filtered)
+            if self.image_output_name == 'last_hidden_state':
+                embeddings = embeddings[:, 0, :]
+        except (ClientDisconnected, FutureCancelledError):
+            raise # Przerwane żądanie (rozłączony klient, anulowana praca) - nie jest błędem modelu
         except Exception as e:
             logger.error(f"Błąd podczas inferencji modelu dla partii obrazów: {e}", exc_info=True)
             raise
         return embeddings
     
     def get_text_embedding(self, text: str) -> np.ndarray:
-        # ... (bez zmian)
-        model_input_names = []
-        try: model_input_names = [inp.name for inp in self.ort_session.get_inputs()]
-        except Exception as e_inputs: raise RuntimeError(f"Nie można ustalić nazw wejść modelu ONNX dla tekstu: {e_inputs}")
+        return self.get_text_embeddings_batch([text])[0]
 
-        if 'input_ids' not in model_input_names: 
-             raise NotImplementedError("Wektoryzacja tekstu nie jest obsługiwana (brak 'input_ids').")
-        
-        processed_inputs = self.processor(text=[text], return_tensors="np", padding=True)
-        model_inputs_filtered = self._prepare_model_inputs(processed_inputs) 
-        
-        try:
-            raw_outputs = self.ort_session.run(None, model_inputs_filtered)
-            output_dict = dict(zip(self.output_names, raw_outputs))
-            target_output_name = 'text_embeds' 
-
-            if target_output_name in output_dict:
-                embedding = output_dict[target_output_name]
-                if embedding.ndim > 1 and embedding.shape[0] == 1: embedding = embedding[0]
-            elif 'pooler_output' in output_dict: 
-                 logger.warning(f"Nie znaleziono '{target_output_name}', próbuję 'pooler_output'.")
-                 embedding = output_dict['pooler_output']
-                 if embedding.ndim > 1 and embedding.shape[0] == 1: embedding = embedding[0]
-            elif 'last_hidden_state' in output_dict: 
-                 logger.warning(f"Nie znaleziono '{target_output_name}' ani 'pooler_output', próbuję 'last_hidden_state'[:,0,:].")
-                 embedding = output_dict['last_hidden_state'][:, 0, :] 
-                 if embedding.ndim > 1 and embedding.shape[0] == 1: embedding = embedding[0]
-            else:
-                logger.error(f"Nie udało się znaleźć wyjścia '{target_output_name}', 'pooler_output', ani 'last_hidden_state' w wynikach modelu. Dostępne wyjścia: {self.output_names}")
-                raise RuntimeError(f"Nie można uzyskać osadzeń tekstu. Dostępne wyjścia: {self.output_names}")
-        except Exception as e:
-            logger.error(f"Błąd podczas inferencji modelu dla tekstu: {e}", exc_info=True)
-            raise
-        return embedding
+    def cached_text_embedding(self, text: str) -> Optional[np.ndarray]:
+        # Tylko LRU w pamięci - bezpieczne w pętli zdarzeń; cache na dysku sprawdza partia mikro-batchera
+        if self.text_cache is None:
+            return None
+        return self.text_cache.get_many(self.cache_model_key, [normalize_prompt(text)], memory_only=True)[0]
 
     def get_text_embeddings_batch(self, texts: List[str]) -> np.ndarray:
-        # ... (bez zmian)
+        # Z cache tekstu: liczone są tylko brakujące, unikalne prompty (po normalizacji)
         if not texts: return np.array([])
-        try: model_input_names = [inp.name for inp in self.ort_session.get_inputs()]
-        except Exception as e_inputs: raise RuntimeError(f"Nie można ustalić nazw wejść modelu ONNX dla tekstu: {e_inputs}")
-        
-        if 'input_ids' not in model_input_names:
+        if self.text_cache is None:
+            return self._compute_text_embeddings(texts)
+        prompts = [normalize_prompt(text) for text in texts]
+        embeddings = self.text_cache.get_many(self.cache_model_key, prompts)
+        missing_prompts = list(dict.fromkeys(prompt for prompt, embedding in zip(prompts, embeddings) if embedding is None))
+        if missing_prompts:
+            computed = self._compute_text_embeddings(missing_prompts)
+            self.text_cache.put_many(self.cache_model_key, missing_prompts, computed)
+            computed_by_prompt = dict(zip(missing_prompts, computed))
+            embeddings = [computed_by_prompt[prompt] if embedding is None else embedding for prompt, embedding in zip(prompts, embeddings)]
+        return np.stack(embeddings)
+
+    def _compute_text_embeddings(self, texts: List[str]) -> np.ndarray:
+        if self.inference_client is not None:
+            with self._inference_timer("text", len(texts)):
+                return self.inference_client.embed_texts(texts)
+        if 'input_ids' not in self.model_input_names: 
              raise NotImplementedError("Wektoryzacja tekstu nie jest obsługiwana (brak 'input_ids').")
+        if self.text_output_name is None:
+            logger.error(f"Nie udało się znaleźć wyjścia 'text_embeds', 'pooler_output', ani 'last_hidden_state' w wynikach modelu (batch). Dostępne wyjścia: {self.output_names}")
+            raise RuntimeError(f"Nie można uzyskać osadzeń tekstu (batch). Dostępne wyjścia: {self.output_names}")
         
-        processed_inputs = self.processor(text=texts, return_tensors="np", padding=True)
-        model_inputs_filtered = self._prepare_model_inputs(processed_inputs)
+        with stage_timer("tokenize"):
+            processed_inputs = self.processor(text=texts, return_tensors="np", padding=True)
+        model_inputs_filtered = self._prepare_model_inputs({
+            'input_ids': processed_inputs['input_ids'],
+            'attention_mask': processed_inputs['attention_mask'],
+            **self._get_dummy_pixel_inputs(batch_size=len(texts))
+        })
 
         try:
-            raw_outputs = self.ort_session.run(None, model_inputs_filtered)
-            output_dict = dict(zip(self.output_names, raw_outputs))
-            target_output_name = 'text_embeds'
-
-            if target_output_name in output_dict:
-                embeddings = output_dict[target_output_name]
-            elif 'pooler_output' in output_dict:
-                logger.warning(f"Nie znaleziono '{target_output_name}', próbuję 'pooler_output' dla batcha.")
-                embeddings = output_dict['pooler_output']
-            elif 'last_hidden_state' in output_dict:
-                logger.warning(f"Nie znaleziono '{target_output_name}' ani 'pooler_output', próbuję 'last_hidden_state'[:,0,:] dla batcha.")
-                embeddings = output_dict['last_hidden_state'][:, 0, :]
-            else:
-                logger.error(f"Nie udało się znaleźć wyjścia '{target_output_name}', 'pooler_output', ani 'last_hidden_state' w wynikach modelu (batch). Dostępne wyjścia: {self.output_names}")
-                raise RuntimeError(f"Nie można uzyskać osadzeń tekstu (batch). Dostępne wyjścia: {self.output_names}")
-
+            with self._inference_timer("text", len(texts)):
+                embeddings = self._run_session(self.text_output_name, model_inputs_filtered)
+            if self.text_output_name == 'last_hidden_state':
+                embeddings = embeddings[:, 0, :]
+        except (ClientDisconnected, FutureCancelledError):
+            raise # Przerwane żądanie (rozłączony klient, anulowana praca) - nie jest błędem modelu
         except Exception as e:
             logger.error(f"Błąd podczas inferencji modelu dla partii tekstów: {e}", exc_info=True)
             raise
         return embeddings
 
-# --- FastAPI app setup, endpoints, startup_event ---
-app = FastAPI()
-embedder: Optional[CLIPImageEmbedder] = None
+# --- Wspólny proces inferencji ---
+def _parse_host_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
 
-@app.on_event("startup")
-async def startup_event():
-    global embedder
-    logger.info(f"Główny proces/worker (PID: {os.getpid()}): Uruchamianie serwera FastAPI, inicjalizacja CLIPImageEmbedder...")
-    try:
-        embedder = CLIPImageEmbedder()
-        if embedder and embedder.model_ort_instance and embedder.ort_session:
-             logger.info(f"CLIPImageEmbedder (PID: {os.getpid()}) zainicjalizowany pomyślnie. Używane urządzenie: {embedder.effective_device}")
-        else:
-             logger.critical(f"Nie udało się w pełni zainicjalizować embeddera (PID: {os.getpid()}).")
-             embedder = None
-    except Exception as e:
-        logger.critical(f"Krytyczny błąd podczas inicjalizacji CLIPImageEmbedder na starcie (PID: {os.getpid()}): {e}", exc_info=True)
-        embedder = None
-    logger.info(f"Zakończono startup_event (PID: {os.getpid()}).")
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    segment = shared_memory.SharedMemory(name=name)
+    if os.name == "posix":
+        # Segment należy do workera HTTP; bez tego resource_tracker hosta usunąłby go przy zamykaniu
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(segment._name, "shared_memory")
+        except Exception:
+            pass
+    return segment
 
-# ... (reszta definicji modeli Pydantic i endpointów bez zmian)
-class ImagePathInput(BaseModel):
-    path: str = Field(..., example="C:\\Users\\Admin\\Pictures\\cosplay_image.jpg")
+class _InferenceHostConnection:
+    # Jedno połączenie z hostem + własny segment pamięci współdzielonej na piksele i wynik
+    def __init__(self, address: str, authkey: bytes, timeout_s: float):
+        deadline = time.monotonic() + timeout_s
+        while True:
+            try:
+                self.connection = Client(_parse_host_address(address), authkey=authkey)
+                break
+            except OSError as e_connect:
+                # Host może jeszcze eksportować/ładować model
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"Nie udało się połączyć z procesem inferencji {address} w {timeout_s:.0f}s: {e_connect}") from e_connect
+                time.sleep(1.0)
+        self.segment: Optional[shared_memory.SharedMemory] = None
 
-class ImagePathsInput(BaseModel):
-    paths: List[str] = Field(..., example=["path/to/img1.jpg", "path/to/img2.png"])
+    def request(self, message: Tuple[Any, ...]) -> Any:
+        self.connection.send(message)
+        status, payload = self.connection.recv()
+        if status != "ok":
+            raise RuntimeError(f"Błąd procesu inferencji: {payload}")
+        return payload
 
-class TextIn(BaseModel):
-    text: str = Field(..., example="A beautiful cosplay photo.")
+    def embed_pixels(self, pixel_values: np.ndarray) -> np.ndarray:
+        pixel_values = np.ascontiguousarray(pixel_values, dtype=np.float32)
+        if self.segment is None or self.segment.size < pixel_values.nbytes:
+            self._release_segment()
+            self.segment = shared_memory.SharedMemory(create=True, size=pixel_values.nbytes)
+        np.ndarray(pixel_values.shape, dtype=np.float32, buffer=self.segment.buf)[...] = pixel_values
+        location, payload = self.request(("image", self.segment.name, pixel_values.shape))
+        if location == "shm":
+            return np.ndarray(payload, dtype=np.float32, buffer=self.segment.buf).copy()
+        return payload
 
-class TextsIn(BaseModel):
-    texts: List[str] = Field(..., example=["cosplay", "character", "triss merigold"])
+    def _release_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            try:
+                self.segment.unlink()
+            except FileNotFoundError:
+                pass
+            self.segment = None
 
-class EmbeddingResponse(BaseModel):
+    def close(self):
+        self._release_segment()
+        self.connection.close()
+
+class InferenceHostClient:
+    # Klient po stronie workera HTTP; osobne połączenie na wątek inferencji (CLIP_INFERENCE_THREADS)
+    def __init__(self, address: str, authkey: bytes, timeout_s: float = INFERENCE_HOST_CONNECT_TIMEOUT_S):
+        self.address = address
+        self.authkey = authkey
+        self.timeout_s = timeout_s
+        self._local = threading.local()
+        self._connections: List[_InferenceHostConnection] = []
+        self._lock = threading.Lock()
+
+    def _connection(self) -> _InferenceHostConnection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = _InferenceHostConnection(self.address, self.authkey, self.timeout_s)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def info(self) -> Dict[str, Any]:
+        return self._connection().request(("info",))
+
+    def embed_pixels(self, pixel_values: np.ndarray) -> np.ndarray:
+        return self._connection().embed_pixels(pixel_values)
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        return self._connection().request(("text", list(texts)))
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                try:
+                    connection.close()
+                except OSError:
+                    pass
+            self._connections.clear()
+
+def _serve_inference_connection(host_embedder: CLIPImageEmbedder, connection):
+    segments: Dict[str, shared_memory.SharedMemory] = {}
+    try:
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                kind = message[0]
+                if kind == "info":
+                    reply = host_embedder.describe_remote_info()
+                elif kind == "image":
+                    _, segment_name, shape = message
+                    segment = segments.get(segment_name)
+                    if segment is None:
+                        # Klient podmienia segment tylko przy powiększeniu - stary można odłączyć
+                        for old_segment in segments.values():
+                            old_segment.close()
+                        segments.clear()
+                        segment = segments[segment_name] = _attach_shared_memory(segment_name)
+                    pixel_values = np.ndarray(shape, dtype=np.float32, buffer=segment.buf)
+                    embeddings = np.ascontiguousarray(host_embedder.get_image_embeddings_from_pixels(pixel_values), dtype=np.float32)
+                    del pixel_values
+                    if embeddings.nbytes <= segment.size:
+                        np.ndarray(embeddings.shape, dtype=np.float32, buffer=segment.buf)[...] = embeddings
+                        reply = ("shm", embeddings.shape)
+                    else:
+                        reply = ("inline", embeddings)
+                elif kind == "text":
+                    reply = host_embedder.get_text_embeddings_batch(message[1])
+                else:
+                    raise ValueError(f"Nieznany typ wiadomości: {kind}")
+                connection.send(("ok", reply))
+            except Exception as e_request:
+                logger.error(f"Błąd obsługi żądania w procesie inferencji: {e_request}", exc_info=True)
+                connection.send(("error", str(e_request)))
+    finally:
+        for segment in segments.values():
+            segment.close()
+        connection.close()
+
+def run_inference_host(address: str, authkey: bytes):
+    # Jedyny proces z modelem w pamięci; wszystkie rdzenie dla jednej sesji (workerzy HTTP nie liczą się do podziału)
+    os.environ[SESSION_SETTINGS_ENV["workers"]] = "1"
+    host_embedder = CLIPImageEmbedder()
+    listener = Listener(_parse_host_address(address), authkey=authkey)
+    logger.info(f"Proces inferencji (PID: {os.getpid()}) nasłuchuje na {address}.")
+    try:
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, multiprocessing.AuthenticationError) as e_accept:
+                logger.warning(f"Odrzucono połączenie z procesem inferencji: {e_accept}")
+                continue
+            threading.Thread(target=_serve_inference_connection, args=(host_embedder, connection),
+                             name="clip-inference-host-connection", daemon=True).start()
+    finally:
+        listener.close()
+
+# --- Warianty modelu (int8/fp16) ---
+def convert_model_variant(source_path: pathlib.Path, target_path: pathlib.Path, variant: str):
+    # Importy leniwe: narzędzia kwantyzacji/konwersji potrzebne są tylko przy jednorazowym generowaniu wariantu
+    if variant == "int8":
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        # Kwantyzowane są tylko MatMul/Gemm (warstwy transformera); konwolucja patch embedding zostaje w fp32,
+        # bo ConvInteger nie jest wspierany przez wszystkie providery. Model wczytywany jest ze ścieżki (inferencja
+        # kształtów po ścieżce obsługuje dane zewnętrzne), a zapis idzie z wagami w osobnym pliku - ViT-H-14 > 2 GB.
+        quantize_dynamic(str(source_path), str(target_path), weight_type=QuantType.QInt8,
+                         op_types_to_quantize=["MatMul", "Gemm"], per_channel=True, use_external_data_format=True)
+    elif variant == "fp16":
+        import onnx
+        from onnxruntime.transformers.float16 import convert_float_to_float16
+        # Inferencja kształtów w pamięci przekracza limit 2 GB protobuf dla ViT-H-14 - robimy ją po ścieżce
+        # (plik obok źródła, żeby względne ścieżki danych zewnętrznych się zgadzały), a konwersja jej nie powtarza
+        inferred_path = source_path.with_name(f"{source_path.stem}.shape-inferred-{os.getpid()}.onnx")
+        try:
+            onnx.shape_inference.infer_shapes_path(str(source_path), str(inferred_path))
+            model = onnx.load(str(inferred_path))
+        except Exception as e_shapes:
+            logger.warning(f"Inferencja kształtów dla '{source_path.name}' nie powiodła się ({e_shapes}); konwersja fp16 bez niej.")
+            model = onnx.load(str(source_path))
+        finally:
+            with contextlib.suppress(OSError):
+                inferred_path.unlink(missing_ok=True)
+        # keep_io_types: wejścia/wyjścia pozostają float32, więc reszta serwera nie wymaga zmian
+        model_fp16 = convert_float_to_float16(model, keep_io_types=True, disable_shape_infer=True)
+        # Wagi w osobnym pliku, bo ViT-H-14 w fp16 zbliża się do limitu 2 GB protobuf
+        onnx.save(model_fp16, str(target_path), save_as_external_data=True, all_tensors_to_one_file=True,
+                  location=f"{target_path.name}_data")
+    else:
+        raise ValueError(f"Nie można skonwertować do wariantu '{variant}'.")
+
+def compare_model_variants(sample_paths: List[str], variant: str, model_id: Optional[str] = None, device: str = "cpu",
+                           texts: Optional[List[str]] = None) -> Dict[str, Any]:
+    # Porównanie wariantu z fp32 na próbce obrazów: dryf kosinusowy, zgodność najbliższych sąsiadów i przepustowość
+    kwargs = {"device": device}
+    if model_id:
+        kwargs["model_id"] = model_id
+    report: Dict[str, Any] = {"variant": variant, "samples": len(sample_paths)}
+    embeddings: Dict[str, np.ndarray] = {}
+    text_embeddings: Dict[str, np.ndarray] = {}
+    for name in ("fp32", variant):
+        variant_embedder = CLIPImageEmbedder(model_variant=name, **kwargs)
+        variant_embedder.get_image_embeddings_batch(sample_paths[:1])  # rozgrzewka sesji
+        started = time.perf_counter()
+        embeddings[name] = normalize_rows(variant_embedder.get_image_embeddings_batch(sample_paths))
+        elapsed = time.perf_counter() - started
+        report[f"{name}_images_per_second"] = len(sample_paths) / elapsed if elapsed > 0 else None
+        if texts:
+            text_embeddings[name] = normalize_rows(variant_embedder.get_text_embeddings_batch(texts))
+        del variant_embedder
+
+    cosines = np.sum(embeddings["fp32"] * embeddings[variant], axis=1)
+    report.update({
+        "cosine_mean": float(np.mean(cosines)),
+        "cosine_min": float(np.min(cosines)),
+        "cosine_p5": float(np.percentile(cosines, 5)),
+    })
+    if report.get("fp32_images_per_second") and report.get(f"{variant}_images_per_second"):
+        report["speedup"] = report[f"{variant}_images_per_second"] / report["fp32_images_per_second"]
+    # Zgodność rankingu: czy najbliższy sąsiad każdego obrazu w próbce pozostaje ten sam
+    if len(sample_paths) > 1:
+        def nearest(matrix: np.ndarray) -> np.ndarray:
+            similarity = matrix @ matrix.T
+            np.fill_diagonal(similarity, -np.inf)
+            return np.argmax(similarity, axis=1)
+        report["nearest_neighbour_agreement"] = float(np.mean(nearest(embeddings["fp32"]) == nearest(embeddings[variant])))
+    if texts:
+        text_cosines = np.sum(text_embeddings["fp32"] * text_embeddings[variant], axis=1)
+        report["text_cosine_mean"] = float(np.mean(text_cosines))
+        report["text_cosine_min"] = float(np.min(text_cosines))
+    return report
+
+# --- Narzędzia wektorowe ---
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+def _merge_top_k(best_scores: np.ndarray, best_rows: np.ndarray, scores: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Łączy dotychczasowe top-k z wynikami kolejnego bloku (bez pełnego sortowania całej macierzy)
+    all_scores = np.concatenate([best_scores, scores], axis=1)
+    all_rows = np.concatenate([best_rows, rows], axis=1)
+    if all_scores.shape[1] > k:
+        keep = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+        all_scores = np.take_along_axis(all_scores, keep, axis=1)
+        all_rows = np.take_along_axis(all_rows, keep, axis=1)
+    return all_scores, all_rows
+
+def blocked_top_k(queries: np.ndarray, matrix: np.ndarray, k: int, block_rows: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+    # Top-k iloczynów skalarnych (dla znormalizowanych wektorów = cosinus) liczone blokami wierszy macierzy,
+    # żeby pamięć tymczasowa była ograniczona niezależnie od rozmiaru indeksu. Wynik posortowany malejąco.
+    query_count = queries.shape[0]
+    best_scores = np.empty((query_count, 0), dtype=np.float32)
+    best_rows = np.empty((query_count, 0), dtype=np.int64)
+    for start in range(0, matrix.shape[0], block_rows):
+        block = np.asarray(matrix[start:start + block_rows], dtype=np.float32)
+        scores = queries @ block.T
+        block_k = min(k, block.shape[0])
+        part = np.argpartition(-scores, block_k - 1, axis=1)[:, :block_k]
+        best_scores, best_rows = _merge_top_k(best_scores, best_rows, np.take_along_axis(scores, part, axis=1), part + start, k)
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+def spherical_kmeans(matrix: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    # Prosty k-means na sferze (znormalizowane wektory, podobieństwo cosinusowe) - centroidy dla struktury IVF
+    rng = np.random.default_rng(seed)
+    k = min(k, matrix.shape[0])
+    centroids = matrix[rng.choice(matrix.shape[0], size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(matrix @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, matrix)
+        empty = np.flatnonzero(np.bincount(assignments, minlength=k) == 0)
+        if len(empty): # Puste klastry dostają losowy punkt
+            sums[empty] = matrix[rng.choice(matrix.shape[0], size=len(empty), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+def similar_pairs(matrix: np.ndarray, threshold: float, top_k: int = 10, query_block_rows: int = 1024,
+                  block_rows: int = 16384) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Pary (i < j) o podobieństwie >= threshold wśród top_k sąsiadów każdego wiersza. Zapytania i macierz
+    # przetwarzane blokami, więc pamięć tymczasowa to query_block_rows x block_rows niezależnie od rozmiaru zbioru.
+    left_parts, right_parts, score_parts = [], [], []
+    neighbours = min(top_k + 1, matrix.shape[0])  # +1: każdy wiersz znajduje sam siebie
+    for start in range(0, matrix.shape[0], query_block_rows):
+        queries = np.asarray(matrix[start:start + query_block_rows], dtype=np.float32)
+        scores, rows = blocked_top_k(queries, matrix, neighbours, block_rows=block_rows)
+        query_rows = np.arange(start, start + queries.shape[0])[:, None]
+        keep = (scores >= threshold) & (rows != query_rows)
+        left = np.broadcast_to(query_rows, rows.shape)[keep]
+        right = rows[keep]
+        left_parts.append(np.minimum(left, right))
+        right_parts.append(np.maximum(left, right))
+        score_parts.append(scores[keep])
+    if not left_parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    left, right, scores = np.concatenate(left_parts), np.concatenate(right_parts), np.concatenate(score_parts)
+    # Para (i, j) pojawia się zwykle dwa razy (z obu stron) - zostawiamy jedną
+    _, unique_positions = np.unique(left * matrix.shape[0] + right, return_index=True)
+    return left[unique_positions], right[unique_positions], scores[unique_positions]
+
+def connected_groups(count: int, left: np.ndarray, right: np.ndarray) -> List[List[int]]:
+    # Union-find: spójne składowe grafu krawędzi (left[i], right[i]); zwraca tylko grupy z więcej niż jednym elementem
+    parent = list(range(count))
+    def find(node: int) -> int:
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+    for a, b in zip(left.tolist(), right.tolist()):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    groups: Dict[int, List[int]] = {}
+    for node in range(count):
+        groups.setdefault(find(node), []).append(node)
+    return [members for members in groups.values() if len(members) > 1]
+
+def compute_dhash(image: Image.Image) -> int:
+    # 64-bitowy hash różnicowy (dHash) z miniatury 9x8 w skali szarości
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.BOX), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+def fingerprint_image_file(path: str) -> Tuple[str, str]:
+    # Tani odcisk pliku dla prefiltra duplikatów: hash bajtów + (rozmiar obrazu, dHash). Dekodowanie JPEG
+    # w trybie draft do miniatury, więc koszt jest ułamkiem przetwarzania przez model.
+    # (rozmiar, dHash) tylko wskazuje kandydatów - zdjęcia z serii mają często ten sam dHash, choć nie są identyczne.
+    with open(path, "rb") as f:
+        data = f.read()
+    image = Image.open(BytesIO(data))
+    original_size = image.size
+    if DECODE_USE_DRAFT and image.format == "JPEG":
+        image.draft("L", (64, 64))
+    return compute_content_hash(data), f"{original_size[0]}x{original_size[1]}:{compute_dhash(image):016x}"
+
+def decoded_pixels_hash(path: str) -> str:
+    # Hash pełnych zdekodowanych pikseli (bez draft): potwierdza identyczność kandydatów o różnych bajtach
+    # (np. inne metadane), zanim prefiltr pominie ich embedding
+    with Image.open(path) as image:
+        image = image.convert("RGB")
+        return compute_content_hash(f"{image.size[0]}x{image.size[1]}:".encode("ascii") + image.tobytes())
+
+# --- Klasteryzacja (podział profili na warianty) ---
+def assign_to_centroids(matrix: np.ndarray, centroids: np.ndarray, block_rows: int = 16384) -> Tuple[np.ndarray, np.ndarray]:
+    # Najbliższy centroid (cosinus) dla każdego wiersza, blokami
+    assignments = np.empty(matrix.shape[0], dtype=np.int64)
+    similarities = np.empty(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], block_rows):
+        scores = matrix[start:start + block_rows] @ centroids.T
+        assignments[start:start + block_rows] = np.argmax(scores, axis=1)
+        similarities[start:start + block_rows] = scores[np.arange(scores.shape[0]), assignments[start:start + block_rows]]
+    return assignments, similarities
+
+def kmeans_plus_plus_init(matrix: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    # Zachłanny k-means++ w odległości cosinusowej (1 - cos): w każdym kroku kilku kandydatów losowanych
+    # z prawdopodobieństwem ~ d^2, wybierany ten, który najbardziej zmniejsza sumę d^2
+    local_trials = 2 + int(np.log(k))
+    centroids = np.empty((k, matrix.shape[1]), dtype=np.float32)
+    centroids[0] = matrix[rng.integers(matrix.shape[0])]
+    min_distances = np.maximum(1.0 - matrix @ centroids[0], 0.0)
+    for center in range(1, k):
+        weights = min_distances ** 2
+        total = float(weights.sum())
+        if total <= 0:
+            centroids[center] = matrix[rng.integers(matrix.shape[0])]
+            continue
+        candidates = rng.choice(matrix.shape[0], size=local_trials, p=weights / total)
+        candidate_distances = np.minimum(min_distances[None, :], np.maximum(1.0 - matrix[candidates] @ matrix.T, 0.0))
+        best = int(np.argmin(np.sum(candidate_distances ** 2, axis=1)))
+        centroids[center] = matrix[candidates[best]]
+        min_distances = candidate_distances[best]
+    return centroids
+
+def minibatch_kmeans(matrix: np.ndarray, k: int, batch_size: int = 4096, max_iterations: int = 100, tolerance: float = 1e-4,
+                     seed: int = 0, init_sample: int = 20000, plus_plus_init: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Mini-batch k-means na sferze (Sculley 2010) z inicjalizacją k-means++ na próbce (albo losowymi punktami,
+    # gdy plus_plus_init=False). Macierz musi być znormalizowana. Zwraca (centroidy, przypisania, podobieństwo do własnego centroidu).
+    rng = np.random.default_rng(seed)
+    count = matrix.shape[0]
+    k = max(1, min(k, count))
+    if plus_plus_init:
+        init_rows = rng.choice(count, size=min(count, max(init_sample, k)), replace=False)
+        centroids = kmeans_plus_plus_init(matrix[init_rows], k, rng)
+    else:
+        centroids = np.array(matrix[rng.choice(count, size=k, replace=False)], dtype=np.float32)
+    center_counts = np.zeros(k, dtype=np.float64)
+    batch_size = min(batch_size, count)
+    for _ in range(max_iterations):
+        batch = matrix[rng.choice(count, size=batch_size, replace=False)] if batch_size < count else matrix
+        batch_assignments = np.argmax(batch @ centroids.T, axis=1)
+        batch_counts = np.bincount(batch_assignments, minlength=k)
+        batch_sums = np.zeros_like(centroids)
+        np.add.at(batch_sums, batch_assignments, batch)
+        # Średnia krocząca: waga partii = jej udział w łącznej liczbie punktów przypisanych do centrum
+        center_counts += batch_counts
+        touched = batch_counts > 0
+        learning_rates = np.zeros(k, dtype=np.float32)
+        learning_rates[touched] = batch_counts[touched] / center_counts[touched]
+        updated = normalize_rows(centroids * (1.0 - learning_rates[:, None])
+                                 + (batch_sums / np.maximum(batch_counts, 1)[:, None]) * learning_rates[:, None])
+        shift = float(np.max(1.0 - np.sum(updated * centroids, axis=1)))
+        centroids = updated
+        if shift < tolerance:
+            break
+    assignments, similarities = assign_to_centroids(matrix, centroids)
+    # Centroidy końcowe = znormalizowana średnia przypisanych punktów (jeden pełny krok Lloyda)
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, assignments, matrix)
+    nonempty = np.bincount(assignments, minlength=k) > 0
+    centroids[nonempty] = normalize_rows(sums[nonempty])
+    return centroids, assignments, similarities
+
+def simplified_silhouette(matrix: np.ndarray, centroids: np.ndarray, assignments: np.ndarray, block_rows: int = 16384) -> float:
+    # Uproszczony współczynnik sylwetki: a = odległość do własnego centroidu, b = do najbliższego innego
+    if centroids.shape[0] < 2:
+        return 0.0
+    total = 0.0
+    for start in range(0, matrix.shape[0], block_rows):
+        distances = 1.0 - matrix[start:start + block_rows] @ centroids.T
+        rows = np.arange(distances.shape[0])
+        own = distances[rows, assignments[start:start + block_rows]]
+        distances[rows, assignments[start:start + block_rows]] = np.inf
+        other = np.min(distances, axis=1)
+        total += float(np.sum((other - own) / np.maximum(np.maximum(own, other), 1e-12)))
+    return total / matrix.shape[0]
+
+def choose_cluster_count(matrix: np.ndarray, k_min: int = 2, k_max: Optional[int] = None, sample_size: int = 4000,
+                         seed: int = 0) -> Tuple[int, Dict[int, float]]:
+    # Automatyczne k: najwyższa uproszczona sylwetka dla kandydatów k z przedziału [k_min, k_max], liczona na próbce
+    count = matrix.shape[0]
+    if k_max is None:
+        k_max = int(np.clip(np.sqrt(count / 2.0), k_min, 30))
+    k_max = max(k_min, min(k_max, count - 1))
+    if count <= k_min:
+        return max(1, count), {}
+    rng = np.random.default_rng(seed)
+    sample = matrix[rng.choice(count, size=min(count, sample_size), replace=False)]
+    # Każde k w małym zakresie, powyżej ~16 kandydatów - siatka geometryczna
+    if k_max - k_min < 16:
+        candidates = list(range(k_min, k_max + 1))
+    else:
+        candidates = sorted(set(int(k) for k in np.geomspace(k_min, k_max, num=16).round()))
+    scores = {}
+    for k in candidates:
+        centroids, assignments, _ = minibatch_kmeans(sample, k, batch_size=1024, max_iterations=30, seed=seed)
+        scores[k] = simplified_silhouette(sample, centroids, assignments)
+    best_k = max(scores, key=lambda k: scores[k])
+    return best_k, scores
+
+def agglomerative_average(matrix: np.ndarray, distance_threshold: float, max_nodes: int = 256, seed: int = 0) -> np.ndarray:
+    # Aglomeracja ze średnim wiązaniem przy progu odległości cosinusowej. Dla wektorów znormalizowanych średni
+    # cosinus między klastrami A i B to iloczyn ich (nieznormalizowanych) średnich, więc łączenie jest dokładne
+    # na poziomie węzłów. Powyżej max_nodes punktów węzłami startowymi są mikroklastry z mini-batch k-means.
+    count = matrix.shape[0]
+    if count > max_nodes:
+        _, node_of_row, _ = minibatch_kmeans(matrix, max_nodes, max_iterations=20, seed=seed, plus_plus_init=False)
+    else:
+        node_of_row = np.arange(count)
+    node_count = int(node_of_row.max()) + 1 if count else 0
+    sizes = np.bincount(node_of_row, minlength=node_count).astype(np.float64)
+    means = np.zeros((node_count, matrix.shape[1]), dtype=np.float64)
+    np.add.at(means, node_of_row, matrix)
+    alive = sizes > 0
+    means[alive] /= sizes[alive, None]
+    similarity = means @ means.T
+    np.fill_diagonal(similarity, -np.inf)
+    similarity[~alive, :] = -np.inf
+    similarity[:, ~alive] = -np.inf
+    label_of_node = np.arange(node_count)
+    min_similarity = 1.0 - distance_threshold
+    while True:
+        flat = int(np.argmax(similarity))
+        a, b = divmod(flat, node_count)
+        if similarity[a, b] < min_similarity:
+            break
+        # b dołącza do a: nowa średnia ważona rozmiarami, podobieństwa a do reszty przeliczone z nowej średniej
+        means[a] = (sizes[a] * means[a] + sizes[b] * means[b]) / (sizes[a] + sizes[b])
+        sizes[a] += sizes[b]
+        sizes[b] = 0
+        label_of_node[label_of_node == b] = a
+        similarity[b, :] = -np.inf
+        similarity[:, b] = -np.inf
+        alive[b] = False
+        row = means @ means[a]
+        row[~alive] = -np.inf
+        row[a] = -np.inf
+        similarity[a, :] = row
+        similarity[:, a] = row
+    _, labels = np.unique(label_of_node[node_of_row], return_inverse=True)
+    return labels.astype(np.int64)
+
+def agglomerative_single(matrix: np.ndarray, distance_threshold: float, top_k: int = 10) -> np.ndarray:
+    # Pojedyncze wiązanie = spójne składowe grafu par z odległością <= progu (sąsiedzi z top_k na wiersz)
+    left, right, _ = similar_pairs(matrix, 1.0 - distance_threshold, top_k)
+    labels = np.arange(matrix.shape[0], dtype=np.int64)
+    for group_number, members in enumerate(connected_groups(matrix.shape[0], left, right)):
+        labels[members] = -1 - group_number
+    _, labels = np.unique(labels, return_inverse=True)
+    return labels.astype(np.int64)
+
+def describe_clusters(matrix: np.ndarray, assignments: np.ndarray) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+    # Centroidy (znormalizowane średnie) i spójność: średni/minimalny cosinus członków do centroidu
+    k = int(assignments.max()) + 1 if len(assignments) else 0
+    sums = np.zeros((k, matrix.shape[1]), dtype=np.float32)
+    np.add.at(sums, assignments, matrix)
+    centroids = normalize_rows(sums)
+    similarities = np.sum(matrix * centroids[assignments], axis=1)
+    sizes = np.bincount(assignments, minlength=k)
+    mean_similarity = np.bincount(assignments, weights=similarities, minlength=k) / np.maximum(sizes, 1)
+    min_similarity = np.full(k, np.inf)
+    np.minimum.at(min_similarity, assignments, similarities)
+    clusters = [{"cluster": cluster, "size": int(sizes[cluster]), "cohesion": float(mean_similarity[cluster]),
+                 "min_similarity": float(min_similarity[cluster])} for cluster in range(k)]
+    return centroids, clusters
+
+# --- Indeks wektorowy (wyszukiwanie najbliższych sąsiadów i klasyfikacja po centroidach) ---
+@contextlib.contextmanager
+def interprocess_file_lock(path: pathlib.Path):
+    # Wyłączna blokada systemowa na pliku (między workerami i CLI; zwalniana też przy śmierci procesu).
+    # Każde wejście otwiera własny uchwyt, więc wyklucza się także z innymi wątkami tego procesu.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as lock_file:
+        if os.name == "nt":
+            import msvcrt
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError: # LK_LOCK poddaje się po ~10 s prób - czekamy dalej
+                    continue
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+class VectorIndex:
+    # Nazwany, trwały indeks: identyfikatory + metadane + znormalizowana macierz float32.
+    # Wyszukiwanie: iloczyn macierzowy blokami; powyżej IVF_THRESHOLD wektorów - IVF (centroidy k-means
+    # + przeszukiwanie nprobe najbliższych list), uczony leniwie i ponownie po podwojeniu rozmiaru.
+    # Wynik indeksowania offline (float16) jest mapowany z pliku tylko do odczytu, bez kopiowania do pamięci;
+    # pierwsza zmiana indeksu robi z niego prywatną kopię float32.
+    # Każdy worker ma własną kopię w pamięci, więc zmiany od ostatniego zapisu są też trzymane jako lista operacji:
+    # zapis (pod blokadą pliku indeksu) wczytuje nowszą wersję zapisaną przez inny proces i powtarza na niej te operacje.
+    def __init__(self, name: str, dim: Optional[int] = None, model_key: Optional[str] = None):
+        self.name = name
+        self.dim = dim
+        # Model, którym policzono wektory - zapytania embeddowane innym modelem (nawet o tym samym wymiarze) nie mają sensu
+        self.model_key = model_key
+        self.ids: List[str] = []
+        self.metadata: List[Dict[str, Any]] = []
+        self._id_to_row: Dict[str, int] = {}
+        self._matrix = np.empty((0, dim or 0), dtype=np.float32)
+        self._lock = threading.RLock()
+        self._ivf_centroids: Optional[np.ndarray] = None
+        self._ivf_assignments: Optional[np.ndarray] = None
+        self._ivf_trained_size = 0
+        self.loaded_mtime: Optional[float] = None
+        self.generation = 0 # Numer zapisanej wersji, na której opiera się stan w pamięci
+        self._pending: List[Tuple[str, Any]] = []
+        self.dirty = False
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix[:len(self.ids)]
+
+    def _ensure_capacity(self, rows: int):
+        if rows <= self._matrix.shape[0]:
+            return
+        new_capacity = max(rows, int(self._matrix.shape[0] * 1.5) + 1024)
+        # (kopia float32 - zastępuje też macierz mapowaną z pliku)
+        grown = np.empty((new_capacity, self.dim), dtype=np.float32)
+        grown[:len(self.ids)] = self.matrix
+        self._matrix = grown
+        if self._ivf_assignments is not None:
+            grown_assignments = np.zeros(new_capacity, dtype=np.int32)
+            grown_assignments[:len(self.ids)] = self._ivf_assignments[:len(self.ids)]
+            self._ivf_assignments = grown_assignments
+
+    def _ensure_writable(self):
+        if not self._matrix.flags.writeable or self._matrix.dtype != np.float32:
+            self._matrix = np.array(self._matrix, dtype=np.float32)
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, metadata: Optional[List[Optional[Dict[str, Any]]]] = None) -> int:
+        vectors = normalize_rows(np.atleast_2d(vectors))
+        if len(ids) != vectors.shape[0]:
+            raise ValueError(f"Liczba identyfikatorów ({len(ids)}) różni się od liczby wektorów ({vectors.shape[0]}).")
+        if metadata is not None and len(metadata) != len(ids):
+            raise ValueError(f"Liczba metadanych ({len(metadata)}) różni się od liczby identyfikatorów ({len(ids)}).")
+        with self._lock:
+            inserted = self._apply_upsert(ids, vectors, metadata)
+            self._pending.append(("upsert", (list(ids), vectors, metadata)))
+            return inserted
+
+    def _apply_upsert(self, ids: List[str], vectors: np.ndarray, metadata: Optional[List[Optional[Dict[str, Any]]]]) -> int:
+        with self._lock:
+            if self.dim is None or (len(self.ids) == 0 and self.dim != vectors.shape[1]):
+                self.dim = vectors.shape[1]
+                self._matrix = np.empty((0, self.dim), dtype=np.float32)
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Wymiar wektorów ({vectors.shape[1]}) różni się od wymiaru indeksu '{self.name}' ({self.dim}).")
+            self._ensure_writable()
+            self._ensure_capacity(len(self.ids) + len(ids))
+            inserted = 0
+            for position, vector_id in enumerate(ids):
+                row = self._id_to_row.get(vector_id)
+                if row is None:
+                    row = len(self.ids)
+                    self.ids.append(vector_id)
+                    self.metadata.append({})
+                    self._id_to_row[vector_id] = row
+                    inserted += 1
+                self._matrix[row] = vectors[position]
+                if metadata is not None and metadata[position] is not None:
+                    self.metadata[row] = metadata[position]
+                if self._ivf_centroids is not None:
+                    self._ivf_assignments[row] = int(np.argmax(self._ivf_centroids @ vectors[position]))
+            self.dirty = True
+            return inserted
+
+    def remove(self, ids: List[str]) -> int:
+        with self._lock:
+            removed = self._apply_remove(ids)
+            if removed:
+                self._pending.append(("remove", list(ids)))
+            return removed
+
+    def _apply_remove(self, ids: List[str]) -> int:
+        removed = 0
+        with self._lock:
+            if any(vector_id in self._id_to_row for vector_id in ids):
+                self._ensure_writable()
+            for vector_id in ids:
+                row = self._id_to_row.pop(vector_id, None)
+                if row is None:
+                    continue
+                last_row = len(self.ids) - 1
+                if row != last_row: # Przenieś ostatni wiersz w miejsce usuniętego - macierz pozostaje ciągła
+                    self._matrix[row] = self._matrix[last_row]
+                    self.ids[row] = self.ids[last_row]
+                    self.metadata[row] = self.metadata[last_row]
+                    self._id_to_row[self.ids[row]] = row
+                    if self._ivf_assignments is not None:
+                        self._ivf_assignments[row] = self._ivf_assignments[last_row]
+                self.ids.pop()
+                self.metadata.pop()
+                removed += 1
+            if removed:
+                self.dirty = True
+            return removed
+
+    def _ensure_ivf(self):
+        size = len(self.ids)
+        if size < INDEX_IVF_THRESHOLD:
+            self._ivf_centroids = None
+            self._ivf_assignments = None
+            return
+        if self._ivf_centroids is not None and size < 2 * self._ivf_trained_size:
+            return
+        list_count = min(4096, max(16, int(4 * np.sqrt(size))))
+        rng = np.random.default_rng(0)
+        sample = np.asarray(self.matrix[rng.choice(size, size=min(size, list_count * 64), replace=False)], dtype=np.float32)
+        started = time.perf_counter()
+        centroids = spherical_kmeans(sample, list_count)
+        assignments = np.zeros(self._matrix.shape[0], dtype=np.int32)
+        for start in range(0, size, 65536):
+            assignments[start:start + 65536] = np.argmax(self.matrix[start:start + 65536] @ centroids.T, axis=1)
+        self._ivf_centroids, self._ivf_assignments, self._ivf_trained_size = centroids, assignments, size
+        logger.info(f"Indeks '{self.name}': wytrenowano IVF ({list_count} list, {size} wektorów) w {time.perf_counter() - started:.1f}s.")
+
+    def search(self, queries: np.ndarray, top_k: int = 10) -> List[List[Dict[str, Any]]]:
+        queries = normalize_rows(np.atleast_2d(queries))
+        with self._lock:
+            size = len(self.ids)
+            if size == 0:
+                return [[] for _ in range(queries.shape[0])]
+            if queries.shape[1] != self.dim:
+                raise ValueError(f"Wymiar zapytania ({queries.shape[1]}) różni się od wymiaru indeksu '{self.name}' ({self.dim}).")
+            top_k = max(1, min(top_k, size))
+            self._ensure_ivf()
+            if self._ivf_centroids is None:
+                scores, rows = blocked_top_k(queries, self.matrix, top_k)
+            else:
+                scores, rows = self._search_ivf(queries, top_k)
+            return [[{"id": self.ids[row], "score": float(score), "metadata": self.metadata[row]}
+                     for score, row in zip(query_scores, query_rows) if row >= 0]
+                    for query_scores, query_rows in zip(scores, rows)]
+
+    def _search_ivf(self, queries: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        nprobe = min(INDEX_IVF_NPROBE, self._ivf_centroids.shape[0])
+        probe_lists = np.argpartition(-(queries @ self._ivf_centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        assignments = self._ivf_assignments[:len(self.ids)]
+        all_scores = np.full((queries.shape[0], top_k), -np.inf, dtype=np.float32)
+        all_rows = np.full((queries.shape[0], top_k), -1, dtype=np.int64)
+        for query_index, query in enumerate(queries):
+            candidate_rows = np.flatnonzero(np.isin(assignments, probe_lists[query_index]))
+            if candidate_rows.size == 0:
+                continue
+            scores, rows = blocked_top_k(query[np.newaxis], self.matrix[candidate_rows], min(top_k, candidate_rows.size))
+            all_scores[query_index, :scores.shape[1]] = scores[0]
+            all_rows[query_index, :rows.shape[1]] = candidate_rows[rows[0]]
+        return all_scores, all_rows
+
+    def info(self) -> Dict[str, Any]:
+        return {"name": self.name, "size": len(self.ids), "dim": self.dim, "model": self.model_key, "dtype": str(self._matrix.dtype),
+                "memory_mapped": isinstance(self._matrix, np.memmap),
+                "ivf_lists": int(self._ivf_centroids.shape[0]) if self._ivf_centroids is not None else 0}
+
+    def save(self, directory: pathlib.Path):
+        # Pod blokadą pliku indeksu: jeśli inny proces zapisał w międzyczasie nowszą wersję, najpierw ją wczytujemy
+        # i powtarzamy na niej niezapisane operacje tego procesu (bez tego wygrywałby ostatni zapisujący worker).
+        # Wektory idą do nowej wersji pliku, a jedynym punktem zatwierdzenia jest podmiana meta.json (os.replace),
+        # więc czytelnik widzi zawsze pasującą parę ids + wektory.
+        directory.mkdir(parents=True, exist_ok=True)
+        vectors_path, meta_path = VectorIndex.paths(directory, self.name)
+        with interprocess_file_lock(VectorIndex.lock_path(directory, self.name)), self._lock:
+            disk_generation = VectorIndex.read_generation(directory, self.name)
+            if disk_generation is not None and disk_generation != self.generation:
+                self._rebase(VectorIndex.load(directory, self.name))
+            elif disk_generation is None and self.loaded_mtime is not None:
+                # Inny proces usunął indeks (DELETE) - zapisujemy tylko niezapisane operacje tego procesu, bez starej zawartości
+                self._rebase(VectorIndex(self.name, model_key=self.model_key))
+            vectors_path = VectorIndex.versioned_vectors_path(directory, self.name)
+            tmp_meta_path = meta_path.with_suffix(f".tmp{os.getpid()}.json")
+            np.save(vectors_path, np.asarray(self.matrix, dtype=np.float32), allow_pickle=False)
+            with open(tmp_meta_path, "w", encoding="utf-8") as f:
+                json.dump({"name": self.name, "dim": self.dim, "model": self.model_key, "generation": self.generation + 1, "vectors_file": vectors_path.name,
+                           "ids": self.ids, "metadata": self.metadata}, f, ensure_ascii=False)
+            os.replace(tmp_meta_path, meta_path)
+            self.generation += 1
+            self.loaded_mtime = meta_path.stat().st_mtime
+            self._pending = []
+            self.dirty = False
+            VectorIndex.remove_stale_vectors(directory, self.name, keep=vectors_path.name)
+
+    def _rebase(self, base: "VectorIndex"):
+        # Stan z dysku + niezapisane operacje tego procesu (ten sam obiekt - trzymające go żądania widzą wynik)
+        pending = self._pending
+        self.dim, self.ids, self.metadata, self._id_to_row = base.dim, base.ids, base.metadata, base._id_to_row
+        self.model_key = base.model_key or self.model_key
+        self._matrix = base._matrix
+        self._ivf_centroids, self._ivf_assignments, self._ivf_trained_size = None, None, 0
+        self.generation = base.generation
+        for operation, arguments in pending:
+            if operation == "upsert":
+                self._apply_upsert(*arguments)
+            else:
+                self._apply_remove(arguments)
+        logger.info(f"Indeks '{self.name}': scalono {len(pending)} operacji z wersją {base.generation} zapisaną przez inny proces.")
+
+    @staticmethod
+    def paths(directory: pathlib.Path, name: str) -> Tuple[pathlib.Path, pathlib.Path]:
+        return directory / f"{name}.vectors.npy", directory / f"{name}.meta.json"
+
+    @staticmethod
+    def lock_path(directory: pathlib.Path, name: str) -> pathlib.Path:
+        return directory / f"{name}.lock"
+
+    @staticmethod
+    def read_generation(directory: pathlib.Path, name: str) -> Optional[int]:
+        _, meta_path = VectorIndex.paths(directory, name)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                return int(json.load(f).get("generation", 0))
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def versioned_vectors_path(directory: pathlib.Path, name: str) -> pathlib.Path:
+        # Nowa wersja pliku wektorów zamiast podmiany istniejącego: na Windows pliku zmapowanego przez inny proces
+        # (serwer trzyma wynik indeksowania offline przez mmap) nie da się podmienić ani usunąć
+        return directory / f"{name}.vectors.{time.time_ns():x}.npy"
+
+    @staticmethod
+    def remove_stale_vectors(directory: pathlib.Path, name: str, keep: str):
+        # Wersje pliku wektorów inne niż wskazana w meta.json; zmapowane jeszcze przez inny proces zostają do następnego razu
+        default_path, _ = VectorIndex.paths(directory, name)
+        for path in [default_path, *directory.glob(f"{name}.vectors.*.npy")]:
+            if path.name != keep and path.exists():
+                with contextlib.suppress(OSError):
+                    path.unlink()
+
+    @classmethod
+    def load(cls, directory: pathlib.Path, name: str) -> "VectorIndex":
+        vectors_path, meta_path = cls.paths(directory, name)
+        for attempt in range(3):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("vectors_file"):
+                vectors_path = directory / pathlib.Path(meta["vectors_file"]).name
+            try:
+                if meta.get("source") == "offline":
+                    matrix = np.load(vectors_path, mmap_mode="r", allow_pickle=False) # Zero-copy; wiersze poza len(ids) to zapas pojemności
+                else:
+                    matrix = np.ascontiguousarray(np.load(vectors_path, allow_pickle=False).astype(np.float32, copy=False))
+                break
+            except FileNotFoundError:
+                if attempt == 2: # Wersja wskazana w przeczytanym meta.json została już zastąpiona - czytamy meta.json ponownie
+                    raise
+        index = cls(name, meta.get("dim"), meta.get("model"))
+        index.generation = int(meta.get("generation", 0))
+        index.ids = list(meta["ids"])
+        index.metadata = list(meta["metadata"])
+        index._id_to_row = {vector_id: row for row, vector_id in enumerate(index.ids)}
+        index._matrix = matrix
+        if index.dim is None and matrix.ndim == 2:
+            index.dim = matrix.shape[1]
+        index.loaded_mtime = meta_path.stat().st_mtime
+        return index
+
+class VectorIndexStore:
+    # Rejestr indeksów tego procesu. Indeks jest ładowany z dysku przy pierwszym użyciu
+    # i przeładowywany, gdy inny worker zapisał nowszą wersję (a lokalnie nie ma niezapisanych zmian).
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+        self._indexes: Dict[str, VectorIndex] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def validate_name(name: str) -> str:
+        if not name or not all(ch.isalnum() or ch in "-_." for ch in name) or name.startswith("."):
+            raise ValueError(f"Nieprawidłowa nazwa indeksu '{name}'. Dozwolone: litery, cyfry, '-', '_', '.'.")
+        return name
+
+    def get(self, name: str, create: bool = False) -> Optional[VectorIndex]:
+        self.validate_name(name)
+        with self._lock:
+            index = self._indexes.get(name)
+            _, meta_path = VectorIndex.paths(self.directory, name)
+            on_disk_mtime = meta_path.stat().st_mtime if meta_path.exists() else None
+            if on_disk_mtime is None and index is not None and not index.dirty and index.loaded_mtime is not None:
+                # Indeks był na dysku, a inny worker go usunął - nie serwujemy (i nie zapiszemy z powrotem) starej kopii
+                del self._indexes[name]
+                index = None
+            if on_disk_mtime is not None and (index is None or (not index.dirty and index.loaded_mtime != on_disk_mtime)):
+                index = VectorIndex.load(self.directory, name)
+                self._indexes[name] = index
+                logger.info(f"Załadowano indeks '{name}' ({len(index)} wektorów) z '{self.directory}'.")
+            if index is None and create:
+                index = VectorIndex(name)
+                self._indexes[name] = index
+            return index
+
+    def delete(self, name: str) -> bool:
+        self.validate_name(name)
+        with self._lock, interprocess_file_lock(VectorIndex.lock_path(self.directory, name)):
+            existed = self._indexes.pop(name, None) is not None
+            _, meta_path = VectorIndex.paths(self.directory, name)
+            if meta_path.exists():
+                meta_path.unlink()
+                existed = True
+            VectorIndex.remove_stale_vectors(self.directory, name, keep="")
+            return existed
+
+    def list_names(self) -> List[str]:
+        with self._lock:
+            names = set(self._indexes)
+            if self.directory.exists():
+                names.update(path.name[:-len(".meta.json")] for path in self.directory.glob("*.meta.json"))
+            return sorted(names)
+
+    def save_dirty(self):
+        with self._lock:
+            indexes = list(self._indexes.values())
+        for index in indexes:
+            if index.dirty:
+                index.save(self.directory)
+
+# --- Zestawy etykiet (tagowanie zero-shot) ---
+class LabelSet:
+    # Nazwany zestaw etykiet z trzymaną w pamięci, znormalizowaną macierzą embeddingów tekstu (etykiety x wymiar).
+    # Etykieta może mieć kilka szablonów promptu ("a photo of {}", "{} cosplay"); jej wektor to znormalizowana
+    # średnia wektorów wszystkich jej promptów. Macierz jest liczona raz na model (prompty idą przez cache tekstu).
+    def __init__(self, name: str, labels: List[str], templates: Optional[List[str]] = None,
+                 prompts: Optional[Dict[str, List[str]]] = None):
+        self.name = name
+        self.labels = labels
+        self.templates = templates or ["{}"]
+        self.prompts = prompts or {}
+        self.matrices: Dict[str, np.ndarray] = {} # klucz modelu -> macierz (każdy model ma własną przestrzeń wektorów)
+        self.loaded_mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def prompts_for(self, label: str) -> List[str]:
+        return self.prompts.get(label) or [template.replace("{}", label) for template in self.templates]
+
+    def ensure_matrix(self, label_embedder: "CLIPImageEmbedder") -> np.ndarray:
+        with self._lock:
+            matrix = self.matrices.get(label_embedder.cache_model_key)
+            if matrix is None:
+                label_prompts = [self.prompts_for(label) for label in self.labels]
+                embeddings = normalize_rows(label_embedder.get_text_embeddings_batch([prompt for prompts in label_prompts for prompt in prompts]))
+                offsets = np.cumsum([0] + [len(prompts) for prompts in label_prompts[:-1]])
+                matrix = self.matrices[label_embedder.cache_model_key] = normalize_rows(np.add.reduceat(embeddings, offsets, axis=0))
+            return matrix
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "labels": self.labels, "templates": self.templates, "prompts": self.prompts}
+
+    @staticmethod
+    def path(directory: pathlib.Path, name: str) -> pathlib.Path:
+        return directory / f"{name}.labels.json"
+
+    def save(self, directory: pathlib.Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(directory, self.name)
+        tmp_path = path.with_suffix(f".tmp{os.getpid()}.json")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+        self.loaded_mtime = path.stat().st_mtime
+
+    @classmethod
+    def load(cls, directory: pathlib.Path, name: str) -> "LabelSet":
+        path = cls.path(directory, name)
+        with open(path, "r", encoding="utf-8") as f:
+            definition = json.load(f)
+        label_set = cls(name, definition["labels"], definition.get("templates"), definition.get("prompts"))
+        label_set.loaded_mtime = path.stat().st_mtime
+        return label_set
+
+class LabelSetStore:
+    # Jak VectorIndexStore: definicje na dysku (wspólne dla workerów), macierze w pamięci procesu
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+        self._label_sets: Dict[str, LabelSet] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Optional[LabelSet]:
+        VectorIndexStore.validate_name(name)
+        with self._lock:
+            label_set = self._label_sets.get(name)
+            path = LabelSet.path(self.directory, name)
+            on_disk_mtime = path.stat().st_mtime if path.exists() else None
+            if on_disk_mtime is not None and (label_set is None or label_set.loaded_mtime != on_disk_mtime):
+                label_set = LabelSet.load(self.directory, name)
+                self._label_sets[name] = label_set
+            elif on_disk_mtime is None and label_set is not None: # Usunięty przez inny worker
+                self._label_sets.pop(name, None)
+                label_set = None
+            return label_set
+
+    def put(self, label_set: LabelSet):
+        VectorIndexStore.validate_name(label_set.name)
+        label_set.save(self.directory)
+        with self._lock:
+            self._label_sets[label_set.name] = label_set
+
+    def delete(self, name: str) -> bool:
+        VectorIndexStore.validate_name(name)
+        with self._lock:
+            existed = self._label_sets.pop(name, None) is not None
+            path = LabelSet.path(self.directory, name)
+            if path.exists():
+                path.unlink()
+                existed = True
+            return existed
+
+    def list_names(self) -> List[str]:
+        with self._lock:
+            names = set(self._label_sets)
+            if self.directory.exists():
+                names.update(path.name[:-len(".labels.json")] for path in self.directory.glob("*.labels.json"))
+            return sorted(names)
+
+def score_labels(image_embeddings: np.ndarray, label_matrix: np.ndarray, top_k: int,
+                 logit_scale: float = 100.0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Jedno mnożenie macierzy dla całej partii: podobieństwa kosinusowe, prawdopodobieństwa softmax
+    # (skala logitów jak w CLIP) i indeksy top-k etykiet posortowane malejąco
+    scores = normalize_rows(image_embeddings) @ label_matrix.T
+    logits = scores * logit_scale
+    probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+    top_k = min(top_k, label_matrix.shape[0])
+    top_indices = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    order = np.argsort(-np.take_along_axis(scores, top_indices, axis=1), axis=1)
+    return scores, probabilities, np.take_along_axis(top_indices, order, axis=1)
+
+# --- Kompaktowe wektory (projekcja PCA, kwantyzacja int8 i PQ) ---
+# Typy elementów zwracanych wektorów: int8 = kody skalarne, pq = jeden bajt (indeks centroidu) na podwektor
+EMBEDDING_OUTPUT_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8, "pq": np.uint8}
+# Kody int8 i PQ wymagają projekcji - skala int8 i książki kodów PQ są dopasowane na próbce razem z PCA
+QUANTIZED_OUTPUT_DTYPES = ("int8", "pq")
+PQ_CENTROIDS = 256
+PROJECTION_MIN_SAMPLE = 32
+# Od tej liczby wektorów recall liczony jest na odłożonej części próbki (20%), poniżej - na próbce treningowej
+PROJECTION_HOLDOUT_MIN_SAMPLE = 200
+
+def nearest_euclidean(matrix: np.ndarray, centroids: np.ndarray, block_rows: int = 16384) -> np.ndarray:
+    # Najbliższy centroid w odległości euklidesowej: ||x||^2 - 2x.c + ||c||^2, bez ||x||^2 (nie zmienia argmin)
+    centroid_norms = np.sum(centroids ** 2, axis=1)
+    assignments = np.empty(matrix.shape[0], dtype=np.int64)
+    for start in range(0, matrix.shape[0], block_rows):
+        scores = centroid_norms[None, :] - 2.0 * (matrix[start:start + block_rows] @ centroids.T)
+        assignments[start:start + block_rows] = np.argmin(scores, axis=1)
+    return assignments
+
+def euclidean_kmeans(matrix: np.ndarray, k: int, iterations: int = 20, seed: int = 0) -> np.ndarray:
+    # Lloyd w odległości euklidesowej - książki kodów PQ (podwektory nie są znormalizowane, więc nie spherical_kmeans)
+    rng = np.random.default_rng(seed)
+    k = min(k, matrix.shape[0])
+    centroids = np.array(matrix[rng.choice(matrix.shape[0], size=k, replace=False)], dtype=np.float32)
+    for _ in range(iterations):
+        assignments = nearest_euclidean(matrix, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, matrix)
+        updated = centroids.copy()
+        nonempty = counts > 0
+        updated[nonempty] = sums[nonempty] / counts[nonempty, None]
+        empty = np.flatnonzero(~nonempty)
+        if len(empty): # Puste centroidy dostają losowy punkt
+            updated[empty] = matrix[rng.choice(matrix.shape[0], size=len(empty), replace=False)]
+        converged = np.allclose(updated, centroids, atol=1e-6)
+        centroids = updated
+        if converged:
+            break
+    return centroids
+
+def recall_at_k(true_rows: np.ndarray, approximate_rows: np.ndarray) -> float:
+    k = true_rows.shape[1]
+    return float(np.mean([len(np.intersect1d(truth, approximate)) / k for truth, approximate in zip(true_rows, approximate_rows)]))
+
+class EmbeddingProjection:
+    # Nazwana projekcja dopasowana na próbce wektorów jednego modelu: PCA bez centrowania (najlepsze przybliżenie
+    # iloczynów skalarnych znormalizowanych wektorów, więc cosinus pozostaje miarą podobieństwa), globalna skala int8
+    # (iloczyn kodów int8 jest proporcjonalny do iloczynu wektorów) i książki kodów PQ (256 centroidów na podwektor).
+    # Wyjście projekcji jest zawsze znormalizowane. Zapisywana jako jeden plik .npz (wspólny dla workerów).
+    def __init__(self, name: str, model_key: str, input_dim: int, components: Optional[np.ndarray], int8_scale: float,
+                 pq_codebooks: np.ndarray, report: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.model_key = model_key
+        self.input_dim = input_dim
+        self.components = components # (dim, input_dim) albo None = bez redukcji wymiaru
+        self.int8_scale = int8_scale
+        self.pq_codebooks = pq_codebooks # (podwektory, centroidy, wymiar podwektora)
+        self.report = report or {}
+        self.loaded_mtime: Optional[float] = None
+
+    @property
+    def output_dim(self) -> int:
+        return self.components.shape[0] if self.components is not None else self.input_dim
+
+    @property
+    def pq_subvectors(self) -> int:
+        return self.pq_codebooks.shape[0]
+
+    def project(self, matrix: np.ndarray) -> np.ndarray:
+        matrix = normalize_rows(matrix)
+        if matrix.shape[1] != self.input_dim:
+            raise ValueError(f"Projekcja '{self.name}' oczekuje wektorów o wymiarze {self.input_dim}, otrzymano {matrix.shape[1]}.")
+        if self.components is not None:
+            matrix = normalize_rows(matrix @ self.components.T)
+        return matrix
+
+    def quantize_int8(self, projected: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(projected / self.int8_scale), -127, 127).astype(np.int8)
+
+    def dequantize_int8(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.int8_scale
+
+    def encode_pq(self, projected: np.ndarray) -> np.ndarray:
+        sub_dim = self.output_dim // self.pq_subvectors
+        codes = np.empty((projected.shape[0], self.pq_subvectors), dtype=np.uint8)
+        for subvector, codebook in enumerate(self.pq_codebooks):
+            codes[:, subvector] = nearest_euclidean(projected[:, subvector * sub_dim:(subvector + 1) * sub_dim], codebook)
+        return codes
+
+    def decode_pq(self, codes: np.ndarray) -> np.ndarray:
+        return np.concatenate([codebook[codes[:, subvector]] for subvector, codebook in enumerate(self.pq_codebooks)], axis=1)
+
+    @classmethod
+    def fit(cls, name: str, model_key: str, sample: np.ndarray, dim: Optional[int] = None, pq_subvectors: Optional[int] = None,
+            recall_k: int = 10, seed: int = 0) -> "EmbeddingProjection":
+        sample = normalize_rows(sample)
+        count, input_dim = sample.shape
+        if count < PROJECTION_MIN_SAMPLE:
+            raise ValueError(f"Za mała próbka: {count} wektorów, potrzeba co najmniej {PROJECTION_MIN_SAMPLE}.")
+        dim = input_dim if dim is None else dim
+        if dim > input_dim:
+            raise ValueError(f"Wymiar projekcji {dim} jest większy niż wymiar wektorów modelu ({input_dim}).")
+        pq_subvectors = pq_subvectors or max(1, dim // 4)
+        if pq_subvectors > dim or dim % pq_subvectors:
+            raise ValueError(f"Wymiar {dim} musi być podzielny przez liczbę podwektorów PQ ({pq_subvectors}).")
+        order = np.random.default_rng(seed).permutation(count)
+        holdout_count = count // 5 if count >= PROJECTION_HOLDOUT_MIN_SAMPLE else 0
+        train = sample[order[holdout_count:]]
+        evaluation = sample[order[:holdout_count]] if holdout_count else train
+
+        components = None
+        report: Dict[str, Any] = {"sample": count, "train": train.shape[0], "evaluation": "holdout" if holdout_count else "in_sample"}
+        if dim < input_dim:
+            # Wektory własne macierzy drugich momentów (d x d) - taniej niż SVD całej próbki przy count >> d
+            eigenvalues, eigenvectors = np.linalg.eigh(train.T.astype(np.float64) @ train)
+            top = np.argsort(eigenvalues)[::-1][:dim]
+            components = np.ascontiguousarray(eigenvectors[:, top].T, dtype=np.float32)
+            report["explained_energy"] = float(np.sum(eigenvalues[top]) / max(np.sum(eigenvalues), 1e-12))
+        projection = cls(name, model_key, input_dim, components, 1.0, np.empty((pq_subvectors, 0, dim // pq_subvectors), dtype=np.float32))
+        projected_train = projection.project(train)
+        # Percentyl zamiast maksimum: pojedyncze skrajne składowe nie marnują zakresu kodów
+        projection.int8_scale = max(float(np.percentile(np.abs(projected_train), 99.99)), 1e-6) / 127.0
+        sub_dim = dim // pq_subvectors
+        projection.pq_codebooks = np.stack([euclidean_kmeans(projected_train[:, subvector * sub_dim:(subvector + 1) * sub_dim], PQ_CENTROIDS, seed=seed + subvector)
+                                            for subvector in range(pq_subvectors)])
+        report.update(projection.evaluate(evaluation, recall_k, seed))
+        projection.report = report
+        return projection
+
+    def evaluate(self, matrix: np.ndarray, k: int = 10, seed: int = 0, max_queries: int = 256) -> Dict[str, Any]:
+        # Recall@k względem pełnych wektorów: k najbliższych sąsiadów (bez samego zapytania) w postaci skompresowanej
+        # vs w pełnym float32. PQ liczone asymetrycznie: zapytanie po projekcji vs wektory odtworzone z kodów.
+        matrix = normalize_rows(matrix)
+        k = min(k, matrix.shape[0] - 1)
+        if k < 1:
+            return {}
+        query_rows = np.random.default_rng(seed).choice(matrix.shape[0], size=min(max_queries, matrix.shape[0]), replace=False)
+
+        def neighbours(queries: np.ndarray, database: np.ndarray) -> np.ndarray:
+            scores = queries @ database.T
+            scores[np.arange(len(query_rows)), query_rows] = -np.inf
+            return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+        truth = neighbours(matrix[query_rows], matrix)
+        projected = self.project(matrix)
+        int8_vectors = normalize_rows(self.dequantize_int8(self.quantize_int8(projected)))
+        pq_vectors = self.decode_pq(self.encode_pq(projected))
+        return {"recall_k": k, "queries": len(query_rows), "database": matrix.shape[0], "recall": {
+            "float": recall_at_k(truth, neighbours(projected[query_rows], projected)),
+            "int8": recall_at_k(truth, neighbours(int8_vectors[query_rows], int8_vectors)),
+            "pq": recall_at_k(truth, neighbours(projected[query_rows], pq_vectors)),
+        }}
+
+    def describe(self) -> Dict[str, Any]:
+        dim = self.output_dim
+        return {"name": self.name, "model": self.model_key, "input_dim": self.input_dim, "dim": dim, "pq_subvectors": self.pq_subvectors,
+                "int8_scale": self.int8_scale, "bytes_per_vector": {"full_float32": 4 * self.input_dim, "float32": 4 * dim,
+                                                                    "float16": 2 * dim, "int8": dim, "pq": self.pq_subvectors},
+                "report": self.report}
+
+    @staticmethod
+    def path(directory: pathlib.Path, name: str) -> pathlib.Path:
+        return directory / f"{name}.projection.npz"
+
+    def save(self, directory: pathlib.Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(directory, self.name)
+        tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}")
+        meta = {"name": self.name, "model": self.model_key, "input_dim": self.input_dim, "int8_scale": self.int8_scale, "report": self.report}
+        components = self.components if self.components is not None else np.empty((0, self.input_dim), dtype=np.float32)
+        with open(tmp_path, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta, ensure_ascii=False)), components=components, pq_codebooks=self.pq_codebooks)
+        os.replace(tmp_path, path)
+        self.loaded_mtime = path.stat().st_mtime
+
+    @classmethod
+    def load(cls, directory: pathlib.Path, name: str) -> "EmbeddingProjection":
+        path = cls.path(directory, name)
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            components = data["components"] if data["components"].shape[0] else None
+            projection = cls(name, meta["model"], meta["input_dim"], components, meta["int8_scale"], data["pq_codebooks"], meta.get("report"))
+        projection.loaded_mtime = path.stat().st_mtime
+        return projection
+
+class ProjectionStore:
+    # Jak LabelSetStore: pliki na dysku (wspólne dla workerów), wczytane projekcje w pamięci procesu
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+        self._projections: Dict[str, EmbeddingProjection] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Optional[EmbeddingProjection]:
+        VectorIndexStore.validate_name(name)
+        with self._lock:
+            projection = self._projections.get(name)
+            path = EmbeddingProjection.path(self.directory, name)
+            on_disk_mtime = path.stat().st_mtime if path.exists() else None
+            if on_disk_mtime is not None and (projection is None or projection.loaded_mtime != on_disk_mtime):
+                projection = EmbeddingProjection.load(self.directory, name)
+                self._projections[name] = projection
+            elif on_disk_mtime is None and projection is not None: # Usunięta przez inny worker
+                self._projections.pop(name, None)
+                projection = None
+            return projection
+
+    def put(self, projection: EmbeddingProjection):
+        VectorIndexStore.validate_name(projection.name)
+        projection.save(self.directory)
+        with self._lock:
+            self._projections[projection.name] = projection
+
+    def delete(self, name: str) -> bool:
+        VectorIndexStore.validate_name(name)
+        with self._lock:
+            existed = self._projections.pop(name, None) is not None
+            path = EmbeddingProjection.path(self.directory, name)
+            if path.exists():
+                path.unlink()
+                existed = True
+            return existed
+
+    def list_names(self) -> List[str]:
+        with self._lock:
+            names = set(self._projections)
+            if self.directory.exists():
+                names.update(path.name[:-len(".projection.npz")] for path in self.directory.glob("*.projection.npz"))
+            return sorted(names)
+
+class EmbeddingOutput:
+    # Postać zwracanych wektorów: bez opcji - surowe float32/float16 jak dotąd; normalize - wiersze o długości 1;
+    # projekcja - znormalizowane wektory po PCA, opcjonalnie jako kody int8 albo PQ
+    def __init__(self, dtype: str = "float32", normalize: bool = False, projection: Optional[EmbeddingProjection] = None):
+        self.dtype = dtype
+        self.normalize = normalize
+        self.projection = projection
+
+    @property
+    def is_default(self) -> bool:
+        return not self.normalize and self.projection is None
+
+    def apply(self, embeddings: np.ndarray) -> np.ndarray:
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.size == 0:
+            return np.empty((0, 0), dtype=EMBEDDING_OUTPUT_DTYPES[self.dtype])
+        matrix = np.atleast_2d(matrix)
+        if self.projection is None:
+            return normalize_rows(matrix) if self.normalize else matrix
+        projected = self.projection.project(matrix)
+        if self.dtype == "int8":
+            return self.projection.quantize_int8(projected)
+        if self.dtype == "pq":
+            return self.projection.encode_pq(projected)
+        return projected
+
+    def describe(self) -> Dict[str, Any]:
+        description: Dict[str, Any] = {"dtype": self.dtype, "normalized": True}
+        if self.projection is not None:
+            description.update({"projection": self.projection.name, "dim": self.projection.output_dim})
+            if self.dtype == "int8":
+                description["int8_scale"] = self.projection.int8_scale
+            elif self.dtype == "pq":
+                description["pq_subvectors"] = self.projection.pq_subvectors
+        return description
+
+# --- Mikro-batching żądań ---
+class _PendingItem:
+    __slots__ = ("payload", "future", "enqueued_at", "timings")
+
+    def __init__(self, payload: Any, future: asyncio.Future, enqueued_at: float, timings: Optional[RequestTimings] = None):
+        self.payload = payload
+        self.future = future
+        self.enqueued_at = enqueued_at
+        self.timings = timings
+
+class MicroBatcher:
+    # Zbiera współbieżne pojedyncze żądania w partie (limit rozmiaru + limit czasu oczekiwania najstarszego elementu)
+    # i wykonuje jedno wywołanie process_batch na partię w executorze, poza pętlą zdarzeń.
+    # process_batch zwraca listę wyników tej samej długości co wejście; element będący wyjątkiem
+    # trafia tylko do żądania, którego dotyczy.
+    def __init__(self, name: str, process_batch: Callable[[List[Any]], List[Union[np.ndarray, Exception]]],
+                 executor: ThreadPoolExecutor, max_batch_size: int = BATCH_MAX_SIZE, max_wait_ms: float = BATCH_MAX_WAIT_MS):
+        self.name = name
+        self.process_batch = process_batch
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_s = max(0.0, max_wait_ms) / 1000.0
+        self._pending: Deque[_PendingItem] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker_task: Optional[asyncio.Task] = None
+        self._retired = False
+        # Statystyki
+        self.submitted_total = 0
+        self.processed_total = 0
+        self.failed_total = 0
+        self.cancelled_total = 0
+        self.batches_total = 0
+        self.max_queue_depth = 0
+        self.last_batch_size = 0
+        self.batch_size_histogram: Dict[int, int] = {}
+        self.total_queue_wait_s = 0.0
+        self.total_batch_run_s = 0.0
+
+    def start(self):
+        if self._worker_task is None:
+            self._wakeup = asyncio.Event()
+            self._worker_task = asyncio.get_running_loop().create_task(self._run(), name=f"micro-batcher-{self.name}")
+            logger.info(f"MicroBatcher '{self.name}' uruchomiony (max_batch_size={self.max_batch_size}, max_wait_ms={self.max_wait_s * 1000:.1f}).")
+
+    def retire(self):
+        # Model usunięty z rejestru: worker kończy pracę po opróżnieniu kolejki (spóźnione żądanie uruchomi go ponownie)
+        self._retired = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        if self._worker_task is not None:
+            self._worker_task.cancel()
+            try:
+                await self._worker_task
+            except asyncio.CancelledError:
+                pass
+            self._worker_task = None
+        while self._pending:
+            item = self._pending.popleft()
+            if not item.future.done():
+                item.future.set_exception(RuntimeError(f"MicroBatcher '{self.name}' został zatrzymany."))
+
+    async def submit(self, payload: Any) -> np.ndarray:
+        if self._worker_task is None:
+            if not self._retired:
+                raise RuntimeError(f"MicroBatcher '{self.name}' nie jest uruchomiony.")
+            self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(_PendingItem(payload, future, loop.time(), _request_timings.get()))
+        self.submitted_total += 1
+        self.max_queue_depth = max(self.max_queue_depth, len(self._pending))
+        self._wakeup.set()
+        ticket = _request_ticket.get()
+        return await (ticket.guard(future) if ticket is not None else future)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._pending:
+                if self._retired:
+                    self._worker_task = None
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            # Czekaj na kolejne elementy, aż partia się zapełni lub minie termin najstarszego elementu
+            deadline = self._pending[0].enqueued_at + self.max_wait_s
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            batch: List[_PendingItem] = []
+            while self._pending and len(batch) < self.max_batch_size:
+                item = self._pending.popleft()
+                if item.future.done(): # Klient zrezygnował z wyniku - nie liczymy go
+                    self._count("cancelled")
+                    continue
+                batch.append(item)
+            if not batch:
+                continue
+
+            started_at = loop.time()
+            for item in batch:
+                queue_wait_s = started_at - item.enqueued_at
+                self.total_queue_wait_s += queue_wait_s
+                metrics.observe("clip_stage_duration_seconds", queue_wait_s, {"stage": "queue"})
+                if item.timings is not None:
+                    item.timings.add("queue", queue_wait_s)
+            metrics.observe("clip_microbatch_size", len(batch), {"batcher": self.name})
+            try:
+                results = await loop.run_in_executor(self.executor, _call_profiled, self.process_batch, [item.payload for item in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"process_batch zwrócił {len(results)} wyników dla partii {len(batch)} elementów.")
+            except Exception as e_batch:
+                logger.error(f"MicroBatcher '{self.name}': błąd przetwarzania partii ({len(batch)} el.): {e_batch}", exc_info=True)
+                results = [e_batch] * len(batch)
+
+            batch_run_s = loop.time() - started_at
+            self.batches_total += 1
+            self.last_batch_size = len(batch)
+            self.batch_size_histogram[len(batch)] = self.batch_size_histogram.get(len(batch), 0) + 1
+            self.total_batch_run_s += batch_run_s
+            for item, result in zip(batch, results):
+                if item.timings is not None: # Partia jest wspólna - każde żądanie widzi pełny czas jej wykonania
+                    item.timings.add("batch", batch_run_s)
+                if item.future.done():
+                    self._count("cancelled")
+                    continue
+                if isinstance(result, Exception):
+                    self._count("failed")
+                    item.future.set_exception(result)
+                else:
+                    self._count("processed")
+                    item.future.set_result(result)
+
+    def _count(self, result: str):
+        # Licznik batchera (stats()) i licznik w rejestrze metryk - ten drugi przeżywa usunięcie modelu z pamięci
+        setattr(self, f"{result}_total", getattr(self, f"{result}_total") + 1)
+        metrics.inc("clip_microbatch_items_total", {"batcher": self.name, "result": result})
+
+    def stats(self) -> Dict[str, Any]:
+        completed = self.processed_total + self.failed_total
+        return {
+            "queue_depth": len(self._pending),
+            "max_queue_depth": self.max_queue_depth,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_s * 1000.0,
+            "submitted_total": self.submitted_total,
+            "processed_total": self.processed_total,
+            "failed_total": self.failed_total,
+            "cancelled_total": self.cancelled_total,
+            "batches_total": self.batches_total,
+            "last_batch_size": self.last_batch_size,
+            "avg_batch_size": (completed / self.batches_total) if self.batches_total else 0.0,
+            "avg_queue_wait_ms": (self.total_queue_wait_s * 1000.0 / completed) if completed else 0.0,
+            "avg_batch_run_ms": (self.total_batch_run_s * 1000.0 / self.batches_total) if self.batches_total else 0.0,
+            "batch_size_histogram": {str(size): count for size, count in sorted(self.batch_size_histogram.items())},
+        }
+
+def _process_image_batch(batch_embedder: CLIPImageEmbedder, prepared_images: List[_PreparedImage]) -> List[Union[np.ndarray, Exception]]:
+    # Obrazy są już zdekodowane w puli dekodującej (błędy plików trafiają tylko do swoich żądań)
+    embeddings = batch_embedder._embed_prepared_images(prepared_images)
+    return [embeddings[row] for row in range(len(prepared_images))]
+
+def _process_text_batch(batch_embedder: CLIPImageEmbedder, texts: List[str]) -> List[Union[np.ndarray, Exception]]:
+    embeddings = batch_embedder.get_text_embeddings_batch(texts)
+    return [embeddings[row] for row in range(len(texts))]
+
+# --- Rejestr modeli ---
+class LoadedModel:
+    # Załadowany model: embedder, jego mikro-batchery i statystyki użycia
+    def __init__(self, key: str, model_embedder: CLIPImageEmbedder, executor: ThreadPoolExecutor, pinned: bool = False,
+                 load_seconds: float = 0.0, batcher_suffix: str = ""):
+        self.key = key
+        self.embedder = model_embedder
+        self.pinned = pinned
+        self.load_seconds = load_seconds
+        self.estimated_bytes = 0 if model_embedder.inference_client else CLIPImageEmbedder.estimate_model_bytes(model_embedder.model_id, model_embedder.model_variant)
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.requests = 0
+        self.image_batcher = MicroBatcher(f"image{batcher_suffix}", functools.partial(_process_image_batch, model_embedder), executor)
+        self.text_batcher = MicroBatcher(f"text{batcher_suffix}", functools.partial(_process_text_batch, model_embedder), executor)
+
+    def start(self):
+        self.image_batcher.start()
+        self.text_batcher.start()
+
+    def retire(self):
+        self.image_batcher.retire()
+        self.text_batcher.retire()
+
+    async def stop(self):
+        await self.image_batcher.stop()
+        await self.text_batcher.stop()
+
+    def touch(self):
+        self.requests += 1
+        self.last_used = time.time()
+        metrics.inc("clip_model_requests_total", {"model": self.key})
+
+    def describe(self) -> Dict[str, Any]:
+        model_embedder = self.embedder
+        return {
+            "model": self.key, "model_id": model_embedder.model_id, "model_variant": model_embedder.model_variant,
+            "status": "warm", "pinned": self.pinned, "requests": self.requests,
+            "loaded_at": self.loaded_at, "last_used": self.last_used, "load_seconds": round(self.load_seconds, 3),
+            "estimated_mb": round(self.estimated_bytes / 1048576, 1), "effective_device": model_embedder.effective_device,
+            "provider": getattr(model_embedder, "active_provider", None) or ("remote" if model_embedder.inference_client else None),
+            "startup_timings": model_embedder.startup_timings,
+            "batching": {"image": self.image_batcher.stats(), "text": self.text_batcher.stats()},
+        }
+
+class ModelRegistry:
+    # Modele tego procesu kluczowane jak cache embeddingów ("model_id" dla fp32, "model_id@wariant" dla pozostałych).
+    # Wszystkie zmiany rejestru odbywają się w pętli zdarzeń; ładowanie sesji (eksport/znacznik/blokada jak przy
+    # starcie) idzie w puli wątków, a równoległe żądania o ten sam model czekają na jedno ładowanie.
+    # Usunięty model kończy obsługę już przyjętych żądań - pamięć zwalnia się, gdy ostatnie z nich się zakończy.
+    # Ze wspólnym procesem inferencji (CLIP_INFERENCE_HOST) dostępny jest tylko jego model: ładowanie innych w każdym
+    # workerze HTTP przywróciłoby wzrost pamięci z liczbą workerów, przed którym ten tryb chroni.
+    def __init__(self, max_models: int = MAX_LOADED_MODELS, memory_budget_mb: int = MODEL_MEMORY_BUDGET_MB,
+                 allowed_models: Optional[List[str]] = None):
+        self.max_models = max_models
+        self.memory_budget_bytes = memory_budget_mb * 1024 * 1024
+        self.allowed_models = ALLOWED_MODELS if allowed_models is None else allowed_models
+        self.default_key: Optional[str] = None
+        self._entries: "OrderedDict[str, LoadedModel]" = OrderedDict()
+        self._load_locks: Dict[str, asyncio.Lock] = {}
+        self._unloaded: Dict[str, Dict[str, Any]] = {}
+        self.loads_total = 0
+        self.load_failures_total = 0
+        self.evictions_total = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @staticmethod
+    def model_key(model_id: str, model_variant: str) -> str:
+        return model_id if model_variant == "fp32" else f"{model_id}@{model_variant}"
+
+    @staticmethod
+    def parse_model_name(name: str) -> Tuple[str, str]:
+        model_id, _, model_variant = name.strip().partition("@")
+        model_variant = (model_variant or MODEL_VARIANT).lower()
+        parts = model_id.split("/")
+        if not model_id or "\\" in model_id or any(not part or part in (".", "..") for part in parts) \
+                or not all(ch.isalnum() or ch in "-_./" for ch in model_id):
+            raise ValueError(f"Nieprawidłowy identyfikator modelu '{name}'.")
+        if model_variant not in MODEL_VARIANTS:
+            raise ValueError(f"Nieznany wariant modelu '{model_variant}'. Dostępne: {list(MODEL_VARIANTS)}")
+        return model_id, model_variant
+
+    def validate_key(self, name: str) -> str:
+        # Kanoniczny klucz modelu dla nazwy podanej przez klienta, bez ładowania modelu (ValueError / PermissionError)
+        model_id, model_variant = self.parse_model_name(name)
+        self._check_allowed(model_id)
+        return self.model_key(model_id, model_variant)
+
+    def _check_allowed(self, model_id: str):
+        if model_id == DEFAULT_MODEL_ID or "*" in self.allowed_models or model_id in self.allowed_models:
+            return
+        if (CLIPImageEmbedder._local_model_path(model_id) / MODEL_VARIANTS["fp32"][1]).exists():
+            return
+        raise PermissionError(f"Model '{model_id}' nie jest dozwolony (CLIP_ALLOWED_MODELS) ani wyeksportowany lokalnie.")
+
+    def register_default(self, model_embedder: CLIPImageEmbedder, executor: ThreadPoolExecutor, load_seconds: float) -> LoadedModel:
+        entry = LoadedModel(self.model_key(model_embedder.model_id, model_embedder.model_variant), model_embedder, executor,
+                            pinned=True, load_seconds=load_seconds)
+        self.default_key = entry.key
+        self._entries[entry.key] = entry
+        entry.start()
+        return entry
+
+    def get_default(self) -> Optional[LoadedModel]:
+        return self._entries.get(self.default_key) if self.default_key else None
+
+    async def acquire(self, name: Optional[str] = None) -> Optional[LoadedModel]:
+        if not name:
+            entry = self.get_default()
+        else:
+            model_id, model_variant = self.parse_model_name(name)
+            key = self.model_key(model_id, model_variant)
+            entry = self._entries.get(key) or await self._load(key, model_id, model_variant)
+        if entry is not None:
+            if entry.key in self._entries:
+                self._entries.move_to_end(entry.key)
+            entry.touch()
+        return entry
+
+    def _model_executor(self) -> ThreadPoolExecutor:
+        # Wątki mikro-batcherów modeli ładowanych na żądanie - własne rejestru, niezależne od startu modelu domyślnego
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix="clip-model-inference")
+        return self._executor
+
+    async def _load(self, key: str, model_id: str, model_variant: str) -> LoadedModel:
+        if INFERENCE_HOST_ADDRESS:
+            raise PermissionError(f"Model '{key}' nie jest dostępny we wspólnym procesie inferencji ({INFERENCE_HOST_ADDRESS}) - "
+                                  f"obsługuje on tylko model domyślny '{self.default_key}'.")
+        self._check_allowed(model_id)
+        lock = self._load_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry
+            self._evict_for(CLIPImageEmbedder.estimate_model_bytes(model_id, model_variant), keep=None)
+            logger.info(f"Ładowanie modelu '{key}' na żądanie...")
+            started = time.perf_counter()
+            try:
+                model_embedder = await run_in_threadpool(CLIPImageEmbedder, model_id=model_id, model_variant=model_variant,
+                                                         embedding_cache=embedding_cache, text_cache=text_cache)
+                if not model_embedder.is_ready():
+                    raise RuntimeError(f"Model '{key}' nie został w pełni zainicjalizowany. Sprawdź logi.")
+            except Exception:
+                self.load_failures_total += 1
+                raise
+            entry = LoadedModel(key, model_embedder, self._model_executor(), load_seconds=time.perf_counter() - started, batcher_suffix=f"@{key}")
+            self._entries[key] = entry
+            self._unloaded.pop(key, None)
+            self.loads_total += 1
+            entry.start()
+            logger.info(f"Model '{key}' załadowany w {entry.load_seconds:.1f} s (~{entry.estimated_bytes / 1048576:.0f} MB).")
+            self._evict_for(0, keep=key)
+            return entry
+
+    def _evict_for(self, incoming_bytes: int, keep: Optional[str]):
+        incoming_count = 0 if keep else 1
+        while True:
+            total_bytes = sum(entry.estimated_bytes for entry in self._entries.values()) + incoming_bytes
+            over_count = len(self._entries) + incoming_count > self.max_models
+            over_budget = self.memory_budget_bytes > 0 and total_bytes > self.memory_budget_bytes
+            if not over_count and not over_budget:
+                return
+            candidate = next((entry for entry in self._entries.values() if not entry.pinned and entry.key != keep), None)
+            if candidate is None:
+                logger.warning(f"Limit modeli przekroczony ({len(self._entries) + incoming_count} modeli, {total_bytes / 1048576:.0f} MB), "
+                               f"ale nie ma modelu do usunięcia.")
+                return
+            self.unload(candidate.key)
+
+    def unload(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        if entry is None or entry.pinned:
+            return False
+        del self._entries[key]
+        entry.retire()
+        self._unloaded[key] = {**entry.describe(), "status": "cold", "unloaded_at": time.time(), "batching": None}
+        self.evictions_total += 1
+        logger.info(f"Usunięto model '{key}' z pamięci (ostatnie użycie {time.time() - entry.last_used:.0f} s temu, {entry.requests} żądań).")
+        return True
+
+    def loaded(self) -> List[LoadedModel]:
+        return list(self._entries.values())
+
+    async def close(self):
+        for entry in list(self._entries.values()):
+            await entry.stop()
+        self._entries.clear()
+        self.default_key = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def describe(self) -> Dict[str, Any]:
+        models = {key: entry.describe() for key, entry in self._entries.items()}
+        for key, info in self._unloaded.items():
+            models.setdefault(key, info)
+        # Modele wyeksportowane lokalnie albo dozwolone, ale jeszcze nieładowane (zimne)
+        candidates = [(model_id, "fp32") for model_id in self.allowed_models if model_id != "*"]
+        if LOCAL_MODELS_ROOT_DIR.exists():
+            for model_dir in LOCAL_MODELS_ROOT_DIR.iterdir():
+                for model_variant, (_, marker_name) in MODEL_VARIANTS.items():
+                    if (model_dir / marker_name).exists():
+                        candidates.append((model_dir.name.replace("_--_", "/"), model_variant))
+        for model_id, model_variant in candidates:
+            models.setdefault(self.model_key(model_id, model_variant), {"model": self.model_key(model_id, model_variant), "model_id": model_id,
+                                                                        "model_variant": model_variant, "status": "cold"})
+        return {
+            "default": self.default_key, "loaded": len(self._entries), "max_models": self.max_models,
+            "memory_budget_mb": self.memory_budget_bytes // 1048576,
+            "estimated_loaded_mb": round(sum(entry.estimated_bytes for entry in self._entries.values()) / 1048576, 1),
+            "loads_total": self.loads_total, "load_failures_total": self.load_failures_total, "evictions_total": self.evictions_total,
+            "models": models,
+        }
+
+# --- FastAPI app setup, endpoints, startup_event ---
+class MetricsMiddleware:
+    # Czas, status i liczba żądań w toku per szablon ścieżki; czasy etapów żądania trafiają do nagłówka Server-Timing
+    # (i logu DEBUG). Czysty middleware ASGI - bez narzutu BaseHTTPMiddleware i bez buforowania odpowiedzi strumieniowych.
+    _UNPROFILED_PREFIXES = ("/metrics", "/debug/")
+    ROUTE_LABEL_CACHE_SIZE = 4096
+
+    def __init__(self, app):
+        self.app = app
+        # (metoda, ścieżka) -> szablon ścieżki; etykieta jest potrzebna przed routingiem (licznik żądań w toku),
+        # więc zamiast skanować app.routes przy każdym żądaniu wynik dopasowania jest zapamiętywany (LRU - ścieżki
+        # z parametrami, np. /index/<nazwa>/search, i nieznane ścieżki nie mogą rozdmuchać słownika)
+        self._route_labels: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+
+    def _route_label(self, scope) -> str:
+        key = (scope["method"], scope["path"])
+        label = self._route_labels.get(key)
+        if label is not None:
+            self._route_labels.move_to_end(key)
+            return label
+        label = "unmatched" # Nieznane ścieżki nie mogą tworzyć nowych serii metryk
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                label = getattr(route, "path", "other")
+                break
+        self._route_labels[key] = label
+        if len(self._route_labels) > self.ROUTE_LABEL_CACHE_SIZE:
+            self._route_labels.popitem(last=False)
+        return label
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        endpoint = self._route_label(scope)
+        timings = RequestTimings()
+        token = _request_timings.set(timings)
+        started = time.perf_counter()
+        status_code = 500
+        metrics.inc("clip_requests_in_flight", {"endpoint": endpoint})
+
+        async def send_with_timings(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                server_timing = timings.server_timing(time.perf_counter() - started).encode("latin-1")
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", server_timing)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            elapsed_s = time.perf_counter() - started
+            _request_timings.reset(token)
+            metrics.inc("clip_requests_in_flight", {"endpoint": endpoint}, -1.0)
+            metrics.inc("clip_requests_total", {"endpoint": endpoint, "method": scope["method"], "status": status_code})
+            metrics.observe("clip_request_duration_seconds", elapsed_s, {"endpoint": endpoint})
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"{scope['method']} {endpoint} -> {status_code} w {elapsed_s * 1000.0:.1f} ms, etapy [ms]: "
+                             f"{ {stage: round(seconds * 1000.0, 2) for stage, seconds in timings.stages.items()} }")
+            if profiling_session is not None and not scope["path"].startswith(self._UNPROFILED_PREFIXES):
+                _finish_profiled_request()
+
+app = FastAPI()
+app.add_middleware(MetricsMiddleware)
+embedder: Optional[CLIPImageEmbedder] = None
+embedding_cache: Optional[EmbeddingCache] = None
+text_cache: Optional[TextEmbeddingCache] = None
+inference_executor: Optional[ThreadPoolExecutor] = None
+bulk_executor: Optional[ThreadPoolExecutor] = None
+image_batcher: Optional[MicroBatcher] = None
+text_batcher: Optional[MicroBatcher] = None
+model_registry = ModelRegistry()
+vector_index_store = VectorIndexStore(INDEX_DIR)
+label_set_store = LabelSetStore(LABEL_SETS_DIR)
+projection_store = ProjectionStore(PROJECTIONS_DIR)
+_index_save_handles: Dict[str, asyncio.TimerHandle] = {}
+startup_timings: Dict[str, float] = {}
+
+@app.on_event("startup")
+async def startup_event():
+    global embedder, embedding_cache, text_cache, inference_executor, bulk_executor, image_batcher, text_batcher
+    logger.info(f"Główny proces/worker (PID: {os.getpid()}): Uruchamianie serwera FastAPI, inicjalizacja CLIPImageEmbedder...")
+    startup_started = time.perf_counter()
+    if CACHE_ENABLED and embedding_cache is None:
+        try:
+            embedding_cache = EmbeddingCache(CACHE_DIR / "embeddings_cache.sqlite")
+        except Exception as e_cache:
+            logger.error(f"Nie udało się otworzyć cache embeddingów w '{CACHE_DIR}': {e_cache}. Kontynuuję bez cache.", exc_info=True)
+            embedding_cache = None
+    if text_cache is None and (TEXT_CACHE_ITEMS > 0 or (TEXT_CACHE_PERSIST and embedding_cache)):
+        text_cache = TextEmbeddingCache(TEXT_CACHE_ITEMS, embedding_cache if TEXT_CACHE_PERSIST else None)
+    try:
+        embedder_started = time.perf_counter()
+        # W puli wątków: eksport/ładowanie modelu albo oczekiwanie na proces inferencji (do CLIP_INFERENCE_HOST_TIMEOUT_S)
+        # nie blokuje pętli zdarzeń
+        embedder = await run_in_threadpool(CLIPImageEmbedder, embedding_cache=embedding_cache, inference_host=INFERENCE_HOST_ADDRESS,
+                                           text_cache=text_cache)
+        startup_timings["embedder"] = round(time.perf_counter() - embedder_started, 3)
+        if embedder and embedder.is_ready():
+             logger.info(f"CLIPImageEmbedder (PID: {os.getpid()}) zainicjalizowany pomyślnie. Używane urządzenie: {embedder.effective_device}")
+        else:
+             logger.critical(f"Nie udało się w pełni zainicjalizować embeddera (PID: {os.getpid()}).")
+             embedder = None
+    except Exception as e:
+        logger.critical(f"Krytyczny błąd podczas inicjalizacji CLIPImageEmbedder na starcie (PID: {os.getpid()}): {e}", exc_info=True)
+        embedder = None
+
+    if embedder:
+        inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix="clip-inference")
+        inference_gate.resize(INFERENCE_THREADS)
+        # Osobne wątki pasa masowego: długie partie nie zajmują kolejki executora, o kolejności wywołań ONNX decyduje inference_gate
+        bulk_executor = ThreadPoolExecutor(max_workers=BULK_CONCURRENCY, thread_name_prefix="clip-bulk")
+        default_model = model_registry.register_default(embedder, inference_executor, startup_timings["embedder"])
+        image_batcher, text_batcher = default_model.image_batcher, default_model.text_batcher
+    if PROFILE_STARTUP_REQUESTS and profiling_session is None:
+        try:
+            _start_profiling(ProfilingSession(PROFILE_STARTUP_REQUESTS, PROFILE_STARTUP_MODE))
+        except ValueError as e_profile:
+            logger.error(f"Nie uruchomiono profilowania z CLIP_PROFILE_REQUESTS: {e_profile}")
+    startup_timings["total"] = round(time.perf_counter() - startup_started, 3)
+    logger.info(f"Zakończono startup_event (PID: {os.getpid()}). Czasy startu [s]: {startup_timings}, "
+                f"fazy embeddera: {embedder.startup_timings if embedder else None}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    global inference_executor, bulk_executor, _decode_pool, embedding_cache, text_cache
+    await model_registry.close()
+    for handle in _index_save_handles.values():
+        handle.cancel()
+    _index_save_handles.clear()
+    try:
+        vector_index_store.save_dirty()
+    except Exception as e_save:
+        logger.error(f"Błąd zapisu indeksów wektorowych przy zamykaniu: {e_save}", exc_info=True)
+    if inference_executor:
+        inference_executor.shutdown(wait=False)
+        inference_executor = None
+    if bulk_executor:
+        bulk_executor.shutdown(wait=False)
+        bulk_executor = None
+    if _decode_pool:
+        _decode_pool.shutdown(wait=False)
+        _decode_pool = None
+    text_cache = None
+    if embedding_cache:
+        embedding_cache.close()
+        embedding_cache = None
+    if embedder and embedder.inference_client:
+        embedder.inference_client.close()
+    if profiling_session is not None:
+        _stop_profiling()
+
+async def _run_inference(func: Callable, *args) -> Any:
+    # Wywołania wsadowe też nie mogą blokować pętli zdarzeń (mikro-batcher działa w tej samej pętli)
+    ticket = _request_ticket.get()
+    executor = bulk_executor if ticket is not None and ticket.lane == LANE_BULK and bulk_executor is not None else inference_executor
+    return await asyncio.get_running_loop().run_in_executor(executor, _in_request_context(func, *args))
+
+async def _embed_single_image(model: LoadedModel, image_input: Union[str, bytes]) -> np.ndarray:
+    # Dekodowanie (i sprawdzenie cache) w puli dekodującej, potem wspólna partia ONNX w mikro-batcherze
+    prepared_image = await asyncio.get_running_loop().run_in_executor(get_decode_pool(), _in_request_context(model.embedder._prepare_image_item, image_input))
+    if prepared_image.embedding is not None:
+        return prepared_image.embedding
+    return await model.image_batcher.submit(prepared_image)
+
+async def _request_model(request: Request) -> LoadedModel:
+    # Model wskazany przez ?model=<id>[@wariant] lub nagłówek X-CLIP-Model; bez wskazania - model domyślny
+    requested = request.query_params.get("model") or request.headers.get("x-clip-model")
+    try:
+        model = await model_registry.acquire(requested)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except Exception as e:
+        logger.error(f"Nie udało się załadować modelu '{requested}': {e}", exc_info=True)
+        raise HTTPException(status_code=503, detail=f"Nie udało się załadować modelu '{requested}': {type(e).__name__} - {str(e)}")
+    if model is None or not model.embedder.is_ready():
+        raise HTTPException(status_code=503, detail="Embedder nie jest zainicjalizowany lub sesja ONNX nie została załadowana")
+    return model
+
+def describe_item_error(error: Exception) -> Dict[str, str]:
+    # Błąd pojedynczego elementu partii: kod dla klienta + typ i treść wyjątku
+    if isinstance(error, FileNotFoundError):
+        code = "not_found"
+    elif isinstance(error, PermissionError):
+        code = "access_denied"
+    elif isinstance(error, (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError)):
+        code = "decode_error" # PIL zgłasza uszkodzone pliki jako OSError/SyntaxError
+    elif isinstance(error, ValueError):
+        code = "invalid_input"
+    else:
+        code = "error"
+    return {"code": code, "type": type(error).__name__, "message": str(error)}
+
+def _split_item_results(endpoint: str, results: List[Union[np.ndarray, Exception]],
+                        paths: Optional[List[str]] = None) -> Tuple[List[int], List[Dict[str, Any]]]:
+    # Pozycje udanych elementów + lista błędów (z indeksem w żądaniu); pominięte elementy trafiają do licznika
+    valid_positions, errors = [], []
+    for position, result in enumerate(results):
+        if isinstance(result, Exception):
+            error = {"index": position, "path": paths[position] if paths else None, **describe_item_error(result)}
+            errors.append(error)
+            metrics.inc("clip_skipped_items_total", {"endpoint": endpoint, "code": error["code"]})
+        else:
+            valid_positions.append(position)
+    if errors:
+        logger.warning(f"{endpoint}: pominięto {len(errors)} z {len(results)} elementów (pierwszy błąd: {errors[0]['path']}: {errors[0]['message']})")
+    return valid_positions, errors
+
+# ... (reszta definicji modeli Pydantic i endpointów bez zmian)
+class ImagePathInput(BaseModel):
+    path: str = Field(..., example="C:\\Users\\Admin\\Pictures\\cosplay_image.jpg")
+
+class ImagePathsInput(BaseModel):
+    paths: List[str] = Field(..., example=["path/to/img1.jpg", "path/to/img2.png"])
+
+class TextIn(BaseModel):
+    text: str = Field(..., example="A beautiful cosplay photo.")
+
+class TextsIn(BaseModel):
+    texts: List[str] = Field(..., example=["cosplay", "character", "triss merigold"])
+
+class EmbeddingOutputInfo(BaseModel):
+    # Tylko przy ?normalize= lub ?projection= (kody int8 i PQ to liczby całkowite)
+    dtype: Optional[str] = None
+    normalized: Optional[bool] = None
+    projection: Optional[str] = None
+    dim: Optional[int] = None
+    int8_scale: Optional[float] = None
+    pq_subvectors: Optional[int] = None
+
+class CropEmbedding(BaseModel):
+    box: List[int] = Field(..., example=[0, 0, 1000, 1000]) # left, top, right, bottom w pikselach oryginału
+    embedding: List[float]
+
+class EmbeddingResponse(EmbeddingOutputInfo):
+    # W trybie wycinków (?crops=) 'embedding' to wektor zbiorczy, a wektory wycinków są w 'crops'
     embedding: List[float]
+    crops: Optional[List[CropEmbedding]] = None
+
+class ItemError(BaseModel):
+    index: int
+    path: Optional[str] = None
+    code: str = Field(..., example="not_found")
+    type: str
+    message: str
 
-class EmbeddingsResponse(BaseModel):
-    embeddings: List[List[float]]
+class EmbeddingsResponse(EmbeddingOutputInfo):
+    # Element, którego nie udało się przetworzyć, ma null w 'embeddings' i wpis w 'errors'
+    embeddings: List[Optional[List[float]]]
+    crops: Optional[List[Optional[List[CropEmbedding]]]] = None
+    errors: List[ItemError] = []
+    skipped: int = 0
 
 class ErrorResponse(BaseModel):
     detail: str
     type: Optional[str] = None 
 
+# --- Binarny format odpowiedzi z embeddingami (negocjacja przez nagłówek Accept) ---
+# application/octet-stream: nagłówek 16 B '<4sHHII' (magic b"CEMB", wersja, kod dtype, liczba wektorów, wymiar),
+#   potem wiersze little-endian bez separatorów.
+# application/x-npy: standardowy plik .npy (np.load po stronie klienta).
+# Typ elementów wybierany parametrem zapytania ?dtype=float32 (domyślnie), float16, int8 lub pq.
+# Kompaktowe wektory: ?normalize=1 (wiersze o długości 1), ?projection=<nazwa> (PCA dopasowane przez
+# POST /projections/<nazwa>, wynik znormalizowany), a z projekcją także ?dtype=int8 (kody skalarne, skala w polu
+# 'int8_scale' / nagłówku X-CLIP-Int8-Scale) i ?dtype=pq (jeden bajt na podwektor, książki kodów w /projections).
+# JSON pozostaje formatem domyślnym. W formatach binarnych wiersz pominiętego elementu partii jest zerowy,
+# a pozycje pominiętych elementów są w nagłówku X-CLIP-Skipped-Indices (szczegóły błędów tylko w JSON).
+SKIPPED_COUNT_HEADER = "X-CLIP-Skipped"
+SKIPPED_INDICES_HEADER = "X-CLIP-Skipped-Indices"
+PROJECTION_HEADER = "X-CLIP-Projection"
+INT8_SCALE_HEADER = "X-CLIP-Int8-Scale"
+BINARY_EMBEDDINGS_MEDIA_TYPE = "application/octet-stream"
+NPY_EMBEDDINGS_MEDIA_TYPE = "application/x-npy"
+BINARY_EMBEDDINGS_MAGIC = b"CEMB"
+BINARY_EMBEDDINGS_VERSION = 1
+BINARY_EMBEDDINGS_HEADER = struct.Struct("<4sHHII")
+BINARY_DTYPE_CODES = {"float32": 1, "float16": 2, "int8": 3, "pq": 4}
+_BINARY_DTYPES_BY_CODE = {code: np.dtype(EMBEDDING_OUTPUT_DTYPES[name]).newbyteorder("<") for name, code in BINARY_DTYPE_CODES.items()}
+
+def _embedding_rows(embeddings: np.ndarray) -> np.ndarray:
+    # Pojedynczy wektor -> jeden wiersz; pusta partia -> zero wierszy (np.atleast_2d zrobiłby z niej wiersz o wymiarze 0)
+    matrix = np.asarray(embeddings)
+    if matrix.size == 0:
+        return matrix.reshape(0, matrix.shape[-1] if matrix.ndim > 1 else 0)
+    return np.atleast_2d(matrix)
+
+def encode_embeddings_binary(embeddings: np.ndarray, dtype: str = "float32") -> bytes:
+    code = BINARY_DTYPE_CODES[dtype]
+    rows = np.ascontiguousarray(_embedding_rows(embeddings), dtype=_BINARY_DTYPES_BY_CODE[code])
+    header = BINARY_EMBEDDINGS_HEADER.pack(BINARY_EMBEDDINGS_MAGIC, BINARY_EMBEDDINGS_VERSION, code, rows.shape[0], rows.shape[1])
+    return header + rows.tobytes()
+
+def decode_embeddings_binary(payload: bytes) -> np.ndarray:
+    # Dekoder referencyjny (benchmarki, klienci w Pythonie)
+    magic, version, code, count, dim = BINARY_EMBEDDINGS_HEADER.unpack_from(payload, 0)
+    if magic != BINARY_EMBEDDINGS_MAGIC or version != BINARY_EMBEDDINGS_VERSION or code not in _BINARY_DTYPES_BY_CODE:
+        raise ValueError(f"Nieprawidłowy nagłówek binarnych embeddingów: magic={magic!r}, wersja={version}, dtype={code}")
+    return np.frombuffer(payload, dtype=_BINARY_DTYPES_BY_CODE[code], count=count * dim, offset=BINARY_EMBEDDINGS_HEADER.size).reshape(count, dim)
+
+def _get_projection_or_error(name: str) -> EmbeddingProjection:
+    try:
+        projection = projection_store.get(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if projection is None:
+        raise HTTPException(status_code=404, detail=f"Projekcja '{name}' nie istnieje.")
+    return projection
+
+def resolve_embedding_output(dtype: str, normalize: bool, projection_name: Optional[str], model: Optional[LoadedModel]) -> EmbeddingOutput:
+    dtype = dtype.lower()
+    if dtype not in BINARY_DTYPE_CODES:
+        raise HTTPException(status_code=400, detail=f"Nieobsługiwany dtype '{dtype}'. Dozwolone: {list(BINARY_DTYPE_CODES)}")
+    projection = None
+    if projection_name:
+        projection = _get_projection_or_error(projection_name)
+        if model is not None and projection.model_key != model.key:
+            raise HTTPException(status_code=400, detail=f"Projekcja '{projection_name}' została dopasowana dla modelu '{projection.model_key}', a żądanie używa '{model.key}'.")
+    elif dtype in QUANTIZED_OUTPUT_DTYPES:
+        raise HTTPException(status_code=400, detail=f"dtype '{dtype}' wymaga parametru projection (skala int8 i książki kodów PQ są dopasowywane na próbce przez POST /projections/<nazwa>).")
+    return EmbeddingOutput(dtype, normalize, projection)
+
+def _negotiate_embeddings_format(request: Request, model: Optional[LoadedModel] = None) -> Tuple[str, EmbeddingOutput]:
+    # Wywoływane przed inferencją - nieprawidłowy dtype/projekcja to 400 bez liczenia embeddingów
+    accept = request.headers.get("accept", "").lower()
+    if NPY_EMBEDDINGS_MEDIA_TYPE in accept:
+        response_format = "npy"
+    elif BINARY_EMBEDDINGS_MEDIA_TYPE in accept:
+        response_format = "binary"
+    else:
+        response_format = "json"
+    normalize = request.query_params.get("normalize", "").lower() in ("1", "true", "yes")
+    output = resolve_embedding_output(request.query_params.get("dtype", "float32"), normalize, request.query_params.get("projection"), model)
+    return response_format, output
+
+def _apply_embedding_output(output: EmbeddingOutput, embeddings: np.ndarray) -> np.ndarray:
+    try:
+        return output.apply(embeddings)
+    except ValueError as e: # Projekcja o innym wymiarze niż wektory modelu
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _embeddings_response(embedding_format: Tuple[str, EmbeddingOutput], embeddings: np.ndarray, single: bool = False) -> Response:
+    response_format, output = embedding_format
+    with stage_timer("serialize"):
+        return _encode_embeddings_response(embeddings, response_format, output, single)
+
+def _item_embeddings_response(embedding_format: Tuple[str, EmbeddingOutput], results: List[Union[np.ndarray, Exception]],
+                              valid_positions: List[int], errors: List[Dict[str, Any]]) -> Response:
+    response_format, output = embedding_format
+    with stage_timer("serialize"):
+        if not errors:
+            return _encode_embeddings_response(np.stack(results) if results else np.empty((0, 0), dtype=np.float32), response_format, output, False)
+        if response_format == "json":
+            embeddings: List[Optional[List[float]]] = [None] * len(results)
+            if valid_positions:
+                rows = _apply_embedding_output(output, np.stack([results[position] for position in valid_positions]))
+                for row, position in enumerate(valid_positions):
+                    embeddings[position] = rows[row].tolist()
+            content = {"embeddings": embeddings, "errors": errors, "skipped": len(errors)}
+            return JSONResponse(content=content if output.is_default else {**content, **output.describe()})
+        dim = np.asarray(results[valid_positions[0]]).shape[-1] if valid_positions else 0
+        matrix = np.zeros((len(results), dim), dtype=np.float32)
+        for position in valid_positions:
+            matrix[position] = results[position]
+        response = _encode_embeddings_response(matrix, response_format, output, False)
+        response.headers[SKIPPED_COUNT_HEADER] = str(len(errors))
+        response.headers[SKIPPED_INDICES_HEADER] = ",".join(str(error["index"]) for error in errors)
+        return response
+
+def _encode_embeddings_response(embeddings: np.ndarray, response_format: str, output: EmbeddingOutput, single: bool) -> Response:
+    rows = _apply_embedding_output(output, embeddings)
+    if response_format == "json":
+        # JSON (domyślnie) - ten sam kształt co EmbeddingResponse/EmbeddingsResponse, bez walidacji każdego floata przez Pydantic
+        content = {"embedding": rows.ravel().tolist()} if single else {"embeddings": rows.tolist()}
+        return JSONResponse(content=content if output.is_default else {**content, **output.describe()})
+    if response_format == "binary":
+        response = Response(content=encode_embeddings_binary(rows, output.dtype), media_type=BINARY_EMBEDDINGS_MEDIA_TYPE)
+    else:
+        buffer = BytesIO()
+        np.save(buffer, _embedding_rows(rows).astype(_BINARY_DTYPES_BY_CODE[BINARY_DTYPE_CODES[output.dtype]], copy=False), allow_pickle=False)
+        response = Response(content=buffer.getvalue(), media_type=NPY_EMBEDDINGS_MEDIA_TYPE)
+    if output.projection is not None:
+        response.headers[PROJECTION_HEADER] = output.projection.name
+        if output.dtype == "int8":
+            response.headers[INT8_SCALE_HEADER] = repr(output.projection.int8_scale)
+    return response
+
+# --- Tryb wielu wycinków (?crops=auto|grid) ---
+# ?crops=auto: kwadratowe okna w skalach ?scales=1,0.5 (ułamek krótszego boku); ?crops=grid: siatka ?grid=2x3.
+# ?overlap=0.25 - zakładka sąsiednich wycinków, ?include_center=0 - bez środkowego kadru zwykłego embeddingu.
+# JSON: wektor zbiorczy w 'embedding(s)' + 'crops' z prostokątem i wektorem każdego wycinka; formaty binarne
+# zawierają tylko wektory zbiorcze (jak szczegóły błędów - wycinki tylko w JSON).
+def _request_crop_spec(request: Request) -> Optional[CropSpec]:
+    params = request.query_params
+    if not params.get("crops"):
+        return None
+    try:
+        return CropSpec.parse(params["crops"], params.get("scales"), params.get("grid"), params.get("overlap"), params.get("include_center"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Nieprawidłowe parametry wycinków: {str(e)}")
+
+async def _embed_single_image_crops(model: LoadedModel, image_input: Union[str, bytes], crop_spec: CropSpec) -> CropEmbeddings:
+    result = (await _run_inference(model.embedder.get_image_crop_embeddings_isolated, [image_input], crop_spec))[0]
+    if isinstance(result, CropSpecError):
+        # Np. przekroczony limit wycinków dla tego obrazu - błąd parametrów, nie serwera
+        raise HTTPException(status_code=400, detail=f"Nieprawidłowe parametry wycinków: {str(result)}")
+    if isinstance(result, Exception):
+        raise result # Błędy odczytu/dekodowania obsługuje endpoint, tak jak bez wycinków
+    return result
+
+def _crop_embeddings_response(embedding_format: Tuple[str, EmbeddingOutput], crop_spec: CropSpec, results: List[Union[CropEmbeddings, Exception]],
+                              valid_positions: List[int], errors: List[Dict[str, Any]], single: bool = False) -> Response:
+    pooled_results = [result if isinstance(result, Exception) else result.pooled for result in results]
+    response_format, output = embedding_format
+    if response_format != "json":
+        if single:
+            return _embeddings_response(embedding_format, pooled_results[0], single=True)
+        return _item_embeddings_response(embedding_format, pooled_results, valid_positions, errors)
+    with stage_timer("serialize"):
+        embeddings: List[Optional[List[float]]] = [None] * len(results)
+        crops: List[Optional[List[Dict[str, Any]]]] = [None] * len(results)
+        if valid_positions:
+            pooled_rows = _apply_embedding_output(output, np.stack([pooled_results[position] for position in valid_positions]))
+            crop_rows = _apply_embedding_output(output, np.concatenate([results[position].embeddings for position in valid_positions]))
+            offset = 0
+            for row, position in enumerate(valid_positions):
+                embeddings[position] = pooled_rows[row].tolist()
+                crops[position] = [{"box": list(box), "embedding": crop_rows[offset + crop].tolist()} for crop, box in enumerate(results[position].boxes)]
+                offset += len(results[position].boxes)
+        if single:
+            content: Dict[str, Any] = {"embedding": embeddings[0], "crops": crops[0]}
+        else:
+            content = {"embeddings": embeddings, "crops": crops}
+            if errors:
+                content.update({"errors": errors, "skipped": len(errors)})
+        content["crop_spec"] = crop_spec.describe()
+        return JSONResponse(content=content if output.is_default else {**content, **output.describe()})
+
+_EMBEDDING_FORMAT_RESPONSES = {
+    200: {"content": {BINARY_EMBEDDINGS_MEDIA_TYPE: {}, NPY_EMBEDDINGS_MEDIA_TYPE: {}},
+          "description": "JSON (domyślnie) lub format binarny wybrany nagłówkiem Accept"},
+}
+
 @app.post("/get_image_embedding", 
           response_model=EmbeddingResponse,
           responses={
+              **_EMBEDDING_FORMAT_RESPONSES,
               503: {"model": ErrorResponse, "description": "Embedder nie jest zainicjalizowany"}, 
               404: {"model": ErrorResponse, "description": "Obraz nie znaleziony"}, 
+              422: {"model": ErrorResponse, "description": "Uszkodzony lub nieobsługiwany obraz"},
               500: {"model": ErrorResponse, "description": "Wewnętrzny błąd serwera"}
           })
-async def get_image_embedding_endpoint(data: ImagePathInput = Body(...)):
-    if not embedder or not embedder.ort_session: 
-        logger.error("Żądanie /get_image_embedding, ale embedder nie jest w pełni zainicjalizowany.")
-        raise HTTPException(status_code=503, detail="Embedder nie jest zainicjalizowany lub sesja ONNX nie została załadowana")
+async def get_image_embedding_endpoint(request: Request, data: ImagePathInput = Body(...), lane_ticket: LaneTicket = Depends(interactive_lane)):
+    model = await _request_model(request)
+    crop_spec = _request_crop_spec(request)
+    embedding_format = _negotiate_embeddings_format(request, model)
     try:
         # logger.info(f"Przetwarzanie obrazu ze ścieżki: {data.path}")
-        embedding = embedder.get_image_embedding(data.path)
-        return EmbeddingResponse(embedding=embedding.tolist())
+        if crop_spec is not None:
+            crop_embeddings = await _embed_single_image_crops(model, data.path, crop_spec)
+            return _crop_embeddings_response(embedding_format, crop_spec, [crop_embeddings], [0], [], single=True)
+        embedding = await _embed_single_image(model, data.path)
+        return _embeddings_response(embedding_format, embedding, single=True)
+    except HTTPException:
+        raise
     except FileNotFoundError:
         logger.warning(f"Nie znaleziono obrazu: {data.path}")
         raise HTTPException(status_code=404, detail=f"Obraz nie znaleziony: {data.path}")
+    except (UnidentifiedImageError, SyntaxError, OSError) as e:
+        logger.warning(f"Nie można odczytać obrazu {data.path}: {e}")
+        raise HTTPException(status_code=422, detail=f"Nie można odczytać obrazu {data.path}: {type(e).__name__} - {str(e)}")
     except Exception as e:
         logger.error(f"Wewnętrzny błąd serwera dla {data.path}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Wewnętrzny błąd serwera: {type(e).__name__} - {str(e)}")
 
-@app.post("/get_image_embedding_upload", response_model=EmbeddingResponse)
-async def get_image_embedding_upload_endpoint(file: UploadFile = File(...)):
-    if not embedder or not embedder.ort_session:
-        raise HTTPException(status_code=503, detail="Embedder nie jest zainicjalizowany lub sesja ONNX nie została załadowana")
+@app.post("/get_image_embedding_upload", response_model=EmbeddingResponse, responses=_EMBEDDING_FORMAT_RESPONSES)
+async def get_image_embedding_upload_endpoint(request: Request, file: UploadFile = File(...), lane_ticket: LaneTicket = Depends(interactive_lane)):
+    model = await _request_model(request)
+    crop_spec = _request_crop_spec(request)
+    embedding_format = _negotiate_embeddings_format(request, model)
     try:
         # logger.info(f"Przetwarzanie załadowanego pliku: {file.filename}")
         image_bytes = await file.read()
-        embedding = embedder.get_image_embedding(image_bytes)
-        return EmbeddingResponse(embedding=embedding.tolist())
+        if crop_spec is not None:
+            crop_embeddings = await _embed_single_image_crops(model, image_bytes, crop_spec)
+            return _crop_embeddings_response(embedding_format, crop_spec, [crop_embeddings], [0], [], single=True)
+        embedding = await _embed_single_image(model, image_bytes)
+        return _embeddings_response(embedding_format, embedding, single=True)
+    except HTTPException:
+        raise
+    except (UnidentifiedImageError, SyntaxError, OSError) as e:
+        metrics.inc("clip_skipped_items_total", {"endpoint": "/get_image_embedding_upload", "code": "decode_error"})
+        raise HTTPException(status_code=422, detail=f"Nie można odczytać obrazu {file.filename}: {type(e).__name__} - {str(e)}")
     except Exception as e:
         logger.error(f"Błąd przetwarzania załadowanego pliku {file.filename}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Wewnętrzny błąd serwera: {type(e).__name__} - {str(e)}")
 
-@app.post("/get_image_embeddings_batch", response_model=EmbeddingsResponse)
-async def get_image_embeddings_batch_endpoint(data: ImagePathsInput = Body(...)):
-    if not embedder or not embedder.ort_session:
-        raise HTTPException(status_code=503, detail="Embedder nie jest zainicjalizowany lub sesja ONNX nie została załadowana")
+@app.post("/get_image_embeddings_batch", response_model=EmbeddingsResponse, responses=_EMBEDDING_FORMAT_RESPONSES)
+async def get_image_embeddings_batch_endpoint(request: Request, data: ImagePathsInput = Body(...), lane_ticket: LaneTicket = Depends(bulk_lane)):
+    # Brakujące/uszkodzone pliki odpadają przed inferencją (null + wpis w 'errors'), reszta idzie jedną partią
+    model = await _request_model(request)
+    crop_spec = _request_crop_spec(request)
+    embedding_format = _negotiate_embeddings_format(request, model)
     try:
         # logger.info(f"Przetwarzanie partii {len(data.paths)} obrazów.")
-        embeddings = embedder.get_image_embeddings_batch(data.paths)
-        return EmbeddingsResponse(embeddings=[emb.tolist() for emb in embeddings])
+        metrics.observe("clip_request_items", len(data.paths), {"endpoint": "/get_image_embeddings_batch"})
+        if crop_spec is not None:
+            crop_results = await _run_inference(model.embedder.get_image_crop_embeddings_isolated, data.paths, crop_spec)
+            valid_positions, errors = _split_item_results("/get_image_embeddings_batch", crop_results, data.paths)
+            return _crop_embeddings_response(embedding_format, crop_spec, crop_results, valid_positions, errors)
+        results = await _run_inference(model.embedder.get_image_embeddings_isolated, data.paths)
+        valid_positions, errors = _split_item_results("/get_image_embeddings_batch", results, data.paths)
+        return _item_embeddings_response(embedding_format, results, valid_positions, errors)
+    except HTTPException:
+        raise
     except Exception as e: 
         logger.error(f"Błąd przetwarzania partii obrazów: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Wewnętrzny błąd serwera: {type(e).__name__} - {str(e)}")
 
-@app.post("/get_text_embedding", response_model=EmbeddingResponse)
-async def get_text_embedding_endpoint(data: TextIn = Body(...)):
-    if not embedder or not embedder.ort_session: 
-        raise HTTPException(status_code=503, detail="Embedder nie jest zainicjalizowany lub sesja ONNX nie została załadowana")
+@app.post("/get_text_embedding", response_model=EmbeddingResponse, responses=_EMBEDDING_FORMAT_RESPONSES)
+async def get_text_embedding_endpoint(request: Request, data: TextIn = Body(...), lane_ticket: LaneTicket = Depends(interactive_lane)):
+    model = await _request_model(request)
+    embedding_format = _negotiate_embeddings_format(request, model)
     try:
-        embedding = embedder.get_text_embedding(data.text)
-        return EmbeddingResponse(embedding=embedding.tolist())
+        embedding = model.embedder.cached_text_embedding(data.text) # Trafienie w LRU nie czeka w kolejce mikro-batchera
+        if embedding is None:
+            embedding = await model.text_batcher.submit(data.text)
+        return _embeddings_response(embedding_format, embedding, single=True)
+    except HTTPException:
+        raise
     except NotImplementedError as e:
         raise HTTPException(status_code=501, detail=str(e)) 
     except Exception as e: 
         raise HTTPException(status_code=500, detail=f"Wewnętrzny błąd serwera: {type(e).__name__} - {str(e)}")
 
-@app.post("/get_text_embeddings_batch", response_model=EmbeddingsResponse)
-async def get_text_embeddings_batch_endpoint(data: TextsIn = Body(...)):
-    if not embedder or not embedder.ort_session: 
-        raise HTTPException(status_code=503, detail="Embedder nie jest zainicjalizowany lub sesja ONNX nie została załadowana")
+@app.post("/get_text_embeddings_batch", response_model=EmbeddingsResponse, responses=_EMBEDDING_FORMAT_RESPONSES)
+async def get_text_embeddings_batch_endpoint(request: Request, data: TextsIn = Body(...), lane_ticket: LaneTicket = Depends(interactive_lane)):
+    model = await _request_model(request)
+    embedding_format = _negotiate_embeddings_format(request, model)
     try:
-        embeddings = embedder.get_text_embeddings_batch(data.texts)
-        return EmbeddingsResponse(embeddings=[emb.tolist() for emb in embeddings])
+        metrics.observe("clip_request_items", len(data.texts), {"endpoint": "/get_text_embeddings_batch"})
+        embeddings = await _run_inference(model.embedder.get_text_embeddings_batch, data.texts)
+        return _embeddings_response(embedding_format, embeddings)
+    except HTTPException:
+        raise
     except NotImplementedError as e:
         raise HTTPException(status_code=501, detail=str(e))
     except Exception as e: 
         raise HTTPException(status_code=500, detail=f"Wewnętrzny błąd serwera: {type(e).__name__} - {str(e)}")
 
+# --- Wsadowy upload obrazów (klient bez wspólnego systemu plików) ---
+# multipart/form-data: dowolna liczba części z plikami (nazwa pola dowolna, np. "files").
+# application/x-clip-images: ramki '<I' (długość obrazu w bajtach) + bajty obrazu, jedna po drugiej.
+# Oba formaty są dzielone w pamięci, bez plików tymczasowych (parser multipart Starlette przenosi części > 1 MB na dysk).
+UPLOAD_FRAMES_MEDIA_TYPE = "application/x-clip-images"
+UPLOAD_FRAME_HEADER = struct.Struct("<I")
+
+async def _read_upload_body(request: Request) -> bytearray:
+    max_bytes = UPLOAD_MAX_MB * 1024 * 1024
+    declared_length = request.headers.get("content-length")
+    if declared_length and declared_length.isdigit() and int(declared_length) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Żądanie ma {int(declared_length)} B, limit to {UPLOAD_MAX_MB} MB (CLIP_UPLOAD_MAX_MB).")
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Żądanie przekracza limit {UPLOAD_MAX_MB} MB (CLIP_UPLOAD_MAX_MB).")
+    return body # Bez kopii do bytes: parsery wycinają obrazy przez memoryview, więc w pamięci jest bufor + obrazy, a nie 2x treść
+
+def split_image_frames(body: Union[bytes, bytearray]) -> List[bytes]:
+    view = memoryview(body)
+    images, offset = [], 0
+    while offset < len(body):
+        if offset + UPLOAD_FRAME_HEADER.size > len(body):
+            raise ValueError(f"Urwany nagłówek ramki na pozycji {offset}.")
+        (length,) = UPLOAD_FRAME_HEADER.unpack_from(body, offset)
+        offset += UPLOAD_FRAME_HEADER.size
+        if offset + length > len(body):
+            raise ValueError(f"Ramka {len(images)} deklaruje {length} B, a zostało {len(body) - offset} B.")
+        images.append(view[offset:offset + length].tobytes()) # Jedna kopia na obraz, bez pośredniego wycinka
+        offset += length
+    return images
+
+def split_multipart_files(body: Union[bytes, bytearray], content_type: str) -> List[Tuple[Optional[str], bytes]]:
+    # Minimalny parser multipart/form-data (RFC 7578) na buforze w pamięci: (nazwa pliku, zawartość) dla każdej części
+    boundary_match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not boundary_match:
+        raise ValueError("Brak parametru 'boundary' w Content-Type.")
+    delimiter = b"--" + boundary_match.group(1).encode("latin-1")
+    view = memoryview(body)
+    parts: List[Tuple[Optional[str], bytes]] = []
+    position = body.find(delimiter)
+    if position < 0:
+        raise ValueError("Nie znaleziono granicy multipart w treści żądania.")
+    while True:
+        position += len(delimiter)
+        if body.startswith(b"--", position): # Granica zamykająca
+            return parts
+        headers_end = body.find(b"\r\n\r\n", position)
+        next_delimiter = body.find(b"\r\n" + delimiter, position)
+        if headers_end < 0 or next_delimiter < 0 or headers_end > next_delimiter:
+            raise ValueError(f"Niekompletna część multipart nr {len(parts)}.")
+        headers = str(view[position:headers_end], "utf-8", "replace")
+        filename_match = re.search(r'filename="([^"]*)"', headers) or re.search(r"filename=([^;\r\n]+)", headers)
+        if filename_match is not None or "filename*=" in headers: # Pola formularza bez pliku są pomijane
+            parts.append((filename_match.group(1) if filename_match else None, view[headers_end + 4:next_delimiter].tobytes()))
+        position = next_delimiter + 2
+
+@app.post("/get_image_embeddings_upload", response_model=EmbeddingsResponse, responses={
+    **_EMBEDDING_FORMAT_RESPONSES,
+    413: {"model": ErrorResponse, "description": "Przekroczony limit rozmiaru lub liczby plików"},
+    415: {"model": ErrorResponse, "description": "Nieobsługiwany Content-Type"},
+})
+async def get_image_embeddings_upload_endpoint(request: Request):
+    # Wiele obrazów w jednym żądaniu (multipart albo ramki z długością): dekodowanie z bufora żądania,
+    # wspólna ścieżka wsadowa (cache, pula dekodująca, porcje ONNX) i błędy per element jak w /get_image_embeddings_batch
+    content_type = request.headers.get("content-type", "")
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type not in ("multipart/form-data", UPLOAD_FRAMES_MEDIA_TYPE):
+        raise HTTPException(status_code=415, detail=f"Nieobsługiwany Content-Type '{media_type}'. Dozwolone: multipart/form-data, {UPLOAD_FRAMES_MEDIA_TYPE}")
+    model = await _request_model(request)
+    crop_spec = _request_crop_spec(request)
+    embedding_format = _negotiate_embeddings_format(request, model)
+    async with admit_request(request, LANE_BULK, watch_disconnect=False) as lane_ticket:
+        body = await _read_upload_body(request)
+        lane_ticket.watch(request)
+        metrics.observe("clip_upload_bytes", len(body))
+        try:
+            if media_type == UPLOAD_FRAMES_MEDIA_TYPE:
+                images = await run_in_threadpool(split_image_frames, body)
+                names: List[Optional[str]] = [None] * len(images)
+            else:
+                parts = await run_in_threadpool(split_multipart_files, body, content_type)
+                names, images = [name for name, _ in parts], [image for _, image in parts]
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Nieprawidłowa treść żądania: {str(e)}")
+        del body
+        if len(images) > UPLOAD_MAX_FILES:
+            raise HTTPException(status_code=413, detail=f"Żądanie zawiera {len(images)} obrazów, limit to {UPLOAD_MAX_FILES} (CLIP_UPLOAD_MAX_FILES).")
+        try:
+            metrics.observe("clip_request_items", len(images), {"endpoint": "/get_image_embeddings_upload"})
+            if crop_spec is not None and images:
+                crop_results = await _run_inference(model.embedder.get_image_crop_embeddings_isolated, images, crop_spec)
+                valid_positions, errors = _split_item_results("/get_image_embeddings_upload", crop_results, names)
+                return _crop_embeddings_response(embedding_format, crop_spec, crop_results, valid_positions, errors)
+            results = await _run_inference(model.embedder.get_image_embeddings_isolated, images) if images else []
+            valid_positions, errors = _split_item_results("/get_image_embeddings_upload", results, names)
+            return _item_embeddings_response(embedding_format, results, valid_positions, errors)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Błąd przetwarzania uploadu {len(images)} obrazów: {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail=f"Wewnętrzny błąd serwera: {type(e).__name__} - {str(e)}")
+
+# --- Strumieniowe przetwarzanie folderu (/ingest_folder) ---
+DEFAULT_IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff"]
+INGEST_NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Ramka binarna: '<II' (długość nagłówka JSON, długość wektora w bajtach) + nagłówek JSON UTF-8 + wektor little-endian
+INGEST_FRAMES_MEDIA_TYPE = "application/x-clip-frames"
+INGEST_FRAME_HEADER = struct.Struct("<II")
+
+class _FolderFile:
+    __slots__ = ("relative_path", "path", "size", "mtime")
+
+    def __init__(self, relative_path: str, path: str, size: int, mtime: float):
+        self.relative_path = relative_path
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+
+def iter_image_files(root: pathlib.Path, extensions: List[str], patterns: Optional[List[str]] = None,
+                     recursive: bool = True, cursor: Optional[str] = None):
+    # Deterministyczny przegląd w porządku leksykograficznym ścieżek względnych (po składowych), więc wznowienie
+    # od kursora (ścieżka względna ostatnio zwróconego pliku) pomija całe poddrzewa leżące przed kursorem.
+    normalized_extensions = {ext.lower() if ext.startswith(".") else f".{ext.lower()}" for ext in extensions}
+    cursor_parts = tuple(pathlib.PurePosixPath(cursor).parts) if cursor else None
+
+    def walk(directory: str, prefix_parts: Tuple[str, ...]):
+        try:
+            with os.scandir(directory) as scanner:
+                entries = sorted(scanner, key=lambda entry: entry.name)
+        except OSError as e_scan:
+            logger.warning(f"Nie można odczytać folderu '{directory}': {e_scan}")
+            return
+        for entry in entries:
+            parts = prefix_parts + (entry.name,)
+            try:
+                is_directory = entry.is_dir(follow_symlinks=False)
+                if is_directory:
+                    if not recursive or (cursor_parts is not None and parts < cursor_parts[:len(parts)]):
+                        continue
+                    yield from walk(entry.path, parts)
+                    continue
+                if cursor_parts is not None and parts <= cursor_parts:
+                    continue
+                if not entry.is_file() or os.path.splitext(entry.name)[1].lower() not in normalized_extensions:
+                    continue
+                relative_path = "/".join(parts)
+                if patterns and not any(fnmatch.fnmatch(relative_path, pattern) for pattern in patterns):
+                    continue
+                stat_result = entry.stat()
+                yield _FolderFile(relative_path, entry.path, stat_result.st_size, stat_result.st_mtime)
+            except OSError as e_entry:
+                logger.warning(f"Pomijam '{entry.path}': {e_entry}")
+
+    yield from walk(str(root), ())
+
+class FolderIngestInput(BaseModel):
+    root: str = Field(..., example="D:\\Cosplay\\Zdjecia")
+    extensions: List[str] = Field(default_factory=lambda: list(DEFAULT_IMAGE_EXTENSIONS))
+    patterns: Optional[List[str]] = Field(None, example=["2024/*", "*/event_*"])
+    recursive: bool = True
+    chunk_size: int = Field(INFERENCE_CHUNK_SIZE, ge=1, le=1024)
+    # Ścieżka względna ostatniego odebranego pliku - wznowienie przerwanego strumienia
+    cursor: Optional[str] = None
+    max_files: Optional[int] = Field(None, ge=1)
+    format: str = Field("ndjson", example="ndjson")
+    dtype: str = Field("float32", example="float32")
+    # Kompaktowe wektory jak w ?normalize= / ?projection= endpointów z embeddingami (int8 i pq wymagają projekcji)
+    normalize: bool = False
+    projection: Optional[str] = None
+
+def _take_folder_files(file_iterator, count: int) -> List[_FolderFile]:
+    return list(itertools.islice(file_iterator, count))
+
+def _encode_ingest_record(record: Dict[str, Any], embedding: Optional[np.ndarray], response_format: str, dtype: str) -> bytes:
+    with stage_timer("serialize"):
+        if response_format == "ndjson":
+            if embedding is not None:
+                record = {**record, "embedding": np.asarray(embedding).tolist()}
+            return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        vector_bytes = b""
+        if embedding is not None:
+            vector_bytes = np.ascontiguousarray(embedding, dtype=_BINARY_DTYPES_BY_CODE[BINARY_DTYPE_CODES[dtype]]).tobytes()
+            record = {**record, "dim": int(np.asarray(embedding).shape[-1]), "dtype": dtype}
+        header_bytes = json.dumps(record, ensure_ascii=False).encode("utf-8")
+        return INGEST_FRAME_HEADER.pack(len(header_bytes), len(vector_bytes)) + header_bytes + vector_bytes
+
+@app.post("/ingest_folder")
+async def ingest_folder_endpoint(request: Request, data: FolderIngestInput = Body(...)):
+    # Serwer sam przegląda folder, liczy embeddingi porcjami i wysyła wyniki na bieżąco (NDJSON lub ramki binarne).
+    # Przeciwciśnienie: najwyżej jedna porcja jest liczona z wyprzedzeniem względem tego, co odebrał klient.
+    # Błąd pojedynczego pliku trafia do strumienia jako rekord z polem 'error' i nie przerywa przetwarzania.
+    # Miejsce w pasie jest zajmowane osobno dla każdej porcji, więc długi strumień przeplata się z innymi żądaniami.
+    model = await _request_model(request)
+    response_format = data.format.lower()
+    if response_format not in ("ndjson", "binary"):
+        raise HTTPException(status_code=400, detail=f"Nieobsługiwany format '{data.format}'. Dozwolone: ndjson, binary")
+    output = resolve_embedding_output(data.dtype, data.normalize, data.projection, model)
+    dtype = output.dtype
+    root = pathlib.Path(data.root)
+    if not root.is_dir():
+        raise HTTPException(status_code=404, detail=f"Folder nie istnieje: {data.root}")
+
+    # Pełna kolejka pasa przed startem - zwykłe 429; później przepełnienie kończy strumień rekordem 'done' z kursorem
+    priority_lanes[_request_lane(request, LANE_BULK)].check_capacity()
+    file_iterator = iter_image_files(root, data.extensions, data.patterns, data.recursive, data.cursor)
+    chunk_tickets: Set[LaneTicket] = set()
+
+    async def produce_chunk(count: int) -> Optional[Tuple[List[_FolderFile], List[Union[np.ndarray, Exception]]]]:
+        files = await run_in_threadpool(_take_folder_files, file_iterator, count)
+        if not files:
+            return None
+        # Rozłączenie wykrywa StreamingResponse (zamyka generator i anuluje porcję), więc bez osobnej obserwacji
+        async with admit_request(request, LANE_BULK, watch_disconnect=False) as lane_ticket:
+            chunk_tickets.add(lane_ticket)
+            try:
+                results = await _run_inference(model.embedder.get_image_embeddings_isolated, [folder_file.path for folder_file in files])
+            except ClientDisconnected:
+                raise
+            except Exception as e_chunk:
+                logger.error(f"/ingest_folder: błąd inferencji porcji {len(files)} plików: {e_chunk}", exc_info=True)
+                results = [e_chunk] * len(files)
+            finally:
+                chunk_tickets.discard(lane_ticket)
+        valid_positions = [position for position, result in enumerate(results) if not isinstance(result, Exception)]
+        if valid_positions and not output.is_default:
+            rows = output.apply(np.stack([results[position] for position in valid_positions]))
+            for row, position in enumerate(valid_positions):
+                results[position] = rows[row]
+        return files, results
+
+    async def stream():
+        completed = False
+        emitted_files = 0
+        error_count = 0
+        scheduled_files = 0
+        cursor = data.cursor
+        truncated = False
+        overload: Optional[Dict[str, Any]] = None
+
+        def schedule_next() -> Optional[asyncio.Future]:
+            nonlocal scheduled_files
+            count = data.chunk_size if data.max_files is None else min(data.chunk_size, data.max_files - scheduled_files)
+            if count <= 0:
+                return None
+            scheduled_files += count
+            return asyncio.ensure_future(produce_chunk(count))
+
+        next_chunk = schedule_next()
+        try:
+            while next_chunk is not None:
+                try:
+                    chunk = await next_chunk
+                except HTTPException as e_lane:
+                    if e_lane.status_code != 429:
+                        raise
+                    # Pas przeciążony w trakcie strumienia - klient wznawia od kursora (np. po Retry-After)
+                    next_chunk, truncated = None, True
+                    overload = {"code": "overloaded", "message": e_lane.detail, "retry_after": int((e_lane.headers or {}).get("Retry-After", 1))}
+                    break
+                if chunk is None:
+                    break
+                next_chunk = schedule_next()
+                if next_chunk is None:
+                    truncated = True
+                files, results = chunk
+                for folder_file, result in zip(files, results):
+                    record = {"type": "item", "relative_path": folder_file.relative_path, "path": folder_file.path,
+                              "size": folder_file.size, "mtime": folder_file.mtime, "cursor": folder_file.relative_path}
+                    if isinstance(result, Exception):
+                        error_count += 1
+                        record["error"] = describe_item_error(result)
+                        metrics.inc("clip_skipped_items_total", {"endpoint": "/ingest_folder", "code": record["error"]["code"]})
+                        yield _encode_ingest_record(record, None, response_format, dtype)
+                    else:
+                        yield _encode_ingest_record(record, result, response_format, dtype)
+                    emitted_files += 1
+                    cursor = folder_file.relative_path
+            if truncated and overload is None: # Limit max_files osiągnięty - sprawdź, czy zostały jeszcze pliki
+                truncated = bool(await run_in_threadpool(_take_folder_files, file_iterator, 1))
+            done_record = {"type": "done", "files": emitted_files, "errors": error_count, "cursor": cursor, "complete": not truncated}
+            if overload is not None:
+                done_record["error"] = overload
+            yield _encode_ingest_record(done_record, None, response_format, dtype)
+            completed = True
+        finally:
+            if not completed: # Klient przerwał odbiór - porcja w wątku inferencji kończy się na granicy porcji
+                for lane_ticket in list(chunk_tickets):
+                    lane_ticket.cancel()
+            if next_chunk is not None and not next_chunk.done():
+                next_chunk.cancel()
+            metrics.observe("clip_request_items", emitted_files, {"endpoint": "/ingest_folder"})
+            logger.info(f"/ingest_folder '{data.root}': wysłano {emitted_files} plików ({error_count} błędów), kursor: {cursor}")
+
+    media_type = INGEST_NDJSON_MEDIA_TYPE if response_format == "ndjson" else INGEST_FRAMES_MEDIA_TYPE
+    return StreamingResponse(stream(), media_type=media_type)
+
+# --- Endpointy indeksu wektorowego ---
+class IndexUpsertInput(BaseModel):
+    ids: List[str] = Field(..., example=["img_001", "img_002"])
+    vectors: Optional[List[List[float]]] = None
+    paths: Optional[List[str]] = Field(None, example=["path/to/img1.jpg", "path/to/img2.png"])
+    metadata: Optional[List[Optional[Dict[str, Any]]]] = None
+
+class IndexRemoveInput(BaseModel):
+    ids: List[str]
+
+class IndexSearchInput(BaseModel):
+    paths: Optional[List[str]] = None
+    vectors: Optional[List[List[float]]] = None
+    top_k: int = Field(10, ge=1, le=1000)
+
+class ClassifyInput(BaseModel):
+    # Indeks z centroidami profili (id = nazwa profilu/kategorii)
+    index: str = Field("profiles", example="profiles")
+    paths: Optional[List[str]] = None
+    vectors: Optional[List[List[float]]] = None
+    top_k: int = Field(3, ge=1, le=100)
+    min_score: Optional[float] = None
+
+def _save_index_quietly(index: VectorIndex):
+    try:
+        index.save(vector_index_store.directory)
+        logger.debug(f"Zapisano indeks '{index.name}' ({len(index)} wektorów).")
+    except Exception as e_save:
+        logger.error(f"Błąd zapisu indeksu '{index.name}': {e_save}", exc_info=True)
+
+def _schedule_index_save(index: VectorIndex):
+    loop = asyncio.get_running_loop()
+    previous_handle = _index_save_handles.pop(index.name, None)
+    if previous_handle:
+        previous_handle.cancel()
+    _index_save_handles[index.name] = loop.call_later(
+        INDEX_SAVE_DELAY_S, lambda: loop.run_in_executor(None, _save_index_quietly, index))
+
+def _get_index_or_error(name: str, create: bool = False) -> VectorIndex:
+    try:
+        index = vector_index_store.get(name, create=create)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if index is None:
+        raise HTTPException(status_code=404, detail=f"Indeks '{name}' nie istnieje.")
+    return index
+
+def _check_index_model(index: VectorIndex, model: LoadedModel):
+    # Porównanie z indeksem ma sens tylko dla wektorów z tego samego modelu (sam wymiar może się zgadzać przypadkiem)
+    if index.model_key is not None and index.model_key != model.key:
+        raise HTTPException(status_code=400, detail=f"Indeks '{index.name}' zbudowano modelem '{index.model_key}', "
+                                                    f"a obrazy byłyby embeddowane modelem '{model.key}'. Użyj ?model={index.model_key}.")
+
+async def _resolve_query_vectors(request: Request, paths: Optional[List[str]], vectors: Optional[List[List[float]]],
+                                 index: Optional[VectorIndex] = None) -> Tuple[np.ndarray, List[int], List[Dict[str, Any]]]:
+    # Zapytania jako gotowe wektory albo ścieżki obrazów (embedding przez ścieżkę wsadową, z cache).
+    # Wynik: macierz udanych elementów, ich pozycje w żądaniu i błędy pominiętych ścieżek.
+    # Z podanym indeksem ścieżki są embeddowane tylko modelem, którym zbudowano indeks.
+    if vectors is not None and paths is not None:
+        raise HTTPException(status_code=400, detail="Podaj 'paths' albo 'vectors', nie oba naraz.")
+    if vectors is not None:
+        try:
+            return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1), list(range(len(vectors))), []
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Wektory muszą mieć jednakowy wymiar.")
+    if not paths:
+        raise HTTPException(status_code=400, detail="Wymagane 'paths' lub 'vectors'.")
+    model = await _request_model(request)
+    if index is not None:
+        _check_index_model(index, model)
+    results = await _run_inference(model.embedder.get_image_embeddings_isolated, paths)
+    endpoint = getattr(request.scope.get("route"), "path", request.url.path) # Szablon ścieżki - bez nazw indeksów w etykietach metryk
+    valid_positions, errors = _split_item_results(endpoint, results, paths)
+    matrix = np.stack([results[position] for position in valid_positions]) if valid_positions else np.empty((0, 0), dtype=np.float32)
+    return matrix, valid_positions, errors
+
+@app.get("/indexes")
+async def list_indexes_endpoint():
+    return {"indexes": vector_index_store.list_names()}
+
+@app.get("/index/{name}")
+async def get_index_info_endpoint(name: str):
+    return _get_index_or_error(name).info()
+
+@app.delete("/index/{name}")
+async def delete_index_endpoint(name: str):
+    pending_save = _index_save_handles.pop(name, None)
+    if pending_save:
+        pending_save.cancel()
+    try:
+        existed = vector_index_store.delete(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not existed:
+        raise HTTPException(status_code=404, detail=f"Indeks '{name}' nie istnieje.")
+    return {"deleted": name}
+
+@app.post("/index/{name}/upsert")
+async def index_upsert_endpoint(request: Request, name: str, data: IndexUpsertInput = Body(...), lane_ticket: LaneTicket = Depends(bulk_lane)):
+    for field_name, values in (("ścieżek", data.paths), ("wektorów", data.vectors), ("metadanych", data.metadata)):
+        if values is not None and len(values) != len(data.ids):
+            raise HTTPException(status_code=400, detail=f"Liczba {field_name} ({len(values)}) różni się od liczby identyfikatorów ({len(data.ids)}).")
+    index = _get_index_or_error(name, create=True)
+    vectors, valid_positions, errors = await _resolve_query_vectors(request, data.paths, data.vectors, index)
+    ids = [data.ids[position] for position in valid_positions]
+    metadata = [data.metadata[position] for position in valid_positions] if data.metadata is not None else None
+    inserted = 0
+    if ids:
+        try:
+            inserted = await run_in_threadpool(index.upsert, ids, vectors, metadata)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if data.paths is not None and index.model_key is None: # Pierwsze wektory z obrazów wiążą indeks z modelem
+            index.model_key = (await _request_model(request)).key
+        _schedule_index_save(index)
+    return {"index": name, "inserted": inserted, "updated": len(ids) - inserted, "size": len(index),
+            "errors": errors, "skipped": len(errors)}
+
+@app.post("/index/{name}/remove")
+async def index_remove_endpoint(name: str, data: IndexRemoveInput = Body(...)):
+    index = _get_index_or_error(name)
+    removed = await run_in_threadpool(index.remove, data.ids)
+    if removed:
+        _schedule_index_save(index)
+    return {"index": name, "removed": removed, "size": len(index)}
+
+@app.post("/index/{name}/search")
+async def index_search_endpoint(request: Request, name: str, data: IndexSearchInput = Body(...), lane_ticket: LaneTicket = Depends(interactive_lane)):
+    index = _get_index_or_error(name)
+    queries, valid_positions, errors = await _resolve_query_vectors(request, data.paths, data.vectors, index)
+    try:
+        found = await run_in_threadpool(index.search, queries, data.top_k) if valid_positions else []
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    results: List[Optional[List[Dict[str, Any]]]] = [None] * (len(data.paths) if data.paths is not None else len(found))
+    for position, candidates in zip(valid_positions, found):
+        results[position] = candidates
+    return {"index": name, "results": results, "errors": errors, "skipped": len(errors)}
+
+@app.post("/classify")
+async def classify_endpoint(request: Request, data: ClassifyInput = Body(...), lane_ticket: LaneTicket = Depends(interactive_lane)):
+    # Najlepiej pasujący centroid profilu dla każdego obrazu - jedno wywołanie na partię zamiast liniowego skanu po stronie klienta
+    index = _get_index_or_error(data.index)
+    queries, valid_positions, errors = await _resolve_query_vectors(request, data.paths, data.vectors, index)
+    try:
+        results = await run_in_threadpool(index.search, queries, data.top_k) if valid_positions else []
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    classifications: List[Optional[Dict[str, Any]]] = [None] * (len(valid_positions) + len(errors))
+    for error in errors:
+        classifications[error["index"]] = {"path": error["path"], "best": None, "candidates": [], "error": error}
+    for position, candidates in zip(valid_positions, results):
+        best = candidates[0] if candidates else None
+        if best is not None and data.min_score is not None and best["score"] < data.min_score:
+            best = None
+        classifications[position] = {
+            "path": data.paths[position] if data.paths else None,
+            "best": best,
+            "candidates": candidates,
+            "error": None,
+        }
+    return {"index": data.index, "results": classifications, "skipped": len(errors)}
+
+# --- Tagowanie zero-shot (zestawy etykiet) ---
+class LabelSetInput(BaseModel):
+    labels: List[str] = Field(..., example=["triss merigold", "yennefer", "ciri", "geralt of rivia"])
+    # Szablony promptu ("{}" = etykieta); kilka szablonów jest uśrednianych (prompt ensembling)
+    templates: Optional[List[str]] = Field(None, example=["a photo of {}", "{} cosplay"])
+    # Własne prompty dla wybranych etykiet (zastępują szablony)
+    prompts: Optional[Dict[str, List[str]]] = None
+
+class TagInput(BaseModel):
+    label_set: str = Field(..., example="characters")
+    paths: Optional[List[str]] = Field(None, example=["path/to/img1.jpg", "path/to/img2.png"])
+    vectors: Optional[List[List[float]]] = None
+    top_k: int = Field(5, ge=1, le=1000)
+    min_score: Optional[float] = None
+    include_scores: bool = False # Pełny wektor podobieństw do wszystkich etykiet
+
+def _get_label_set_or_error(name: str) -> LabelSet:
+    try:
+        label_set = label_set_store.get(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if label_set is None:
+        raise HTTPException(status_code=404, detail=f"Zestaw etykiet '{name}' nie istnieje.")
+    return label_set
+
+@app.get("/labels")
+async def list_label_sets_endpoint():
+    return {"label_sets": label_set_store.list_names()}
+
+@app.get("/labels/{name}")
+async def get_label_set_endpoint(name: str):
+    label_set = _get_label_set_or_error(name)
+    return {**label_set.to_dict(), "models": {model_key: int(matrix.shape[1]) for model_key, matrix in label_set.matrices.items()}}
+
+@app.post("/labels/{name}")
+async def register_label_set_endpoint(request: Request, name: str, data: LabelSetInput = Body(...), lane_ticket: LaneTicket = Depends(interactive_lane)):
+    # Rejestracja (lub zastąpienie) zestawu: od razu liczy macierz etykiet, żeby /tag robił już tylko mnożenie
+    model = await _request_model(request)
+    labels = list(dict.fromkeys(label.strip() for label in data.labels if label.strip()))
+    if not labels:
+        raise HTTPException(status_code=400, detail="Zestaw etykiet nie może być pusty.")
+    if data.templates is not None and (not data.templates or any("{}" not in template for template in data.templates)):
+        raise HTTPException(status_code=400, detail="Każdy szablon musi zawierać '{}' w miejscu etykiety.")
+    unknown_labels = sorted(set(data.prompts or {}) - set(labels))
+    if unknown_labels:
+        raise HTTPException(status_code=400, detail=f"Prompty dla etykiet spoza zestawu: {unknown_labels}")
+    started = time.perf_counter()
+    label_set = LabelSet(name, labels, data.templates, data.prompts)
+    try:
+        matrix = await _run_inference(label_set.ensure_matrix, model.embedder)
+        label_set_store.put(label_set)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except NotImplementedError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except Exception as e:
+        logger.error(f"Błąd rejestracji zestawu etykiet '{name}': {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Wewnętrzny błąd serwera: {type(e).__name__} - {str(e)}")
+    logger.info(f"Zarejestrowano zestaw etykiet '{name}' ({len(labels)} etykiet, wymiar {matrix.shape[1]}).")
+    return {"name": name, "model": model.key, "labels": len(labels), "dim": int(matrix.shape[1]), "elapsed_ms": (time.perf_counter() - started) * 1000.0}
+
+@app.delete("/labels/{name}")
+async def delete_label_set_endpoint(name: str):
+    try:
+        existed = label_set_store.delete(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not existed:
+        raise HTTPException(status_code=404, detail=f"Zestaw etykiet '{name}' nie istnieje.")
+    return {"deleted": name}
+
+@app.post("/tag")
+async def tag_endpoint(request: Request, data: TagInput = Body(...), lane_ticket: LaneTicket = Depends(interactive_lane)):
+    # Auto-tagowanie: jedna partia embeddingów obrazów + jedno mnożenie przez macierz etykiet.
+    # Błąd pojedynczego pliku trafia do jego wyniku (pole 'error') i nie przerywa partii.
+    label_set = _get_label_set_or_error(data.label_set)
+    model = await _request_model(request)
+    if (data.paths is None) == (data.vectors is None):
+        raise HTTPException(status_code=400, detail="Podaj 'paths' albo 'vectors'.")
+    started = time.perf_counter()
+    try:
+        label_matrix = await _run_inference(label_set.ensure_matrix, model.embedder)
+        if data.vectors is not None:
+            items: List[Union[np.ndarray, Exception]] = list((await _resolve_query_vectors(request, None, data.vectors))[0])
+        else:
+            items = await _run_inference(model.embedder.get_image_embeddings_isolated, data.paths)
+        valid_positions, errors = _split_item_results("/tag", items, data.paths)
+        errors_by_position = {error["index"]: error for error in errors}
+        results: List[Dict[str, Any]] = [
+            {"path": data.paths[position] if data.paths else None, "labels": [], "error": errors_by_position.get(position)}
+            for position in range(len(items))]
+        if valid_positions:
+            image_embeddings = np.stack([items[position] for position in valid_positions])
+            if image_embeddings.shape[1] != label_matrix.shape[1]:
+                raise HTTPException(status_code=400, detail=f"Wymiar wektorów {image_embeddings.shape[1]} != wymiar etykiet {label_matrix.shape[1]}.")
+            scores, probabilities, top_indices = await run_in_threadpool(score_labels, image_embeddings, label_matrix, data.top_k)
+            for row, position in enumerate(valid_positions):
+                results[position]["labels"] = [
+                    {"label": label_set.labels[label_index], "score": float(scores[row, label_index]),
+                     "probability": float(probabilities[row, label_index])}
+                    for label_index in top_indices[row]
+                    if data.min_score is None or scores[row, label_index] >= data.min_score]
+                if data.include_scores:
+                    results[position]["scores"] = scores[row].tolist()
+    except HTTPException:
+        raise
+    except NotImplementedError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except Exception as e:
+        logger.error(f"Błąd tagowania zestawem '{data.label_set}': {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Wewnętrzny błąd serwera: {type(e).__name__} - {str(e)}")
+    metrics.observe("clip_request_items", len(results), {"endpoint": "/tag"})
+    return {"label_set": data.label_set, "model": model.key, "label_names": label_set.labels if data.include_scores else None,
+            "results": results, "errors": len(results) - len(valid_positions),
+            "elapsed_ms": (time.perf_counter() - started) * 1000.0}
+
+# --- Projekcje kompaktowych wektorów (endpointy) ---
+class ProjectionInput(BaseModel):
+    # Próbka do dopasowania: ścieżki obrazów, gotowe wektory albo losowe wiersze istniejącego indeksu
+    paths: Optional[List[str]] = None
+    vectors: Optional[List[List[float]]] = None
+    index: Optional[str] = None
+    # Model, którym policzono 'vectors' (wymagany dla nich - projekcja działa tylko w przestrzeni jednego modelu)
+    model: Optional[str] = Field(None, example="openai/clip-vit-base-patch32")
+    # Wymiar po PCA; None = bez redukcji (tylko normalizacja i kwantyzacja pełnego wektora)
+    dim: Optional[int] = Field(None, ge=1, example=256)
+    # Liczba podwektorów PQ (bajtów kodu na wektor); domyślnie dim / 4
+    pq_subvectors: Optional[int] = Field(None, ge=1, example=64)
+    sample_size: int = Field(20000, ge=PROJECTION_MIN_SAMPLE)
+    recall_k: int = Field(10, ge=1, le=100)
+    seed: int = 0
+
+@app.get("/projections")
+async def list_projections_endpoint():
+    return {"projections": projection_store.list_names()}
+
+@app.get("/projections/{name}")
+async def get_projection_endpoint(name: str):
+    return _get_projection_or_error(name).describe()
+
+@app.get("/projections/{name}/parameters")
+async def get_projection_parameters_endpoint(name: str):
+    # Parametry dla klienta (.npz): components (PCA), int8_scale, pq_codebooks - do rzutowania własnych wektorów
+    # i asymetrycznego liczenia odległości do kodów PQ bez pytania serwera
+    projection = _get_projection_or_error(name)
+    buffer = BytesIO()
+    components = projection.components if projection.components is not None else np.empty((0, projection.input_dim), dtype=np.float32)
+    np.savez(buffer, components=components, int8_scale=np.float32(projection.int8_scale), pq_codebooks=projection.pq_codebooks)
+    return Response(content=buffer.getvalue(), media_type="application/octet-stream",
+                    headers={"Content-Disposition": f'attachment; filename="{name}.projection.npz"'})
+
+@app.post("/projections/{name}")
+async def fit_projection_endpoint(request: Request, name: str, data: ProjectionInput = Body(...), lane_ticket: LaneTicket = Depends(bulk_lane)):
+    # Dopasowanie (lub zastąpienie) projekcji na próbce; odpowiedź zawiera recall@k każdej postaci względem pełnych wektorów
+    started = time.perf_counter()
+    if sum(source is not None for source in (data.paths, data.vectors, data.index)) != 1:
+        raise HTTPException(status_code=400, detail="Podaj dokładnie jedno źródło: 'paths', 'vectors' albo 'index'.")
+    try:
+        VectorIndexStore.validate_name(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Klucz modelu projekcji: z indeksu (model zapisany w jego meta), jawny 'model' dla gotowych wektorów
+    # albo model żądania dla ścieżek. ?model= / X-CLIP-Model, jeśli podany, musi się z nim zgadzać.
+    requested = request.query_params.get("model") or request.headers.get("x-clip-model")
+    try:
+        requested_key = model_registry.validate_key(requested) if requested else None
+        declared_key = model_registry.validate_key(data.model) if data.model else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    errors: List[Dict[str, Any]] = []
+    if data.index is not None:
+        index = _get_index_or_error(data.index)
+        if index.model_key is None:
+            raise HTTPException(status_code=400, detail=f"Indeks '{data.index}' nie ma zapisanego modelu (zbudowany z gotowych wektorów) - "
+                                                        f"dopasuj projekcję na 'vectors' z jawnym 'model'.")
+        model_key = index.model_key
+        matrix = index.matrix
+    elif data.vectors is not None:
+        if declared_key is None:
+            raise HTTPException(status_code=400, detail="Dla 'vectors' podaj 'model', którym je policzono.")
+        model_key = declared_key
+        matrix, _, errors = await _resolve_query_vectors(request, None, data.vectors)
+    else:
+        model = await _request_model(request)
+        model_key = model.key
+        matrix, _, errors = await _resolve_query_vectors(request, data.paths, None)
+    for other_key in (requested_key, declared_key):
+        if other_key is not None and other_key != model_key:
+            raise HTTPException(status_code=400, detail=f"Próbka pochodzi z modelu '{model_key}', a wskazano model '{other_key}'.")
+    if len(matrix) > data.sample_size:
+        rows = np.sort(np.random.default_rng(data.seed).choice(len(matrix), size=data.sample_size, replace=False))
+        matrix = matrix[rows]
+    sample = np.asarray(matrix, dtype=np.float32)
+    try:
+        projection = await run_in_threadpool(EmbeddingProjection.fit, name, model_key, sample, data.dim, data.pq_subvectors, data.recall_k, data.seed)
+        projection_store.put(projection)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Błąd dopasowania projekcji '{name}': {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Wewnętrzny błąd serwera: {type(e).__name__} - {str(e)}")
+    logger.info(f"Dopasowano projekcję '{name}' ({projection.input_dim} -> {projection.output_dim}, PQ {projection.pq_subvectors} B) "
+                f"na {len(sample)} wektorach, recall: {projection.report.get('recall')}")
+    result = projection.describe()
+    if data.paths is not None:
+        result["errors"], result["skipped"] = errors, len(errors)
+    result["elapsed_ms"] = (time.perf_counter() - started) * 1000.0
+    return result
+
+@app.delete("/projections/{name}")
+async def delete_projection_endpoint(name: str):
+    try:
+        existed = projection_store.delete(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not existed:
+        raise HTTPException(status_code=404, detail=f"Projekcja '{name}' nie istnieje.")
+    return {"deleted": name}
+
+# --- Wykrywanie duplikatów i serii zdjęć ---
+class DuplicatesInput(BaseModel):
+    # Źródło: lista ścieżek obrazów albo nazwa zapisanego indeksu wektorowego
+    paths: Optional[List[str]] = Field(None, example=["path/to/img1.jpg", "path/to/img1_copy.jpg"])
+    index: Optional[str] = None
+    threshold: float = Field(0.95, ge=-1.0, le=1.0)
+    top_k: int = Field(10, ge=1, le=1000)
+    # Prefiltr: identyczne bajty / identyczne zdekodowane piksele - bez przepuszczania przez model
+    # (dHash przy tym samym rozmiarze obrazu służy tylko do wskazania kandydatów do porównania pikseli)
+    prefilter: bool = True
+    include_pairs: bool = False
+
+def _find_duplicate_groups(labels: List[str], matrix: np.ndarray, matrix_positions: Optional[List[int]], threshold: float, top_k: int,
+                           forced_groups: Optional[List[Tuple[List[int], str]]] = None, include_pairs: bool = False) -> List[Dict[str, Any]]:
+    # Wiersze macierzy odpowiadają pozycjom matrix_positions w labels (None = wszystkie po kolei).
+    # forced_groups: grupy z prefiltra (pozycje w labels), łączone z parami z podobieństwa embeddingów.
+    if len(matrix):
+        left, right, scores = similar_pairs(normalize_rows(matrix), threshold, top_k)
+    else:
+        left, right, scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    if matrix_positions is not None:
+        positions = np.asarray(matrix_positions, dtype=np.int64)
+        left, right = positions[left], positions[right]
+    methods: Dict[int, set] = {}
+    forced_left: List[int] = []
+    forced_right: List[int] = []
+    for members, method in forced_groups or []:
+        for member in members:
+            methods.setdefault(member, set()).add(method)
+        forced_left.extend([members[0]] * (len(members) - 1))
+        forced_right.extend(members[1:])
+    groups = connected_groups(len(labels), np.concatenate([left, np.asarray(forced_left, dtype=np.int64)]),
+                              np.concatenate([right, np.asarray(forced_right, dtype=np.int64)]))
+    group_of = {member: group_number for group_number, members in enumerate(groups) for member in members}
+    group_scores: List[List[float]] = [[] for _ in groups]
+    group_pairs: List[List[Dict[str, Any]]] = [[] for _ in groups]
+    for a, b, score in zip(left.tolist(), right.tolist(), scores.tolist()):
+        group_number = group_of[a]
+        group_scores[group_number].append(score)
+        if include_pairs:
+            group_pairs[group_number].append({"a": labels[a], "b": labels[b], "score": score})
+    results = []
+    for group_number, members in enumerate(groups):
+        group_methods = set().union(*(methods.get(member, set()) for member in members))
+        if group_scores[group_number]:
+            group_methods.add("embedding")
+        group = {
+            "members": [labels[member] for member in members],
+            "size": len(members),
+            "methods": sorted(group_methods),
+            "min_score": min(group_scores[group_number]) if group_scores[group_number] else 1.0,
+            "max_score": max(group_scores[group_number]) if group_scores[group_number] else 1.0,
+        }
+        if include_pairs:
+            group["pairs"] = group_pairs[group_number]
+        results.append(group)
+    results.sort(key=lambda group: -group["size"])
+    return results
+
+def _prefilter_identical_files(paths: List[str]) -> Tuple[List[int], List[Tuple[List[int], str]], List[Dict[str, Any]]]:
+    # Zwraca: pozycje reprezentantów (do embeddingu), grupy identycznych plików oraz błędy odczytu
+    fingerprints = list(get_decode_pool().map(_safe_fingerprint, paths))
+    errors = [{"path": paths[position], "error": str(fingerprint), **describe_item_error(fingerprint)}
+              for position, fingerprint in enumerate(fingerprints) if isinstance(fingerprint, Exception)]
+    for error in errors:
+        metrics.inc("clip_skipped_items_total", {"endpoint": "/duplicates", "code": error["code"]})
+    by_bytes: Dict[str, List[int]] = {}
+    for position, fingerprint in enumerate(fingerprints):
+        if not isinstance(fingerprint, Exception):
+            by_bytes.setdefault(fingerprint[0], []).append(position)
+    by_dhash: Dict[str, List[int]] = {}
+    for members in by_bytes.values():
+        by_dhash.setdefault(fingerprints[members[0]][1], []).append(members[0])
+    # Ten sam dHash to tylko kandydaci: pomijamy embedding wyłącznie przy identycznych zdekodowanych pikselach,
+    # reszta (np. zdjęcia z serii) jest embeddowana i oceniana normalnie
+    candidates = [position for members in by_dhash.values() if len(members) > 1 for position in members]
+    pixel_hashes = dict(zip(candidates, get_decode_pool().map(_safe_pixels_hash, [paths[position] for position in candidates])))
+    representatives: List[int] = []
+    by_pixels: Dict[str, List[int]] = {}
+    for members in by_dhash.values():
+        for position in members:
+            pixel_hash = pixel_hashes.get(position)
+            if pixel_hash is None or isinstance(pixel_hash, Exception):
+                representatives.append(position) # Błąd dekodowania zgłosi etap embeddingu
+            else:
+                by_pixels.setdefault(pixel_hash, []).append(position)
+    representatives = sorted(representatives + [members[0] for members in by_pixels.values()])
+    forced_groups = [(members, "identical_bytes") for members in by_bytes.values() if len(members) > 1]
+    forced_groups += [(members, "identical_pixels") for members in by_pixels.values() if len(members) > 1]
+    return representatives, forced_groups, errors
+
+def _safe_fingerprint(path: str) -> Union[Tuple[str, str], Exception]:
+    try:
+        return fingerprint_image_file(path)
+    except Exception as e_fingerprint:
+        return e_fingerprint
+
+def _safe_pixels_hash(path: str) -> Union[str, Exception]:
+    try:
+        return decoded_pixels_hash(path)
+    except Exception as e_pixels:
+        return e_pixels
+
+@app.post("/duplicates")
+async def duplicates_endpoint(request: Request, data: DuplicatesInput = Body(...), lane_ticket: LaneTicket = Depends(bulk_lane)):
+    # Grupy duplikatów/serii: prefiltr identycznych plików, potem blokowy iloczyn znormalizowanych wektorów
+    # z top_k na wiersz i łączenie par powyżej progu w grupy (union-find)
+    if (data.paths is None) == (data.index is None):
+        raise HTTPException(status_code=400, detail="Podaj 'paths' albo 'index' (dokładnie jedno).")
+    started = time.perf_counter()
+    if data.index is not None:
+        index = _get_index_or_error(data.index)
+        groups = await run_in_threadpool(_find_duplicate_groups, list(index.ids), index.matrix, None, data.threshold,
+                                         data.top_k, None, data.include_pairs)
+        return {"source": {"index": data.index}, "count": len(index), "groups": groups, "errors": [],
+                "elapsed_ms": (time.perf_counter() - started) * 1000.0}
+
+    model = await _request_model(request)
+    try:
+        if data.prefilter:
+            representatives, forced_groups, errors = await run_in_threadpool(_prefilter_identical_files, data.paths)
+        else:
+            representatives, forced_groups, errors = list(range(len(data.paths))), [], []
+        embedded = await _run_inference(model.embedder.get_image_embeddings_isolated, [data.paths[position] for position in representatives])
+        embedded_positions = []
+        vectors = []
+        for position, result in zip(representatives, embedded):
+            if isinstance(result, Exception):
+                errors.append({"path": data.paths[position], "error": str(result), **describe_item_error(result)})
+                metrics.inc("clip_skipped_items_total", {"endpoint": "/duplicates", "code": errors[-1]["code"]})
+            else:
+                embedded_positions.append(position)
+                vectors.append(result)
+        matrix = np.stack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+        # Pliki pominięte przez prefiltr dołączają do grup przez forced_groups (ich reprezentant ma embedding)
+        groups = await run_in_threadpool(_find_duplicate_groups, data.paths, matrix, embedded_positions, data.threshold,
+                                         data.top_k, forced_groups, data.include_pairs)
+        return {"source": {"paths": len(data.paths)}, "count": len(data.paths), "embedded": len(embedded_positions),
+                "groups": groups, "errors": errors, "elapsed_ms": (time.perf_counter() - started) * 1000.0}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Błąd w /duplicates: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Błąd serwera podczas wykrywania duplikatów: {str(e)}")
+
+class ClusterInput(BaseModel):
+    # Źródło: ścieżki obrazów, gotowe wektory (opcjonalnie z ids) albo nazwa indeksu
+    paths: Optional[List[str]] = None
+    vectors: Optional[List[List[float]]] = None
+    ids: Optional[List[str]] = None
+    index: Optional[str] = None
+    method: Literal["kmeans", "agglomerative"] = "kmeans"
+    # kmeans: k=None -> automatyczny wybór z [k_min, k_max] po uproszczonej sylwetce
+    k: Optional[int] = Field(None, ge=1, le=1000)
+    k_min: int = Field(2, ge=1)
+    k_max: Optional[int] = Field(None, ge=1, le=1000)
+    # agglomerative: próg odległości cosinusowej (1 - cos) i rodzaj wiązania
+    distance_threshold: float = Field(0.25, gt=0.0, le=2.0)
+    linkage: Literal["average", "single"] = "average"
+    seed: int = 0
+    include_centroids: bool = True
+
+def _run_clustering(matrix: np.ndarray, data: ClusterInput) -> Dict[str, Any]:
+    matrix = normalize_rows(matrix)
+    result: Dict[str, Any] = {"method": data.method}
+    if data.method == "kmeans":
+        k = data.k
+        if k is None:
+            k, candidate_scores = choose_cluster_count(matrix, data.k_min, data.k_max, seed=data.seed)
+            result["k_candidates"] = {str(candidate): score for candidate, score in candidate_scores.items()}
+        _, assignments, _ = minibatch_kmeans(matrix, k, seed=data.seed)
+        _, assignments = np.unique(assignments, return_inverse=True)  # bez pustych klastrów
+    else:
+        result["linkage"] = data.linkage
+        result["distance_threshold"] = data.distance_threshold
+        if data.linkage == "single":
+            assignments = agglomerative_single(matrix, data.distance_threshold)
+        else:
+            assignments = agglomerative_average(matrix, data.distance_threshold, seed=data.seed)
+    centroids, clusters = describe_clusters(matrix, assignments)
+    result.update({
+        "k": len(clusters),
+        "assignments": assignments.tolist(),
+        "clusters": clusters,
+        "silhouette": simplified_silhouette(matrix, centroids, assignments),
+    })
+    if data.include_centroids:
+        result["centroids"] = centroids.tolist()
+    return result
+
+@app.post("/cluster")
+async def cluster_endpoint(request: Request, data: ClusterInput = Body(...), lane_ticket: LaneTicket = Depends(bulk_lane)):
+    # Klasteryzacja wektorów (np. podział profilu postaci na warianty): mini-batch k-means z k-means++
+    # i automatycznym k albo aglomeracja z progiem odległości
+    started = time.perf_counter()
+    if sum(source is not None for source in (data.paths, data.vectors, data.index)) != 1:
+        raise HTTPException(status_code=400, detail="Podaj dokładnie jedno źródło: 'paths', 'vectors' albo 'index'.")
+    if data.index is not None:
+        index = _get_index_or_error(data.index)
+        matrix, ids = np.asarray(index.matrix, dtype=np.float32), list(index.ids)
+    else:
+        matrix, valid_positions, errors = await _resolve_query_vectors(request, data.paths, data.vectors)
+        ids = data.ids if data.ids is not None else (data.paths if data.paths is not None else [str(row) for row in range(len(matrix))])
+        if errors: # Pominięte obrazy nie biorą udziału w klasteryzacji
+            if len(ids) != len(data.paths):
+                raise HTTPException(status_code=400, detail=f"Liczba identyfikatorów ({len(ids)}) różni się od liczby ścieżek ({len(data.paths)}).")
+            ids = [ids[position] for position in valid_positions]
+    if len(ids) != len(matrix):
+        raise HTTPException(status_code=400, detail=f"Liczba identyfikatorów ({len(ids)}) różni się od liczby wektorów ({len(matrix)}).")
+    if len(matrix) == 0:
+        raise HTTPException(status_code=400, detail="Brak wektorów do klasteryzacji.")
+    try:
+        result = await run_in_threadpool(_run_clustering, matrix, data)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Błąd w /cluster: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Błąd serwera podczas klasteryzacji: {str(e)}")
+    result["ids"] = ids
+    if data.index is None:
+        result["errors"], result["skipped"] = errors, len(errors)
+    result["elapsed_ms"] = (time.perf_counter() - started) * 1000.0
+    return result
+
 @app.get("/health")
 async def health_check():
     initialized_fully = False
@@ -545,18 +5019,591 @@ async def health_check():
 
     if embedder:
         current_device = embedder.effective_device
-        if embedder.model_ort_instance and embedder.processor and embedder.ort_session: 
+        if embedder.is_ready():
             initialized_fully = True
-            details = f"Embedder zainicjalizowany. Efektywne urządzenie: {current_device}."
+            details = f"Embedder zainicjalizowany. Efektywne urządzenie: {current_device}, wariant modelu: {embedder.model_variant}."
         else:
             details = f"Embedder częściowo zainicjalizowany. Sprawdź logi. Efektywne urządzenie: {current_device}."
             
     status = "ok" if initialized_fully else "error"
-    return {"status": status, "embedder_fully_initialized": initialized_fully, "effective_device": current_device, "details": details}
+    batching = {name: batcher.stats() for name, batcher in (("image", image_batcher), ("text", text_batcher)) if batcher}
+    return {"status": status, "embedder_fully_initialized": initialized_fully, "effective_device": current_device, "details": details,
+            "model_variant": embedder.model_variant if embedder else MODEL_VARIANT,
+            "session": embedder.describe_session_settings() if embedder else None,
+            "startup_timings": {**startup_timings, "embedder_phases": embedder.startup_timings if embedder else None},
+            "batching": batching, "embedding_cache": embedding_cache.stats() if embedding_cache else None,
+            "text_cache": text_cache.stats() if text_cache else None, "models": model_registry.describe(),
+            "lanes": {name: lane.stats() for name, lane in priority_lanes.items()},
+            "inference_gate": {"slots": inference_gate.slots, "busy": inference_gate.busy, "waiting": dict(inference_gate.waiting)}}
+
+@app.get("/models")
+async def list_models_endpoint():
+    return model_registry.describe()
+
+@app.post("/models/load")
+async def load_model_endpoint(request: Request):
+    # Rozgrzanie modelu przed ruchem (np. przed reindeksacją) - model jak w innych endpointach: ?model= lub X-CLIP-Model
+    if not (request.query_params.get("model") or request.headers.get("x-clip-model")):
+        raise HTTPException(status_code=400, detail="Wskaż model parametrem ?model= lub nagłówkiem X-CLIP-Model.")
+    model = await _request_model(request)
+    return model.describe()
+
+@app.delete("/models/{model_name:path}")
+async def unload_model_endpoint(model_name: str):
+    try:
+        model_id, model_variant = ModelRegistry.parse_model_name(model_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    key = ModelRegistry.model_key(model_id, model_variant)
+    if key == model_registry.default_key:
+        raise HTTPException(status_code=409, detail=f"Model domyślny '{key}' nie może zostać usunięty.")
+    if not model_registry.unload(key):
+        raise HTTPException(status_code=404, detail=f"Model '{key}' nie jest załadowany.")
+    return {"unloaded": key}
+
+# --- Metryki i profilowanie (endpointy) ---
+def _refresh_scrape_metrics():
+    # Wartości odczytywane z istniejących obiektów w chwili scrape (bez kosztu na ścieżce żądań). Liczniki *_total
+    # modeli i mikro-batcherów rosną w rejestrze na bieżąco - nie spadają, gdy model zostanie usunięty z pamięci.
+    for name in ("clip_model_info", "clip_model_memory_bytes", "clip_microbatch_queue_depth"):
+        metrics.clear(name)
+    for model in model_registry.loaded():
+        model_embedder = model.embedder
+        provider = getattr(model_embedder, "active_provider", None) or ("remote" if model_embedder.inference_client else "N/A")
+        metrics.set("clip_model_info", 1, {"model": model.key, "model_id": model_embedder.model_id, "variant": model_embedder.model_variant,
+                                           "provider": provider, "device": model_embedder.effective_device, "default": "true" if model.pinned else "false",
+                                           "inference_host": (INFERENCE_HOST_ADDRESS or "") if model.pinned else ""})
+        metrics.set("clip_model_memory_bytes", model.estimated_bytes, {"model": model.key})
+        for batcher in (model.image_batcher, model.text_batcher):
+            metrics.set("clip_microbatch_queue_depth", batcher.stats()["queue_depth"], {"batcher": batcher.name})
+    metrics.set("clip_models_loaded", len(model_registry.loaded()))
+    for lane_name, lane in priority_lanes.items():
+        lane_stats = lane.stats()
+        metrics.set("clip_lane_active", lane_stats["active"], {"lane": lane_name})
+        metrics.set("clip_lane_queue_depth", lane_stats["queue_depth"], {"lane": lane_name})
+        metrics.set("clip_lane_admitted_total", lane_stats["admitted_total"], {"lane": lane_name})
+        metrics.set("clip_lane_rejected_total", lane_stats["rejected_total"], {"lane": lane_name})
+        metrics.set("clip_lane_cancelled_total", lane_stats["cancelled_total"], {"lane": lane_name})
+        metrics.set("clip_inference_gate_waiting", inference_gate.waiting[lane_name], {"lane": lane_name})
+    metrics.set("clip_model_loads_total", model_registry.loads_total)
+    metrics.set("clip_model_evictions_total", model_registry.evictions_total)
+    metrics.set("clip_embedder_ready", 1 if embedder and embedder.is_ready() else 0)
+    for phase, seconds in {**startup_timings, **(embedder.startup_timings if embedder else {})}.items():
+        metrics.set("clip_startup_seconds", seconds, {"phase": phase})
+    if embedding_cache:
+        cache_stats = embedding_cache.stats()
+        for event in ("memory_hits", "disk_hits", "misses", "inserts", "evictions"):
+            metrics.set("clip_embedding_cache_total", cache_stats[event], {"event": event})
+        metrics.set("clip_embedding_cache_memory_items", cache_stats["memory_items"])
+    if text_cache:
+        text_cache_stats = text_cache.stats()
+        for event in ("memory_hits", "disk_hits", "misses", "inserts"):
+            metrics.set("clip_text_cache_total", text_cache_stats[event], {"event": event})
+        metrics.set("clip_text_cache_memory_items", text_cache_stats["memory_items"])
+    metrics.set("clip_profiling_active", 1 if profiling_session is not None else 0)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    _refresh_scrape_metrics()
+    return Response(content=metrics.render(), media_type=PROMETHEUS_MEDIA_TYPE)
+
+class ProfileInput(BaseModel):
+    requests: int = Field(50, ge=1, le=100000, example=50)
+    mode: Literal["sample", "cprofile"] = "sample"
+    interval_ms: float = Field(5.0, ge=0.5, le=1000.0)
+
+def _start_profiling(session: ProfilingSession):
+    global profiling_session
+    profiling_session = session
+    session.start()
+
+def _stop_profiling() -> Optional[ProfilingSession]:
+    global profiling_session, last_profiling_session
+    session, profiling_session = profiling_session, None
+    if session is None:
+        return None
+    try:
+        session.stop()
+    except Exception as e_profile:
+        logger.error(f"Błąd zapisu profilu: {e_profile}", exc_info=True)
+    last_profiling_session = session
+    return session
+
+def _finish_profiled_request():
+    session = profiling_session
+    if session is not None and session.request_finished():
+        _stop_profiling()
+
+@app.post("/debug/profile")
+async def start_profile_endpoint(data: ProfileInput = Body(...)):
+    if profiling_session is not None:
+        raise HTTPException(status_code=409, detail=f"Profilowanie już trwa: {profiling_session.describe()}")
+    _start_profiling(ProfilingSession(data.requests, data.mode, data.interval_ms))
+    return profiling_session.describe()
+
+@app.get("/debug/profile")
+async def profile_status_endpoint():
+    session = profiling_session or last_profiling_session
+    if session is None:
+        raise HTTPException(status_code=404, detail="Profilowanie nie było uruchamiane.")
+    return session.describe()
+
+@app.delete("/debug/profile")
+async def stop_profile_endpoint():
+    # Zakończenie przed zebraniem N żądań - profil z dotychczasowych żądań i tak jest zapisywany
+    session = _stop_profiling()
+    if session is None:
+        raise HTTPException(status_code=404, detail="Profilowanie nie jest aktywne.")
+    return session.describe()
+
+def _collect_sample_images(sources: List[str], limit: int) -> List[str]:
+    sample_paths: List[str] = []
+    for source in sources:
+        source_path = pathlib.Path(source)
+        if source_path.is_dir():
+            sample_paths.extend(str(entry.path) for entry in iter_image_files(source_path, DEFAULT_IMAGE_EXTENSIONS))
+        else:
+            sample_paths.append(str(source_path))
+        if len(sample_paths) >= limit:
+            break
+    return sample_paths[:limit]
+
+def _run_check_variant(args: argparse.Namespace):
+    sample_paths = _collect_sample_images(args.samples, args.limit)
+    if not sample_paths:
+        raise SystemExit("Brak obrazów do porównania.")
+    report = compare_model_variants(sample_paths, args.variant, model_id=args.model_id, device=args.device, texts=args.texts)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.min_cosine is not None and report["cosine_min"] < args.min_cosine:
+        raise SystemExit(f"Minimalne podobieństwo kosinusowe {report['cosine_min']:.4f} < {args.min_cosine}")
+
+# --- Indeksowanie offline (CLI) ---
+OFFLINE_MANIFEST_FORMAT = "clip-offline-index"
+OFFLINE_VECTOR_DTYPE = np.float16
+
+class OfflineIndexWriter:
+    # Wynik indeksowania offline w folderze indeksów: <nazwa>.vectors.<wersja>.npy (macierz float16 ze znormalizowanymi
+    # wierszami, pisana przez memmap) + <nazwa>.manifest.jsonl (nagłówek z modelem, wymiarem i plikiem wektorów, potem rekordy
+    # plików: ścieżka, rozmiar, mtime, hash zawartości, wiersz; ostatni rekord ścieżki wygrywa). Każda partia to najpierw
+    # wektory (flush), potem rekordy manifestu (fsync), więc przerwanie w dowolnym momencie zostawia spójny stan do wznowienia.
+    # finalize() domyka dziury po usuniętych plikach i zapisuje <nazwa>.meta.json - VectorIndex ładuje wtedy wynik przez mmap.
+    # Plik wskazany w meta.json (opublikowany) jest niezmienny - działający serwer może go mieć zmapowany. Wznowienie,
+    # które coś w nim zmienia, powiększenie i przebudowa piszą nową wersję pliku wektorów (rekord {"vectors": ...}
+    # w manifeście); przełączenie serwera następuje przez meta.json w finalize().
+    def __init__(self, directory: pathlib.Path, name: str, model_key: str):
+        self.directory = directory
+        self.name = name
+        self.model_key = model_key
+        self.vectors_path, self.meta_path = VectorIndex.paths(directory, name)
+        self.manifest_path = directory / f"{name}.manifest.jsonl"
+        self.records: Dict[str, Dict[str, Any]] = {}
+        self.dim: Optional[int] = None
+        self.row_count = 0 # Wiersze [0, row_count) są przydzielone (żywe albo zwolnione)
+        self._free_rows: List[int] = []
+        self._capacity_hint = 0
+        self._matrix: Optional[np.memmap] = None
+        self._manifest_file = None
+        self._published_name: Optional[str] = None
+
+    def open(self, rebuild: bool = False):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if rebuild:
+            # Wektory i meta.json zostają: serwer serwuje poprzednią wersję do finalize(), które sprząta stare pliki
+            if self.manifest_path.exists():
+                self.manifest_path.unlink()
+        if self.manifest_path.exists():
+            self._read_manifest()
+        self._published_name = self._read_published_name()
+        if self.records:
+            # Opublikowany plik tylko do odczytu - pierwszy zapis przełącza na kopię (_ensure_unpublished)
+            mode = "r" if self.vectors_path.name == self._published_name else "r+"
+            matrix = np.load(self.vectors_path, mmap_mode=mode, allow_pickle=False) if self.vectors_path.exists() else None
+            if matrix is None or matrix.dtype != OFFLINE_VECTOR_DTYPE or matrix.ndim != 2 or matrix.shape[1] != self.dim \
+                    or matrix.shape[0] < self.row_count:
+                raise RuntimeError(f"Plik '{self.vectors_path}' nie pasuje do manifestu (zmieniony poza indeksowaniem offline?). Uruchom z --rebuild.")
+            self._matrix = matrix
+            used_rows = {record["row"] for record in self.records.values()}
+            self._free_rows = sorted((row for row in range(self.row_count) if row not in used_rows), reverse=True)
+        if self._matrix is not None:
+            self._manifest_file = open(self.manifest_path, "a", encoding="utf-8")
+
+    def _read_published_name(self) -> Optional[str]:
+        # Plik wektorów, który wskazuje bieżący meta.json
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return pathlib.Path(meta.get("vectors_file") or VectorIndex.paths(self.directory, self.name)[0].name).name
+
+    def _read_manifest(self):
+        valid_bytes = 0
+        with open(self.manifest_path, "rb") as f:
+            header_line = f.readline()
+            try:
+                header = json.loads(header_line)
+            except ValueError:
+                header = None
+            if not header_line.endswith(b"\n") or not isinstance(header, dict) or header.get("format") != OFFLINE_MANIFEST_FORMAT:
+                raise RuntimeError(f"'{self.manifest_path}' nie jest manifestem indeksowania offline. Uruchom z --rebuild.")
+            if header.get("model") != self.model_key:
+                raise RuntimeError(f"Indeks '{self.name}' zbudowano modelem '{header.get('model')}', a nie '{self.model_key}'. Uruchom z --rebuild.")
+            self.dim = int(header["dim"])
+            if header.get("vectors"):
+                self.vectors_path = self.directory / pathlib.Path(header["vectors"]).name
+            valid_bytes = len(header_line)
+            for line in f:
+                try:
+                    record = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    record = None
+                if record is None: # Urwany ostatni wiersz po przerwaniu - zostanie obcięty
+                    break
+                valid_bytes += len(line)
+                if "path" not in record: # Przełączenie na powiększoną wersję pliku wektorów
+                    self.vectors_path = self.directory / pathlib.Path(record["vectors"]).name
+                elif record.get("removed"):
+                    self.records.pop(record["path"], None)
+                else:
+                    self.records[record["path"]] = record
+                    self.row_count = max(self.row_count, record["row"] + 1)
+        if valid_bytes < self.manifest_path.stat().st_size:
+            logger.warning(f"Manifest '{self.manifest_path.name}' ma urwany ostatni rekord - obcinam do {valid_bytes} B.")
+            with open(self.manifest_path, "r+b") as f:
+                f.truncate(valid_bytes)
+
+    def is_current(self, folder_file: "_FolderFile") -> bool:
+        record = self.records.get(folder_file.path)
+        return record is not None and record["size"] == folder_file.size and record["mtime"] == folder_file.mtime
+
+    def reserve(self, new_files: int):
+        # Pojemność z góry na cały przebieg - bez powiększania pliku co partię
+        self._capacity_hint = self.row_count + max(0, new_files - len(self._free_rows))
+        if self._matrix is not None:
+            self._ensure_capacity(self._capacity_hint)
+
+    def _append_records(self, records: List[Dict[str, Any]]):
+        self._manifest_file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+        self._manifest_file.flush()
+        os.fsync(self._manifest_file.fileno())
+
+    def _manifest_header(self) -> str:
+        return json.dumps({"format": OFFLINE_MANIFEST_FORMAT, "version": 1, "model": self.model_key, "dim": self.dim,
+                           "dtype": np.dtype(OFFLINE_VECTOR_DTYPE).name, "vectors": self.vectors_path.name}) + "\n"
+
+    def _create(self, dim: int):
+        self.dim = dim
+        self.vectors_path = VectorIndex.versioned_vectors_path(self.directory, self.name)
+        self._matrix = np.lib.format.open_memmap(self.vectors_path, mode="w+", dtype=OFFLINE_VECTOR_DTYPE,
+                                                 shape=(max(1, self._capacity_hint), dim))
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            f.write(self._manifest_header())
+        self._manifest_file = open(self.manifest_path, "a", encoding="utf-8")
+
+    def _ensure_capacity(self, rows: int):
+        if rows <= self._matrix.shape[0]:
+            return
+        self._switch_vectors_file(max(rows, int(self._matrix.shape[0] * 1.25)))
+
+    def _ensure_unpublished(self):
+        # Przed zapisem wierszy: opublikowanego pliku nie zmieniamy w miejscu (serwer widziałby nowe wektory pod starymi id)
+        if self.vectors_path.name == self._published_name:
+            self._switch_vectors_file(self._matrix.shape[0])
+
+    def _switch_vectors_file(self, capacity: int):
+        # Nowa wersja pliku, przepisanie przydzielonych wierszy blokami i przełączenie manifestu na nią.
+        # Poprzedni plik zostaje (może go wskazywać meta.json używane przez serwer) - sprząta go finalize().
+        grown_path = VectorIndex.versioned_vectors_path(self.directory, self.name)
+        grown = np.lib.format.open_memmap(grown_path, mode="w+", dtype=OFFLINE_VECTOR_DTYPE, shape=(capacity, self.dim))
+        for start in range(0, self.row_count, 65536):
+            stop = min(start + 65536, self.row_count)
+            grown[start:stop] = self._matrix[start:stop]
+        grown.flush()
+        del grown
+        self._matrix.flush()
+        self._matrix = None
+        self._append_records([{"vectors": grown_path.name}])
+        self.vectors_path = grown_path
+        self._matrix = np.load(self.vectors_path, mmap_mode="r+", allow_pickle=False)
+
+    def _take_row(self, path: str) -> int:
+        record = self.records.get(path)
+        if record is not None:
+            return record["row"]
+        if self._free_rows:
+            return self._free_rows.pop()
+        self.row_count += 1
+        return self.row_count - 1
+
+    def write_batch(self, files: List["_FolderFile"], content_hashes: List[str], embeddings: np.ndarray):
+        if self._matrix is None:
+            self._create(int(embeddings.shape[1]))
+        if embeddings.shape[1] != self.dim:
+            raise ValueError(f"Wymiar embeddingów ({embeddings.shape[1]}) różni się od wymiaru indeksu '{self.name}' ({self.dim}).")
+        rows = [self._take_row(folder_file.path) for folder_file in files]
+        self._ensure_capacity(max(rows) + 1)
+        self._ensure_unpublished()
+        self._matrix[rows] = normalize_rows(embeddings).astype(OFFLINE_VECTOR_DTYPE)
+        self._matrix.flush()
+        records = [{"path": folder_file.path, "size": folder_file.size, "mtime": folder_file.mtime, "hash": content_hash, "row": row}
+                   for folder_file, content_hash, row in zip(files, content_hashes, rows)]
+        self._append_records(records)
+        for record in records:
+            self.records[record["path"]] = record
+
+    def remove(self, paths: List[str]):
+        removed = [self.records.pop(path) for path in paths if path in self.records]
+        if not removed:
+            return
+        self._append_records([{"path": record["path"], "removed": True} for record in removed])
+        self._free_rows = sorted(self._free_rows + [record["row"] for record in removed], reverse=True)
+
+    def finalize(self) -> int:
+        if self._matrix is None:
+            return 0
+        # Dziury po usuniętych plikach zapełniane ostatnimi wierszami (wektor przed rekordem - jak w write_batch)
+        row_owners = {record["row"]: path for path, record in self.records.items()}
+        holes = sorted(row for row in self._free_rows if row < len(self.records))
+        if holes:
+            self._ensure_unpublished()
+        moved_records = []
+        for hole in holes:
+            last_row = max(row_owners)
+            self._matrix[hole] = self._matrix[last_row]
+            path = row_owners.pop(last_row)
+            row_owners[hole] = path
+            moved_records.append({**self.records[path], "row": hole})
+        if moved_records:
+            self._matrix.flush()
+            self._append_records(moved_records)
+            for record in moved_records:
+                self.records[record["path"]] = record
+        self.row_count = len(self.records)
+        self._free_rows = []
+        # Kompaktowy manifest (same żywe rekordy) i meta.json dla VectorIndex - oba podmieniane atomowo
+        ordered = sorted(self.records.values(), key=lambda record: record["row"])
+        self._manifest_file.close()
+        tmp_manifest_path = self.manifest_path.with_suffix(f".tmp{os.getpid()}.jsonl")
+        with open(tmp_manifest_path, "w", encoding="utf-8") as f:
+            f.write(self._manifest_header())
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in ordered)
+        os.replace(tmp_manifest_path, self.manifest_path)
+        self._manifest_file = open(self.manifest_path, "a", encoding="utf-8")
+        tmp_meta_path = self.meta_path.with_suffix(f".tmp{os.getpid()}.json")
+        with interprocess_file_lock(VectorIndex.lock_path(self.directory, self.name)):
+            generation = (VectorIndex.read_generation(self.directory, self.name) or 0) + 1
+            with open(tmp_meta_path, "w", encoding="utf-8") as f:
+                json.dump({"name": self.name, "dim": self.dim, "source": "offline", "model": self.model_key, "generation": generation,
+                           "vectors_file": self.vectors_path.name, "ids": [record["path"] for record in ordered],
+                           "metadata": [{"size": record["size"], "mtime": record["mtime"], "hash": record["hash"]} for record in ordered]},
+                          f, ensure_ascii=False)
+            os.replace(tmp_meta_path, self.meta_path)
+            self._published_name = self.vectors_path.name
+            VectorIndex.remove_stale_vectors(self.directory, self.name, keep=self.vectors_path.name)
+        return len(moved_records)
+
+    def close(self):
+        if self._matrix is not None:
+            self._matrix.flush()
+            self._matrix = None
+        if self._manifest_file is not None:
+            self._manifest_file.close()
+            self._manifest_file = None
+
+_offline_preprocessor: Optional[CLIPImageEmbedder] = None
+
+def _init_offline_worker(model_id: str):
+    global _offline_preprocessor
+    logger.setLevel(logging.WARNING)
+    _offline_preprocessor = CLIPImageEmbedder.preprocessing_only(model_id)
+
+def _prepare_offline_file(path: str, preprocessor: Optional[CLIPImageEmbedder] = None) -> Tuple[str, np.ndarray]:
+    # Wykonywane w procesie dekodującym: hash zawartości do manifestu + piksele gotowe do inferencji
+    preprocessor = preprocessor or _offline_preprocessor
+    image_bytes = preprocessor._read_image_bytes(path)
+    return compute_content_hash(image_bytes), preprocessor._prepare_image_pixels(image_bytes)
+
+def _iter_offline_batches(executor, files: List["_FolderFile"], batch_size: int, submit: Callable):
+    # Okno zleceń ograniczone do dwóch partii: procesy dekodują następną partię, gdy bieżąca jest w inferencji,
+    # a pamięć na piksele nie rośnie z rozmiarem archiwum
+    file_iterator = iter(files)
+    window: Deque[Tuple[_FolderFile, Any]] = deque()
+
+    def fill():
+        for folder_file in itertools.islice(file_iterator, 2 * batch_size - len(window)):
+            window.append((folder_file, submit(executor, folder_file.path)))
+
+    fill()
+    try:
+        while window:
+            batch = [window.popleft() for _ in range(min(batch_size, len(window)))]
+            fill()
+            yield batch
+    finally:
+        for _, future in window:
+            future.cancel()
+
+def run_offline_index(root: str, name: str, output_dir: Optional[str] = None, model_id: Optional[str] = None,
+                      model_variant: Optional[str] = None, device: str = DEFAULT_DEVICE, batch_size: int = 64,
+                      decode_processes: int = 0, extensions: Optional[List[str]] = None, patterns: Optional[List[str]] = None,
+                      recursive: bool = True, rebuild: bool = False, keep_missing: bool = False) -> Dict[str, Any]:
+    # Indeksowanie folderu bez HTTP: ten sam CLIPImageEmbedder co serwer, dekodowanie w puli procesów
+    # (decode_processes=0 - pula wątków w tym procesie), duże partie inferencji, wznawialne po przerwaniu.
+    VectorIndexStore.validate_name(name)
+    root_path = pathlib.Path(root).resolve()
+    if not root_path.is_dir():
+        raise ValueError(f"Folder '{root}' nie istnieje.")
+    started = time.perf_counter()
+    offline_embedder = CLIPImageEmbedder(model_id=model_id or DEFAULT_MODEL_ID, device=device, model_variant=model_variant)
+    if not offline_embedder.is_ready():
+        raise RuntimeError("Embedder nie jest zainicjalizowany lub sesja ONNX nie została załadowana")
+    writer = OfflineIndexWriter(pathlib.Path(output_dir) if output_dir else INDEX_DIR, name, offline_embedder.cache_model_key)
+    writer.open(rebuild=rebuild)
+    summary: Dict[str, Any] = {"index": name, "model": offline_embedder.cache_model_key, "root": str(root_path)}
+    try:
+        seen_paths = set()
+        pending: List[_FolderFile] = []
+        for folder_file in iter_image_files(root_path, extensions or DEFAULT_IMAGE_EXTENSIONS, patterns, recursive):
+            seen_paths.add(folder_file.path)
+            if not writer.is_current(folder_file):
+                pending.append(folder_file)
+        root_prefix = str(root_path).rstrip(os.sep) + os.sep
+        missing = [] if keep_missing else [path for path in writer.records if path.startswith(root_prefix) and path not in seen_paths]
+        writer.remove(missing)
+        writer.reserve(len(pending))
+        summary.update({"files": len(seen_paths), "unchanged": len(seen_paths) - len(pending), "removed": len(missing)})
+        logger.info(f"Indeks '{name}': {len(seen_paths)} plików, do przetworzenia {len(pending)}, usuniętych {len(missing)}.")
+
+        if decode_processes > 0:
+            executor = ProcessPoolExecutor(max_workers=decode_processes, initializer=_init_offline_worker,
+                                           initargs=(offline_embedder.model_id,))
+            submit = lambda pool, path: pool.submit(_prepare_offline_file, path)
+        else:
+            executor = get_decode_pool()
+            submit = lambda pool, path: pool.submit(_prepare_offline_file, path, offline_embedder)
+        embedded, failed = 0, 0
+        progress_started = time.perf_counter()
+        try:
+            for batch in _iter_offline_batches(executor, pending, batch_size, submit):
+                ready_files, content_hashes, pixel_values = [], [], []
+                for folder_file, future in batch:
+                    try:
+                        content_hash, pixels = future.result()
+                    except Exception as e_prepare:
+                        failed += 1
+                        logger.warning(f"Pomijam '{folder_file.path}': {type(e_prepare).__name__} - {e_prepare}")
+                        continue
+                    ready_files.append(folder_file)
+                    content_hashes.append(content_hash)
+                    pixel_values.append(pixels)
+                if ready_files:
+                    embeddings = offline_embedder.get_image_embeddings_from_pixels(np.stack(pixel_values))
+                    writer.write_batch(ready_files, content_hashes, embeddings)
+                    embedded += len(ready_files)
+                elapsed = time.perf_counter() - progress_started
+                logger.info(f"Indeks '{name}': {embedded + failed}/{len(pending)} ({embedded / max(elapsed, 1e-9):.1f} obrazów/s, błędy: {failed}).")
+        finally:
+            if executor is not get_decode_pool():
+                executor.shutdown(wait=True, cancel_futures=True)
+        summary["moved_rows"] = writer.finalize()
+        summary.update({"embedded": embedded, "failed": failed, "size": len(writer.records), "dim": writer.dim,
+                        "vectors_path": str(writer.vectors_path), "manifest_path": str(writer.manifest_path),
+                        "elapsed_s": round(time.perf_counter() - started, 3)})
+    finally:
+        writer.close()
+    return summary
+
+def _run_offline_index(args: argparse.Namespace):
+    try:
+        summary = run_offline_index(args.root, args.name, output_dir=args.output, model_id=args.model_id, model_variant=args.variant,
+                                    device=args.device, batch_size=args.batch_size, decode_processes=args.decode_processes,
+                                    extensions=args.extensions, patterns=args.patterns, recursive=not args.no_recursive,
+                                    rebuild=args.rebuild, keep_missing=args.keep_missing)
+    except (ValueError, RuntimeError) as e:
+        raise SystemExit(str(e))
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+
+def _export_session_cli_args(args: argparse.Namespace):
+    # Flagi CLI trafiają do zmiennych środowiskowych, bo workery uvicorn (i tryb --reload) importują moduł od nowa
+    global SESSION_CONFIG_FILE
+    if args.session_config:
+        os.environ["CLIP_SESSION_CONFIG"] = args.session_config
+        SESSION_CONFIG_FILE = pathlib.Path(args.session_config)
+    cli_values = {
+        "workers": args.workers, "intra_op_threads": args.intra_op_threads, "inter_op_threads": args.inter_op_threads,
+        "graph_optimization": args.graph_optimization, "execution_mode": args.execution_mode,
+        "enable_mem_arena": args.mem_arena, "enable_mem_pattern": args.mem_pattern,
+        "cache_optimized_model": args.cache_optimized_model, "io_binding": args.io_binding,
+    }
+    for name, value in cli_values.items():
+        if value is not None:
+            os.environ[SESSION_SETTINGS_ENV[name]] = str(value)
 
+def _build_cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Serwer embeddingów CLIP oraz narzędzia pomocnicze.")
+    session_group = parser.add_argument_group("sesja ONNX Runtime (nadpisują plik konfiguracyjny i zmienne środowiskowe)")
+    session_group.add_argument("--session-config", default=None, help="Plik JSON z ustawieniami sesji")
+    session_group.add_argument("--workers", type=int, default=None, help="Liczba workerów uvicorn (dzieli rdzenie między sesje)")
+    session_group.add_argument("--intra-op-threads", type=int, default=None)
+    session_group.add_argument("--inter-op-threads", type=int, default=None)
+    session_group.add_argument("--graph-optimization", choices=list(GRAPH_OPTIMIZATION_LEVELS), default=None)
+    session_group.add_argument("--execution-mode", choices=list(EXECUTION_MODES), default=None)
+    session_group.add_argument("--mem-arena", choices=["on", "off"], default=None)
+    session_group.add_argument("--mem-pattern", choices=["on", "off"], default=None)
+    session_group.add_argument("--cache-optimized-model", choices=["on", "off"], default=None)
+    session_group.add_argument("--io-binding", choices=["auto", "on", "off"], default=None)
+    parser.add_argument("--shared-inference", action="store_true",
+                        help="Jeden proces inferencji z modelem dla wszystkich workerów HTTP (RAM nie rośnie z --workers)")
+    parser.add_argument("--inference-host", default="127.0.0.1:8009", help="Adres procesu inferencji (host:port)")
+    subparsers = parser.add_subparsers(dest="command")
+    check_parser = subparsers.add_parser("check-variant", help="Porównaj wariant int8/fp16 z fp32 (dryf kosinusowy i przepustowość)")
+    check_parser.add_argument("--variant", choices=[name for name in MODEL_VARIANTS if name != "fp32"], required=True)
+    check_parser.add_argument("--samples", nargs="+", required=True, help="Pliki obrazów lub foldery z próbką")
+    check_parser.add_argument("--limit", type=int, default=64, help="Maksymalna liczba obrazów w próbce")
+    check_parser.add_argument("--texts", nargs="*", default=None, help="Opcjonalne teksty do porównania wieży tekstowej")
+    check_parser.add_argument("--model-id", default=None)
+    check_parser.add_argument("--device", default="cpu")
+    check_parser.add_argument("--min-cosine", type=float, default=None, help="Zakończ z błędem, jeśli minimalny kosinus jest niższy")
+    check_parser.set_defaults(handler=_run_check_variant)
+    index_parser = subparsers.add_parser("index", help="Indeksowanie offline folderu: macierz float16 (memmap) + manifest, wznawialne")
+    index_parser.add_argument("root", help="Folder ze zdjęciami (przeglądany rekurencyjnie)")
+    index_parser.add_argument("--name", required=True, help="Nazwa indeksu (ten sam format co /index/{name})")
+    index_parser.add_argument("--output", default=None, help="Folder wyniku (domyślnie folder indeksów serwera, CLIP_INDEX_DIR)")
+    index_parser.add_argument("--model-id", default=None)
+    index_parser.add_argument("--variant", choices=list(MODEL_VARIANTS), default=None)
+    index_parser.add_argument("--device", default=DEFAULT_DEVICE)
+    index_parser.add_argument("--batch-size", type=int, default=64, help="Rozmiar partii inferencji")
+    index_parser.add_argument("--decode-processes", type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                              help="Procesy dekodujące obrazy (0 = wątki w procesie inferencji)")
+    index_parser.add_argument("--extensions", nargs="+", default=None)
+    index_parser.add_argument("--patterns", nargs="*", default=None, help="Wzorce fnmatch ścieżek względnych")
+    index_parser.add_argument("--no-recursive", action="store_true")
+    index_parser.add_argument("--rebuild", action="store_true", help="Zacznij od zera (np. po zmianie modelu)")
+    index_parser.add_argument("--keep-missing", action="store_true", help="Nie usuwaj z indeksu plików, których już nie ma")
+    index_parser.set_defaults(handler=_run_offline_index)
+    host_parser = subparsers.add_parser("inference-host", help="Uruchom samodzielny proces inferencji dla workerów z CLIP_INFERENCE_HOST")
+    host_parser.set_defaults(handler=lambda args: run_inference_host(args.inference_host, _require_inference_authkey()))
+    return parser
 
 if __name__ == "__main__":
+    cli_args = _build_cli_parser().parse_args()
+    _export_session_cli_args(cli_args)
+    if cli_args.command:
+        cli_args.handler(cli_args)
+        raise SystemExit(0)
     logger.info("Startowanie serwera Uvicorn dla CLIP embeddings...")
+    if cli_args.shared_inference:
+        # Workery uvicorn importują moduł od nowa - adres i klucz procesu inferencji dostają przez env
+        os.environ["CLIP_INFERENCE_HOST"] = cli_args.inference_host
+        os.environ.setdefault("CLIP_INFERENCE_AUTHKEY", secrets.token_hex(16))
+        host_process = multiprocessing.Process(target=run_inference_host, name="clip-inference-host", daemon=True,
+                                               args=(cli_args.inference_host, os.environ["CLIP_INFERENCE_AUTHKEY"].encode("utf-8")))
+        host_process.start()
+        uvicorn.run("clip_server:app", host="127.0.0.1", port=8008, workers=max(1, cli_args.workers or 1), log_level="info")
+        raise SystemExit(0)
+    if cli_args.workers and cli_args.workers > 1:
+        uvicorn.run("clip_server:app", host="127.0.0.1", port=8008, workers=cli_args.workers, log_level="info")
+        raise SystemExit(0)
     # UWAGA: Przy pierwszym uruchomieniu po zmianach (lub jeśli folder 'models' jest pusty),
     # uruchom z --reload LUB --workers 1, aby pozwolić na jednorazowy, zsynchronizowany eksport modelu.
     # Dopiero potem używaj --workers N (np. --workers 4) dla wielu procesów.
@@ -1 +1,2 @@
+set CLIP_WORKERS=2
 uvicorn clip_server:app --workers 2 --host 127.0.0.1 --port 8008 --log-level info
\ No newline at end of file
@@ -1,6 +1,7 @@
 ﻿// Plik: Services/ClipServiceHttpClient.cs
 using System;
 using System.Diagnostics;
+using System.Net;
 using System.Net.Http;
 using System.Net.Http.Json;
 using System.Text.Json;
@@ -17,6 +18,9 @@ namespace CosplayManager.Services
         private readonly HttpClient _httpClient;
         private readonly string _baseAddress = "http://127.0.0.1:8008"; // Upewnij się, że to port, na którym ręcznie uruchamiasz serwer Pythona
         private bool _isServerConfirmedRunning = false;
+        private static readonly TimeSpan MaxRetryAfterDelay = TimeSpan.FromSeconds(30);
+        private const int MaxOverloadRetries = 10;
+        private static readonly TimeSpan MaxOverloadRetryDuration = TimeSpan.FromMinutes(5);
 
         public ClipServiceHttpClient()
         {
@@ -136,7 +140,7 @@ namespace CosplayManager.Services
                 // Użyj przekazanego CancellationToken lub domyślnego (jeśli nie ma) z rozsądnym timeoutem
                 var effectiveCts = CancellationTokenSource.CreateLinkedTokenSource(cancellationToken, new CancellationTokenSource(TimeSpan.FromSeconds(120)).Token);
 
-                HttpResponseMessage response = await _httpClient.PostAsJsonAsync(endpoint, payload, effectiveCts.Token);
+                using HttpResponseMessage response = await PostAsJsonWithRetryAsync(endpoint, payload, "GetImageEmbeddingFromPathAsync", effectiveCts.Token);
                 SimpleFileLogger.Log($"GetImageEmbeddingFromPathAsync: Otrzymano odpowiedź dla: {imagePath}. Status: {response.StatusCode}");
 
                 if (response.IsSuccessStatusCode)
@@ -187,7 +191,7 @@ namespace CosplayManager.Services
             return null;
         }
 
-        public async Task<List<float[]>?> GetImageEmbeddingsBatchAsync(List<string> imagePaths, CancellationToken cancellationToken = default)
+        public async Task<List<float[]?>?> GetImageEmbeddingsBatchAsync(List<string> imagePaths, CancellationToken cancellationToken = default)
         {
             if (!_isServerConfirmedRunning)
             {
@@ -202,7 +206,7 @@ namespace CosplayManager.Services
             if (imagePaths == null || !imagePaths.Any())
             {
                 SimpleFileLogger.Log("GetImageEmbeddingsBatchAsync: Lista ścieżek obrazów jest pusta lub null.");
-                return new List<float[]>();
+                return new List<float[]?>();
             }
 
             var payload = new { paths = imagePaths };
@@ -213,7 +217,7 @@ namespace CosplayManager.Services
             {
                 var effectiveCts = CancellationTokenSource.CreateLinkedTokenSource(cancellationToken, new CancellationTokenSource(TimeSpan.FromMinutes(Math.Max(5, imagePaths.Count * 0.5))).Token); // Dynamiczny timeout, min 5 minut
 
-                HttpResponseMessage response = await _httpClient.PostAsJsonAsync(endpoint, payload, effectiveCts.Token);
+                using HttpResponseMessage response = await PostAsJsonWithRetryAsync(endpoint, payload, "GetImageEmbeddingsBatchAsync", effectiveCts.Token);
                 SimpleFileLogger.Log($"GetImageEmbeddingsBatchAsync: Otrzymano odpowiedź dla paczki {imagePaths.Count} obrazów. Status: {response.StatusCode}");
 
                 if (response.IsSuccessStatusCode)
@@ -221,8 +225,16 @@ namespace CosplayManager.Services
                     var result = await response.Content.ReadFromJsonAsync<EmbeddingsBatchResponse>(cancellationToken: effectiveCts.Token);
                     if (result?.embeddings != null && result.embeddings.Count == imagePaths.Count)
                     {
-                        SimpleFileLogger.Log($"GetImageEmbeddingsBatchAsync: Pomyślnie uzyskano {result.embeddings.Count} embeddingów.");
-                        return result.embeddings.Select(e => e.ToArray()).ToList();
+                        // Serwer pomija uszkodzone/brakujące pliki: null na ich pozycji + wpis w 'errors', reszta paczki jest poprawna
+                        if (result.errors != null)
+                        {
+                            foreach (var itemError in result.errors)
+                            {
+                                SimpleFileLogger.LogWarning($"GetImageEmbeddingsBatchAsync: Pominięto '{itemError.path}' ({itemError.code}): {itemError.message}");
+                            }
+                        }
+                        SimpleFileLogger.Log($"GetImageEmbeddingsBatchAsync: Pomyślnie uzyskano {result.embeddings.Count - result.skipped} embeddingów (pominięte: {result.skipped}).");
+                        return result.embeddings.Select(e => e?.ToArray()).ToList();
                     }
                     else
                     {
@@ -263,6 +275,39 @@ namespace CosplayManager.Services
             return null;
         }
 
+        // Serwer odpowiada 429 z nagłówkiem Retry-After, gdy kolejka jego pasa priorytetu jest pełna.
+        // Ponawiamy najwyżej MaxOverloadRetries razy i nie dłużej niż MaxOverloadRetryDuration (także przy CancellationToken.None),
+        // potem zwracamy odpowiedź 429 wywołującemu, który loguje ją jak każdy inny błąd serwera.
+        private async Task<HttpResponseMessage> PostAsJsonWithRetryAsync(string endpoint, object payload, string caller, CancellationToken cancellationToken)
+        {
+            DateTimeOffset deadline = DateTimeOffset.UtcNow + MaxOverloadRetryDuration;
+            for (int attempt = 1; ; attempt++)
+            {
+                HttpResponseMessage response = await _httpClient.PostAsJsonAsync(endpoint, payload, cancellationToken);
+                if (response.StatusCode != HttpStatusCode.TooManyRequests)
+                {
+                    return response;
+                }
+                if (attempt > MaxOverloadRetries || DateTimeOffset.UtcNow >= deadline)
+                {
+                    SimpleFileLogger.LogWarning($"{caller}: Serwer CLIP nadal przeciążony (429) po {attempt} próbach, rezygnuję z żądania do {endpoint}.");
+                    return response;
+                }
+
+                TimeSpan delay = response.Headers.RetryAfter?.Delta
+                    ?? (response.Headers.RetryAfter?.Date - DateTimeOffset.UtcNow)
+                    ?? TimeSpan.FromSeconds(1);
+                response.Dispose();
+                if (delay < TimeSpan.FromMilliseconds(500)) delay = TimeSpan.FromMilliseconds(500);
+                if (delay > MaxRetryAfterDelay) delay = MaxRetryAfterDelay;
+                delay += TimeSpan.FromMilliseconds(Random.Shared.Next(0, 250)); // Rozproszenie, żeby równoległe zadania nie wracały naraz
+                TimeSpan remaining = deadline - DateTimeOffset.UtcNow;
+                if (delay > remaining) delay = remaining > TimeSpan.Zero ? remaining : TimeSpan.Zero;
+
+                SimpleFileLogger.LogWarning($"{caller}: Serwer CLIP jest przeciążony (429), ponowienie żądania do {endpoint} za {delay.TotalSeconds:F1}s.");
+                await Task.Delay(delay, cancellationToken);
+            }
+        }
 
         public void Dispose()
         {
@@ -279,8 +324,18 @@ namespace CosplayManager.Services
 
         private class EmbeddingsBatchResponse
         {
-            public List<List<float>>? embeddings { get; set; }
+            public List<List<float>?>? embeddings { get; set; }
+            public List<BatchItemError>? errors { get; set; }
+            public int skipped { get; set; }
             public string? error { get; set; }
         }
+
+        private class BatchItemError
+        {
+            public int index { get; set; }
+            public string? path { get; set; }
+            public string? code { get; set; }
+            public string? message { get; set; }
+        }
     }
 }
\ No newline at end of file
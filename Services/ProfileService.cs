@@ -189,7 +189,7 @@ namespace CosplayManager.Services
                                     StatusMessage = $"Serwer CLIP: Paczka {currentBatchNumber}/{totalBatches} ({pathsForBatch.Count} obr.)..."
                                 });
 
-                                List<float[]>? batchEmbeddings = await _clipService.GetImageEmbeddingsBatchAsync(pathsForBatch, cancellationToken);
+                                List<float[]?>? batchEmbeddings = await _clipService.GetImageEmbeddingsBatchAsync(pathsForBatch, cancellationToken);
 
                                 if (batchEmbeddings != null && batchEmbeddings.Count == currentBatchEntries.Count)
                                 {